@@ -83,6 +83,18 @@ interface Demo1Options : DataflowPipelineOptions {
 
     fun setAvroOutputPath(avroOutputPath: ValueProvider<String>)
 
+    @get:Description("Avro block codec: null, deflate, snappy, bzip2 or xz. Default: deflate")
+    @get:Default.String("deflate")
+    val avroCodec: String
+
+    fun setAvroCodec(avroCodec: String)
+
+    @get:Description("Number of Avro shards per partition. Example: 30 for 30 files. 0 lets the runner choose. Default: 0")
+    @get:Default.Integer(0)
+    val avroShards: Int
+
+    fun setAvroShards(avroShards: Int)
+
     @get:Description("Latitude in radians to center row latitude values on. Example: 41.8839. Default: 41.8839 (Chicago City Hall)")
     @get:Default.Double(41.8839)
     val mapCenterLat: ValueProvider<Double>
@@ -7,6 +7,7 @@ import com.ntconcepts.gcpdemo1.models.TaxiTripOutput
 import com.ntconcepts.gcpdemo1.transforms.*
 import com.ntconcepts.gcpdemo1.utils.AvroNamingFn
 import com.ntconcepts.gcpdemo1.utils.CSVNamingFn
+import org.apache.avro.file.CodecFactory
 import org.apache.avro.generic.GenericRecord
 import org.apache.beam.sdk.Pipeline
 import org.apache.beam.sdk.coders.*
@@ -399,6 +400,27 @@ fun writeCSV(
 }
 
 fun writeAvro(options: Demo1Options, p: PCollection<KV<TaxiRideL1, TaxiTripOutput>>) {
+    val write = FileIO.writeDynamic<String, TaxiTripOutput>()
+        .by {
+            it.ml_partition
+        }
+        .via(Contextful.fn<TaxiTripOutput, GenericRecord>(
+            SerializableFunction {
+                it.toGenericRecord()
+            }
+        ),
+            AvroIO.sink(TaxiTripOutput.AvroSchemaGetter.schema(daysOfWeekList, monthsList))
+                .withCodec(CodecFactory.fromString(options.avroCodec))
+        )
+        .to(options.avroOutputPath)
+        .withDestinationCoder(StringUtf8Coder.of())
+        .withNaming(
+            Contextful.fn(
+                SerializableFunction {
+                    AvroNamingFn(it)
+                })
+        )
+
     p.apply(
         "Map to TaxiTripOutput",
         MapElements.into(TypeDescriptor.of(TaxiTripOutput::class.java))
@@ -408,25 +430,8 @@ fun writeAvro(options: Demo1Options, p: PCollection<KV<TaxiRideL1, TaxiTripOutpu
     )
         .apply(
             "Write Avro",
-            FileIO.writeDynamic<String, TaxiTripOutput>()
-                .by {
-                    it.ml_partition
-                }
-                .via(Contextful.fn<TaxiTripOutput, GenericRecord>(
-                    SerializableFunction {
-                        it.toGenericRecord()
-                    }
-                ),
-                    AvroIO.sink(TaxiTripOutput.AvroSchemaGetter.schema(daysOfWeekList, monthsList))
-                )
-                .to(options.avroOutputPath)
-                .withDestinationCoder(StringUtf8Coder.of())
-                .withNaming(
-                    Contextful.fn(
-                        SerializableFunction {
-                            AvroNamingFn(it)
-                        })
-                )
+            // 0 leaves the shard count to the runner
+            if (options.avroShards > 0) write.withNumShards(options.avroShards) else write
         )
 
 }
@@ -0,0 +1,71 @@
+from typing import Callable, List, Optional
+
+import tensorflow as tf
+
+DTYPES = {
+    'float32': tf.float32,
+    'float16': tf.float16,
+    'bfloat16': tf.bfloat16,
+}
+
+
+def all_reduce(values: List[tf.Tensor], reduce_op=tf.distribute.ReduceOp.SUM, pack=False,
+               dtype='float32') -> List[tf.Tensor]:
+    """All-reduces `values` across replicas from a replica context.
+
+    With `pack` the values are flattened into one buffer so each step pays
+    the collective's latency once instead of once per tensor. With a
+    `dtype` narrower than float32 the values are sent in that dtype and
+    cast back afterwards, halving the bytes on the wire.
+    """
+    context = tf.distribute.get_replica_context()
+
+    if pack:
+        shapes = [tf.shape(value) for value in values]
+        sizes = [tf.size(value) for value in values]
+        buffers = [tf.concat([tf.reshape(value, [-1]) for value in values], 0)]
+    else:
+        buffers = values
+
+    reduced = context.all_reduce(reduce_op, [tf.cast(buffer, DTYPES[dtype]) for buffer in buffers])
+    reduced = [tf.cast(value, buffer.dtype) for value, buffer in zip(reduced, buffers)]
+
+    if pack:
+        return [tf.reshape(part, shape) for part, shape in zip(tf.split(reduced[0], sizes), shapes)]
+    return reduced
+
+
+def get_gradient_reducer(params: dict) -> Optional[Callable]:
+    """Replaces the optimizer's implicit gradient all-reduce, or None to keep it.
+
+    Synchronous steps sum the gradients across replicas like the optimizer
+    does. With --local-sgd-steps > 1 every step is local: each replica
+    applies its own gradients, scaled to the same magnitude, and the weights
+    are averaged by average_variables every --local-sgd-steps steps instead.
+    """
+    pack = params['allreduce_pack'] is True
+    dtype = params['allreduce_dtype']
+    if params['local_sgd_steps'] > 1:
+        def scale_local(gradients):
+            num_replicas = tf.distribute.get_replica_context().num_replicas_in_sync
+            return [gradient * num_replicas for gradient in gradients]
+        return scale_local
+    if not pack and dtype == 'float32':
+        return None
+    return lambda gradients: all_reduce(gradients, pack=pack, dtype=dtype)
+
+
+def average_variables(variables: List[tf.Variable], pack=False, dtype='float32'):
+    """Replaces each replica's copy of `variables` with the mean over replicas. Call from a replica context"""
+    averaged = all_reduce(
+        [tf.identity(variable) for variable in variables],
+        reduce_op=tf.distribute.ReduceOp.MEAN,
+        pack=pack,
+        dtype=dtype
+    )
+
+    def assign(strategy, pairs):
+        for variable, value in pairs:
+            strategy.extended.update(variable, lambda v, t: v.assign(t), args=(value,), group=False)
+
+    tf.distribute.get_replica_context().merge_call(assign, args=(list(zip(variables, averaged)),))
@@ -1,31 +1,52 @@
 
 import tensorflow as tf
 
+from trainer.data import features as features
+
+
+PRECISIONS = ['float32', 'mixed_bfloat16']
+
+
+def get_policy(precision: str):
+    """Keras dtype policy for --precision; None keeps the float32 default"""
+    if precision == 'float32':
+        return None
+    mixed_precision = tf.keras.mixed_precision
+    policy_class = getattr(mixed_precision, 'Policy', None) or mixed_precision.experimental.Policy
+    return policy_class(precision)
+
 
 def get(params: dict) -> tf.keras.Sequential:
+    # With mixed_bfloat16 the hidden layers compute in bfloat16 on float32
+    # variables; the output layer stays float32 so the sigmoid and the loss do.
+    dtype = get_policy(params.get('precision', 'float32'))
     return tf.keras.Sequential([
         tf.keras.layers.Dense(
             params['dense_neurons_1'],
-            input_shape=(26,),
-            kernel_initializer=params['kernel_initial_1']
+            input_shape=(features.num_features(),),
+            kernel_initializer=params['kernel_initial_1'],
+            dtype=dtype
         ),
-        tf.keras.layers.BatchNormalization(axis=1),
-        tf.keras.layers.Activation(activation=params['activation']),
-        tf.keras.layers.Dropout(params['dropout_rate']),
+        tf.keras.layers.BatchNormalization(axis=1, dtype=dtype),
+        tf.keras.layers.Activation(activation=params['activation'], dtype=dtype),
+        tf.keras.layers.Dropout(params['dropout_rate'], dtype=dtype),
         tf.keras.layers.Dense(
             params['dense_neurons_2'],
             kernel_initializer=params['kernel_initial_2'],
-            activation=params['activation']
+            activation=params['activation'],
+            dtype=dtype
         ),
-        tf.keras.layers.Dropout(params['dropout_rate']),
+        tf.keras.layers.Dropout(params['dropout_rate'], dtype=dtype),
         tf.keras.layers.Dense(
             params['dense_neurons_3'],
             kernel_initializer=params['kernel_initial_3'],
-            activation=params['activation']
+            activation=params['activation'],
+            dtype=dtype
         ),
-        tf.keras.layers.Dropout(params['dropout_rate']),
+        tf.keras.layers.Dropout(params['dropout_rate'], dtype=dtype),
         tf.keras.layers.Dense(
             1,
-            activation='sigmoid'
+            activation='sigmoid',
+            dtype='float32'
         )
-    ])
\ No newline at end of file
+    ])
@@ -0,0 +1,574 @@
+"""CPU benchmarks for the training package.
+
+Run from `mlp_trainer/`, e.g.:
+
+    python -m trainer.benchmark --benchmark=train-step --batch-size=102400
+"""
+import argparse
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+import fastavro
+import numpy as np
+import tensorflow as tf
+
+import trainer.base_model as base_model
+import trainer.io_worker as io_worker
+import trainer.model_loop as model_loop
+import trainer.serving as serving
+import trainer.timing as timing
+from trainer.data import avro as avro_generator
+from trainer.data import features
+from trainer.data import synthetic
+
+MODEL_PARAMS = {
+    'dense_neurons_1': 64,
+    'dense_neurons_2': 32,
+    'dense_neurons_3': 16,
+    'activation': 'relu',
+    'dropout_rate': 0.1,
+    'kernel_initial_1': 'normal',
+    'kernel_initial_2': 'normal',
+    'kernel_initial_3': 'normal',
+    'learning_rate': 0.01,
+}
+
+# Formats and codecs compared by the codec benchmark: TFRecord compression
+# types as written by pipeline.py and Avro block codecs
+TFRECORD_CODECS = ['none', 'gzip', 'zlib']
+AVRO_CODECS = ['null', 'deflate', 'snappy', 'zstandard']
+
+# A range size no object reaches, so each object is downloaded in one request
+WHOLE_OBJECT_MB = 1 << 20
+
+
+def run_train_steps(params: Dict[str, Any], batch_size: int, steps: int, warmup_steps: int,
+                    accum_steps=1, jit_compile=False) -> Dict[str, float]:
+    """Times `steps` train steps of the custom loop's train step on synthetic data"""
+    tf.random.set_seed(0)
+    model = base_model.get(params)
+    optimizer = tf.optimizers.Adam(learning_rate=params['learning_rate'])
+    loss_object = tf.keras.losses.BinaryCrossentropy(reduction=tf.keras.losses.Reduction.NONE)
+
+    def compute_loss(labels, predictions):
+        per_example_loss = loss_object(labels, predictions)
+        return per_example_loss, tf.nn.compute_average_loss(per_example_loss, global_batch_size=batch_size)
+
+    accuracy = tf.keras.metrics.BinaryAccuracy()
+    train_step = tf.function(model_loop.make_train_step(
+        model,
+        optimizer,
+        compute_loss,
+        [accuracy],
+        accum_steps=accum_steps,
+        jit_compile=jit_compile,
+    ))
+
+    iterator = iter(synthetic.get_data(batch_size, steps + warmup_steps))
+    for _ in range(warmup_steps):
+        train_step(next(iterator)).numpy()
+
+    start = timing.now()
+    for _ in range(steps):
+        loss = train_step(next(iterator))
+    loss = loss.numpy()
+    elapsed = timing.now() - start
+
+    # Accuracy on a batch the model was not trained on
+    eval_features, eval_labels = synthetic.make_batch(batch_size, seed=1)
+    eval_accuracy = tf.keras.metrics.BinaryAccuracy()
+    eval_accuracy.update_state(eval_labels, model(eval_features, training=False))
+
+    return {
+        'steps_per_sec': steps / elapsed,
+        'examples_per_sec': steps * batch_size / elapsed,
+        'final_loss': float(loss),
+        'accuracy': float(accuracy.result()),
+        'eval_accuracy': float(eval_accuracy.result()),
+    }
+
+
+def train_step_benchmark(args) -> List[Dict[str, Any]]:
+    """Compares the current loop with the XLA compiled and gradient accumulation train steps"""
+    configs = [
+        {'name': 'loop', 'accum_steps': 1, 'jit_compile': False},
+        {'name': 'jit', 'accum_steps': 1, 'jit_compile': True},
+        {'name': 'accum', 'accum_steps': args.grad_accum_steps, 'jit_compile': False},
+        {'name': 'jit_accum', 'accum_steps': args.grad_accum_steps, 'jit_compile': True},
+    ]
+    results = []
+    for config in configs:
+        result = run_train_steps(
+            MODEL_PARAMS,
+            args.batch_size,
+            args.steps,
+            args.warmup_steps,
+            accum_steps=config['accum_steps'],
+            jit_compile=config['jit_compile'],
+        )
+        result.update(config)
+        results.append(result)
+
+    baseline = results[0]['examples_per_sec']
+    for result in results:
+        result['speedup'] = result['examples_per_sec'] / baseline
+    return results
+
+
+def precision_benchmark(args) -> List[Dict[str, Any]]:
+    """Throughput and final accuracy of each --precision against float32"""
+    results = []
+    for precision in base_model.PRECISIONS:
+        params = dict(MODEL_PARAMS)
+        params['precision'] = precision
+        result = run_train_steps(params, args.batch_size, args.steps, args.warmup_steps)
+        result['name'] = precision
+        results.append(result)
+
+    baseline = results[0]
+    for result in results:
+        result['speedup'] = result['examples_per_sec'] / baseline['examples_per_sec']
+        result['eval_accuracy_delta'] = result['eval_accuracy'] - baseline['eval_accuracy']
+    return results
+
+
+def io_jitter_benchmark(args) -> List[Dict[str, Any]]:
+    """Step time jitter with checkpoints and summaries written inline or by a BackgroundWriter.
+
+    Every --io-every-steps steps a checkpoint and a set of scalar summaries
+    are written to --io-dir; point it at a slow local disk to see the
+    difference. Step times include the time spent issuing the writes.
+    """
+    results = []
+    for mode in ['inline', 'background']:
+        output_dir = os.path.join(args.io_dir, mode)
+        model = base_model.get(MODEL_PARAMS)
+        optimizer = tf.optimizers.Adam(learning_rate=MODEL_PARAMS['learning_rate'])
+        loss_object = tf.keras.losses.BinaryCrossentropy()
+
+        @tf.function
+        def train_step(features, labels):
+            with tf.GradientTape() as tape:
+                loss = loss_object(labels, model(features, training=True))
+            gradients = tape.gradient(loss, model.trainable_variables)
+            optimizer.apply_gradients(zip(gradients, model.trainable_variables))
+            return loss
+
+        writer = tf.summary.create_file_writer(os.path.join(output_dir, 'logs'))
+        manager = tf.train.CheckpointManager(
+            tf.train.Checkpoint(optimizer=optimizer, model=model),
+            directory=output_dir,
+            max_to_keep=5
+        )
+        background_writer = None
+        host_checkpoint = None
+        if mode == 'background':
+            background_writer = io_worker.BackgroundWriter(writer)
+            host_checkpoint = io_worker.HostCheckpoint(
+                base_model.get(MODEL_PARAMS),
+                tf.optimizers.Adam(learning_rate=MODEL_PARAMS['learning_rate']),
+                directory=output_dir
+            )
+
+        iterator = iter(synthetic.get_data(args.batch_size, args.steps + args.warmup_steps))
+        for _ in range(args.warmup_steps):
+            train_step(*next(iterator)).numpy()
+
+        step_times = []
+        for step in range(1, args.steps + 1):
+            start = timing.now()
+            loss = train_step(*next(iterator))
+            scalars = {'loss': loss}
+            scalars.update({'metric_{}'.format(i): loss for i in range(10)})
+            if background_writer is not None:
+                background_writer.scalars(scalars, step)
+            else:
+                with writer.as_default():
+                    for name, value in scalars.items():
+                        tf.summary.scalar(name, value, step=step)
+            if step % args.io_every_steps == 0:
+                if background_writer is not None:
+                    background_writer.checkpoint(host_checkpoint, model, optimizer, step)
+                    background_writer.flush()
+                else:
+                    manager.save(step)
+                    writer.flush()
+            loss.numpy()
+            step_times.append(timing.now() - start)
+
+        if background_writer is not None:
+            background_writer.close()
+
+        step_times.sort()
+        mean = sum(step_times) / len(step_times)
+        results.append({
+            'name': mode,
+            'mean_ms': 1000 * mean,
+            'p50_ms': 1000 * step_times[len(step_times) // 2],
+            'p99_ms': 1000 * step_times[min(len(step_times) - 1, int(len(step_times) * .99))],
+            'max_ms': 1000 * step_times[-1],
+            'std_ms': 1000 * (sum((t - mean) ** 2 for t in step_times) / len(step_times)) ** .5,
+        })
+    return results
+
+
+def avro_read_benchmark(args) -> List[Dict[str, Any]]:
+    """Rows/sec and MB/sec reading every Avro object of --partition.
+
+    `whole-object` downloads one object at a time in a single request, as the
+    reader used to; `ranged` uses --download-threads concurrent range
+    downloads of --download-range-mb with --read-ahead-mb of read-ahead,
+    decoding --read-objects objects at once. Point --avro-bucket at a local
+    directory or --avro-endpoint at a fake GCS server to measure offline.
+    """
+    configs = [
+        ('whole-object', {'download_threads': 1, 'download_range_mb': WHOLE_OBJECT_MB, 'read_ahead_mb': 0}, 1),
+        ('ranged', {
+            'download_threads': args.download_threads,
+            'download_range_mb': args.download_range_mb,
+            'read_ahead_mb': args.read_ahead_mb,
+        }, args.read_objects),
+    ]
+
+    def count_rows(obj_name):
+        return sum(1 for _ in avro_generator.generate_blob(args.avro_bucket.encode('utf-8'), obj_name.encode('utf-8')))
+
+    results = []
+    for name, options, read_objects in configs:
+        params = dict(options)
+        params['avro_endpoint'] = args.avro_endpoint
+        avro_generator.configure(params)
+
+        start = timing.now()
+        obj_names = avro_generator.list_blobs(args.avro_bucket, args.avro_prefix, args.partition)
+        with ThreadPoolExecutor(max_workers=read_objects) as pool:
+            rows = sum(pool.map(count_rows, obj_names))
+        elapsed = timing.now() - start
+
+        object_reader = avro_generator.get_object_reader(args.avro_bucket)
+        megabytes = sum(object_reader.size(obj_name) for obj_name in obj_names) / (1 << 20)
+        results.append({
+            'name': name,
+            'objects': len(obj_names),
+            'rows': rows,
+            'rows_per_sec': rows / elapsed,
+            'mb_per_sec': megabytes / elapsed,
+        })
+
+    for result in results:
+        result['speedup'] = result['rows_per_sec'] / results[0]['rows_per_sec'] if results[0]['rows_per_sec'] > 0 else 0.0
+    return results
+
+
+def write_codec_shards(directory: str, file_format: str, codec: str, rows: int, shard_rows: int) -> List[str]:
+    """Writes `rows` synthetic rows as shards of `shard_rows` rows and returns their paths"""
+    os.makedirs(directory, exist_ok=True)
+    feats, labels = synthetic.make_batch(rows, seed=2)
+    names = features.names()
+    paths = []
+    for shard, start in enumerate(range(0, rows, shard_rows)):
+        end = min(start + shard_rows, rows)
+        if file_format == 'tfrecord':
+            path = os.path.join(directory, 'part-{:05d}.tfrecords'.format(shard))
+            options = tf.io.TFRecordOptions(compression_type='' if codec == 'none' else codec.upper())
+            with tf.io.TFRecordWriter(path, options=options) as writer:
+                for i in range(start, end):
+                    feature = {name: tf.train.Feature(float_list=tf.train.FloatList(value=[feats[i, j]]))
+                               for j, name in enumerate(names)}
+                    feature[features.LABEL] = tf.train.Feature(int64_list=tf.train.Int64List(value=[int(labels[i, 0])]))
+                    writer.write(tf.train.Example(features=tf.train.Features(feature=feature)).SerializeToString())
+        else:
+            path = os.path.join(directory, 'part-{:05d}.avro'.format(shard))
+            schema = {
+                'type': 'record',
+                'name': 'TaxiTrip',
+                'fields': [{'name': name, 'type': 'float'} for name in names] + [{'name': features.LABEL, 'type': 'long'}],
+            }
+            records = ({**{name: float(feats[i, j]) for j, name in enumerate(names)}, features.LABEL: int(labels[i, 0])}
+                       for i in range(start, end))
+            with open(path, 'wb') as f:
+                fastavro.writer(f, schema, records, codec=codec)
+        paths.append(path)
+    return paths
+
+
+def read_tfrecords(paths: List[str], codec: str, batch_size: int) -> int:
+    spec = {name: tf.io.FixedLenFeature([], tf.float32) for name in features.names()}
+    spec[features.LABEL] = tf.io.FixedLenFeature([], features.LABEL_DTYPE)
+    dataset = tf.data.TFRecordDataset(
+        paths,
+        compression_type='' if codec == 'none' else codec.upper()
+    ).batch(batch_size).map(lambda records: tf.io.parse_example(records, spec))
+    rows = 0
+    for batch in dataset:
+        rows += int(tf.shape(batch[features.LABEL])[0])
+    return rows
+
+
+def codec_benchmark(args) -> List[Dict[str, Any]]:
+    """Bytes on disk, read throughput and CPU decode cost of each shard codec.
+
+    --codec-rows synthetic rows are written under --io-dir in shards of
+    about --codec-shard-mb (before compression) per codec. Avro shards are
+    read through the trainer's Avro reader, TFRecord shards with
+    TFRecordDataset and parse_example. `cpu_sec_per_mrow` is the process
+    CPU time, all threads included, per million rows. Shards are read from
+    the local disk, usually from the page cache, so this measures decode
+    cost rather than storage bandwidth; divide `bytes_on_disk` by a storage
+    tier's bandwidth to estimate its transfer time.
+    """
+    row_bytes = 4 * features.num_features() + 8
+    shard_rows = max(1, int(args.codec_shard_mb * (1 << 20) / row_bytes))
+    avro_generator.configure({'download_threads': args.download_threads})
+
+    results = []
+    for file_format, codecs in [('tfrecord', TFRECORD_CODECS), ('avro', AVRO_CODECS)]:
+        for codec in codecs:
+            name = '{}-{}'.format(file_format, codec)
+            directory = os.path.join(os.path.abspath(args.io_dir), 'codec', name)
+            try:
+                paths = write_codec_shards(directory, file_format, codec, args.codec_rows, shard_rows)
+            except (ValueError, ImportError) as e:
+                # e.g. the zstandard or python-snappy package is missing
+                logging.warning("Skipping %s: %s", name, e)
+                continue
+
+            wall_start = timing.now()
+            cpu_start = time.process_time()
+            if file_format == 'tfrecord':
+                rows = read_tfrecords(paths, codec, args.batch_size)
+            else:
+                rows = 0
+                for path in paths:
+                    rows += sum(1 for _ in avro_generator.generate_blob(
+                        directory.encode('utf-8'), os.path.basename(path).encode('utf-8')))
+            wall = timing.now() - wall_start
+            cpu = time.process_time() - cpu_start
+
+            results.append({
+                'name': name,
+                'shards': len(paths),
+                'rows': rows,
+                'bytes_on_disk': sum(os.path.getsize(path) for path in paths),
+                'rows_per_sec': rows / wall,
+                'cpu_sec_per_mrow': 1e6 * cpu / max(rows, 1),
+            })
+
+    smallest = min(result['bytes_on_disk'] for result in results) if results else 0
+    for result in results:
+        result['size_vs_smallest'] = result['bytes_on_disk'] / smallest if smallest else 0.0
+    return results
+
+
+def prediction_cache_benchmark(args) -> List[Dict[str, Any]]:
+    """Latency, hit rate and prediction error of the serving cache on near-duplicate requests.
+
+    A model built with MODEL_PARAMS is exported under --io-dir. Each of
+    --cache-requests requests has --cache-request-rows rows drawn from
+    --cache-distinct-rows synthetic rows, with --cache-jitter standard
+    normal noise added to the continuous features. The same requests are
+    served without a cache, with a cache keyed on exact values and with one
+    keyed on --cache-quanta; `max_abs_error` is the largest difference from
+    the uncached predictions.
+    """
+    export_dir = os.path.join(os.path.abspath(args.io_dir), 'serving')
+    base_model.get(MODEL_PARAMS).save(export_dir, save_format='tf')
+
+    rng = np.random.RandomState(0)
+    pool, _ = synthetic.make_batch(args.cache_distinct_rows)
+    continuous = np.array([not serving.is_one_hot(name) for name in features.names()])
+    requests = []
+    for _ in range(args.cache_requests):
+        rows = pool[rng.randint(0, len(pool), size=args.cache_request_rows)].copy()
+        rows[:, continuous] += rng.normal(scale=args.cache_jitter, size=(len(rows), continuous.sum()))
+        requests.append(rows)
+
+    def serve(predict) -> Dict[str, Any]:
+        latencies = []
+        predictions = []
+        for rows in requests:
+            start = timing.now()
+            predictions.append(predict(rows))
+            latencies.append(timing.now() - start)
+        latencies = np.array(latencies)
+        return {
+            'requests_per_sec': len(requests) / latencies.sum(),
+            'mean_ms': 1000. * latencies.mean(),
+            'p99_ms': 1000. * np.percentile(latencies, 99),
+            'predictions': np.concatenate(predictions),
+        }
+
+    uncached = serve(serving.load_model(export_dir))
+    uncached['name'] = 'uncached'
+    results = [uncached]
+    for name, quanta in [('exact', '0'), ('quantized', args.cache_quanta)]:
+        cache = serving.PredictionCache(
+            max_bytes=int(args.cache_mb * (1 << 20)),
+            ttl_secs=args.cache_ttl_secs,
+        )
+        model = serving.CachedModel(export_dir, cache, serving.get_quanta(serving.parse_quanta(quanta)))
+        result = serve(model.predict)
+        result.update(cache.stats())
+        result['name'] = name
+        result['quanta'] = quanta
+        results.append(result)
+
+    for result in results:
+        predictions = result.pop('predictions')
+        result['max_abs_error'] = float(np.abs(predictions - uncached['predictions']).max())
+        result['speedup'] = result['requests_per_sec'] / uncached['requests_per_sec']
+    return results
+
+
+BENCHMARKS = {
+    'train-step': train_step_benchmark,
+    'io-jitter': io_jitter_benchmark,
+    'precision': precision_benchmark,
+    'avro-read': avro_read_benchmark,
+    'codec': codec_benchmark,
+    'prediction-cache': prediction_cache_benchmark,
+}
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--benchmark',
+        type=str,
+        help='Benchmark to run. One of: {}'.format(', '.join(sorted(BENCHMARKS))),
+        default='train-step')
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        help='Batch size. Default: 102400',
+        default=102400)
+    parser.add_argument(
+        '--steps',
+        type=int,
+        help='Timed steps per configuration. Default: 20',
+        default=20)
+    parser.add_argument(
+        '--warmup-steps',
+        type=int,
+        help='Untimed steps run first to trace and compile. Default: 3',
+        default=3)
+    parser.add_argument(
+        '--grad-accum-steps',
+        type=int,
+        help='Micro-batches per step for the gradient accumulation configurations. Default: 4',
+        default=4)
+    parser.add_argument(
+        '--io-dir',
+        type=str,
+        help='Local directory io-jitter writes checkpoints and summaries to. Default: benchmark_io',
+        default='benchmark_io')
+    parser.add_argument(
+        '--io-every-steps',
+        type=int,
+        help='Steps between checkpoints in io-jitter. Default: 5',
+        default=5)
+    parser.add_argument(
+        '--avro-bucket',
+        type=str,
+        help='GCS bucket, or local directory, avro-read reads from. Default: gcp-cert-demo-1',
+        default='gcp-cert-demo-1')
+    parser.add_argument(
+        '--avro-prefix',
+        type=str,
+        help='Path prefix of the Avro data avro-read reads. Default: data/avro/1_pct',
+        default='data/avro/1_pct')
+    parser.add_argument(
+        '--avro-endpoint',
+        type=str,
+        help='API endpoint of a fake GCS server avro-read reads from',
+        default='')
+    parser.add_argument(
+        '--partition',
+        type=str,
+        help='Partition avro-read reads. Default: train',
+        default='train')
+    parser.add_argument(
+        '--download-threads',
+        type=int,
+        help='Concurrent range downloads of the ranged avro-read configuration. Default: 8',
+        default=8)
+    parser.add_argument(
+        '--download-range-mb',
+        type=float,
+        help='Range size of the ranged avro-read configuration in MB. Default: 8',
+        default=8)
+    parser.add_argument(
+        '--read-ahead-mb',
+        type=float,
+        help='Read-ahead of the ranged avro-read configuration in MB. Default: 256',
+        default=256)
+    parser.add_argument(
+        '--read-objects',
+        type=int,
+        help='Objects decoded at once by the ranged avro-read configuration. Default: 4',
+        default=4)
+    parser.add_argument(
+        '--codec-rows',
+        type=int,
+        help='Synthetic rows written per codec by the codec benchmark. Default: 1000000',
+        default=1000000)
+    parser.add_argument(
+        '--codec-shard-mb',
+        type=float,
+        help='Approximate uncompressed shard size of the codec benchmark in MB. Default: 64',
+        default=64)
+    parser.add_argument(
+        '--cache-requests',
+        type=int,
+        help='Requests served by the prediction-cache benchmark. Default: 2000',
+        default=2000)
+    parser.add_argument(
+        '--cache-request-rows',
+        type=int,
+        help='Rows per prediction-cache request. Default: 32',
+        default=32)
+    parser.add_argument(
+        '--cache-distinct-rows',
+        type=int,
+        help='Synthetic rows the prediction-cache requests are drawn from. Default: 5000',
+        default=5000)
+    parser.add_argument(
+        '--cache-jitter',
+        type=float,
+        help='Standard deviation of the noise added to the continuous features of each request row. Default: 0.002',
+        default=0.002)
+    parser.add_argument(
+        '--cache-quanta',
+        type=str,
+        help='Quantum of the continuous features, optionally with per feature overrides like '
+             '`0.01,pickup_lat_std=0.002`. Default: 0.01',
+        default='0.01')
+    parser.add_argument(
+        '--cache-mb',
+        type=float,
+        help='Memory bound of the prediction cache in MB. Default: 64',
+        default=64)
+    parser.add_argument(
+        '--cache-ttl-secs',
+        type=float,
+        help='Seconds a cached prediction is served; 0 keeps it until evicted. Default: 0',
+        default=0.)
+    parser.add_argument(
+        '--output',
+        type=str,
+        help='Optional path to write results as JSON')
+    args, _ = parser.parse_known_args()
+
+    results = BENCHMARKS[args.benchmark](args)
+    for result in results:
+        logging.info(result)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,178 @@
+"""Local multi-process cluster for measuring how training scales with workers.
+
+Each worker count in --workers is trained by a chief, the remaining workers
+and --ps parameter servers, all as local `trainer.task` processes with a
+generated TF_CONFIG. The chief is declared as `master`, as AI Platform does,
+so `task.get_tf_config` maps it to `chief`. Arguments after `--` are passed
+to every task. Run from `mlp_trainer/`, e.g.:
+
+    python -m trainer.cluster --workers=1,2,4 -- --trainer=loop --epochs=1 --sample-fraction=0.01
+    python -m trainer.cluster --workers=1,2 --ps=1 -- --distribute=True --distribute-strategy=parameter-server
+    python -m trainer.cluster --workers=4 -- --trainer=loop --allreduce-pack --allreduce-dtype=bfloat16 --local-sgd-steps=8
+"""
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+from typing import Any, Dict, List
+
+# Flags the harness sets for each task unless they are passed after `--`
+THREAD_FLAGS = ['--intra-op-threads', '--data-threads', '--cycle-length']
+
+
+def cluster_spec(num_workers: int, num_ps: int, base_port: int) -> Dict[str, List[str]]:
+    """A master plus `num_workers` - 1 workers and `num_ps` parameter servers on localhost"""
+    addresses = ['localhost:{}'.format(base_port + i) for i in range(num_workers + num_ps)]
+    cluster = {'master': addresses[:1]}
+    if num_workers > 1:
+        cluster['worker'] = addresses[1:num_workers]
+    if num_ps > 0:
+        cluster['ps'] = addresses[num_workers:]
+    return cluster
+
+
+def tf_config(cluster: Dict[str, List[str]], task_type: str, index: int) -> str:
+    return json.dumps({
+        'cluster': cluster,
+        'task': {'type': task_type, 'index': index},
+    })
+
+
+def cpus_per_task(num_tasks: int) -> int:
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    return max(1, cpus // num_tasks)
+
+
+def run_config(num_workers: int, args, task_args: List[str]) -> Dict[str, Any]:
+    """Trains with `num_workers` training tasks and returns their combined throughput"""
+    run_dir = os.path.join(args.output_dir, 'workers-{}'.format(num_workers))
+    throughput_dir = os.path.join(run_dir, 'throughput')
+    os.makedirs(run_dir, exist_ok=True)
+    for name in os.listdir(throughput_dir) if os.path.isdir(throughput_dir) else []:
+        os.remove(os.path.join(throughput_dir, name))
+
+    cluster = cluster_spec(num_workers, args.ps, args.base_port)
+    command = [
+        sys.executable, '-m', 'trainer.task',
+        '--task=train',
+        '--num-workers={}'.format(num_workers),
+        '--job-dir={}'.format(os.path.join(run_dir, 'job')),
+        '--no-generated-job-path',
+        '--throughput-dir={}'.format(throughput_dir),
+    ]
+    threads = cpus_per_task(num_workers + args.ps)
+    for flag in THREAD_FLAGS:
+        if not any(arg.startswith(flag) for arg in task_args):
+            command.append('{}={}'.format(flag, threads))
+    command += task_args
+
+    processes = {}
+    for task_type, addresses in cluster.items():
+        for index in range(len(addresses)):
+            name = '{}-{}'.format(task_type, index)
+            env = dict(os.environ)
+            env['TF_CONFIG'] = tf_config(cluster, task_type, index)
+            log = open(os.path.join(run_dir, '{}.log'.format(name)), 'w')
+            processes[name] = (subprocess.Popen(command, env=env, stdout=log, stderr=subprocess.STDOUT), log)
+    logging.info("Started %d tasks for %d workers: %s", len(processes), num_workers, sorted(processes))
+
+    failed = []
+    for name, (process, log) in processes.items():
+        if name.startswith('ps-'):
+            continue
+        if process.wait(timeout=args.timeout) != 0:
+            failed.append(name)
+    # Parameter servers serve until they are stopped
+    for name, (process, log) in processes.items():
+        if process.poll() is None:
+            process.terminate()
+            process.wait()
+        log.close()
+    if failed:
+        raise RuntimeError("Tasks {} failed; see the logs in {}".format(failed, run_dir))
+
+    examples = 0
+    seconds = 0.0
+    train_loss = None
+    for name in os.listdir(throughput_dir):
+        with open(os.path.join(throughput_dir, name)) as f:
+            task = json.load(f)
+        # Each task reports only the examples its own replicas trained on
+        examples += task['examples']
+        seconds = max(seconds, task['seconds'])
+        if name.startswith('chief-'):
+            train_loss = task.get('train_loss')
+
+    return {
+        'workers': num_workers,
+        'ps': args.ps,
+        'threads_per_task': threads,
+        'examples': examples,
+        'seconds': seconds,
+        'examples_per_sec': examples / seconds if seconds > 0 else 0.0,
+        # Last epoch loss of the chief, to weigh throughput against convergence
+        'train_loss': train_loss,
+    }
+
+
+def add_scaling_efficiency(results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Per-worker throughput relative to the first (smallest) configuration"""
+    baseline = results[0]['examples_per_sec'] / results[0]['workers']
+    for result in results:
+        result['scaling_efficiency'] = result['examples_per_sec'] / (result['workers'] * baseline) if baseline > 0 else 0.0
+    return results
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
+
+    argv = sys.argv[1:]
+    task_args = []
+    if '--' in argv:
+        task_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--workers',
+        type=str,
+        help='Comma separated training task counts (chief included) to run. Default: 1,2,4',
+        default='1,2,4')
+    parser.add_argument(
+        '--ps',
+        type=int,
+        help='Parameter servers to start for each run. Default: 0',
+        default=0)
+    parser.add_argument(
+        '--base-port',
+        type=int,
+        help='First localhost port of the cluster. Default: 23456',
+        default=23456)
+    parser.add_argument(
+        '--output-dir',
+        type=str,
+        help='Directory for job directories, task logs and throughput files. Default: cluster_runs',
+        default='cluster_runs')
+    parser.add_argument(
+        '--timeout',
+        type=int,
+        help='Seconds to wait for each run. Default: 3600',
+        default=3600)
+    parser.add_argument(
+        '--output',
+        type=str,
+        help='Optional path to write results as JSON')
+    args = parser.parse_args(argv)
+
+    results = []
+    for num_workers in [int(n) for n in args.workers.split(',') if n]:
+        results.append(run_config(num_workers, args, task_args))
+    results = add_scaling_efficiency(results)
+    for result in results:
+        logging.info(result)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -1,31 +1,157 @@
+import hashlib
 import io
 import math
-from typing import Iterator, List, Tuple
+import re
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
-from google.cloud import storage
-from fastavro import reader
+from fastavro import reader, block_reader
 import tensorflow as tf
 
+import trainer.profiling as profiling
+from trainer.data import downsampling as downsampling
 from trainer.data import features as features
+from trainer.data import manifest as manifest
+from trainer.data import object_store as object_store
 
-client = storage.Client()
+# Options of the object readers, set from the task parameters by configure()
+reader_options = {
+    'endpoint': None,
+    'threads': 8,
+    'range_bytes': 8 << 20,
+    'read_ahead_bytes': 256 << 20,
+}
+
+_readers = {}
+
+# --shard-filter conditions, set by configure()
+shard_filter = []
+
+# Manifests by (bucket, prefix); None when the prefix has none
+_manifests = {}
+
+# First pipeline.py run whose train shards are new, and the fraction of older
+# train shards replayed with them; set from --new-data-since and --replay-fraction
+new_data_run = None
+replay_fraction = 0.
+
+# pipeline.py names the shards of incremental runs `{partition}-run{N}-...`
+RUN_PATTERN = re.compile(r'-run(\d+)-')
+
+
+def configure(params: Dict[str, Any]):
+    """Applies --avro-endpoint, --download-threads, --download-range-mb, --read-ahead-mb, --shard-filter,
+    --new-data-since and --replay-fraction"""
+    global shard_filter, new_data_run, replay_fraction
+    shard_filter = manifest.parse_filter(params.get('shard_filter', ''))
+    new_data_run = None
+    replay_fraction = params.get('replay_fraction', 0.)
+    if params.get('new_data_since') and params.get('data_source') == 'avro':
+        if not params['new_data_since'].isdigit():
+            raise ValueError("--new-data-since of Avro data is a pipeline.py run number, got {}".format(
+                params['new_data_since']))
+        new_data_run = int(params['new_data_since'])
+    options = {
+        'endpoint': params.get('avro_endpoint') or None,
+        'threads': params.get('download_threads', reader_options['threads']),
+        'range_bytes': int(params.get('download_range_mb', reader_options['range_bytes'] >> 20) * (1 << 20)),
+        'read_ahead_bytes': int(params.get('read_ahead_mb', reader_options['read_ahead_bytes'] >> 20) * (1 << 20)),
+    }
+    if options != reader_options:
+        reader_options.update(options)
+        _readers.clear()
+        _manifests.clear()
+
+
+def get_object_reader(bucket_name: str) -> object_store.ObjectReader:
+    """One reader, and so one download pool and read-ahead budget, per bucket"""
+    if bucket_name not in _readers:
+        _readers[bucket_name] = object_store.ObjectReader(
+            object_store.get_store(bucket_name, reader_options['endpoint']),
+            threads=reader_options['threads'],
+            range_bytes=reader_options['range_bytes'],
+            read_ahead_bytes=reader_options['read_ahead_bytes'],
+        )
+    return _readers[bucket_name]
+
+
+def get_manifest(bucket_name: str, prefix: str) -> Optional[Dict[str, Any]]:
+    """The manifest pipeline.py wrote under `prefix`, or None for data written without one"""
+    key = (bucket_name, prefix)
+    if key not in _manifests:
+        store = get_object_reader(bucket_name).store
+        name = "{}/{}".format(prefix, manifest.MANIFEST_FILE)
+        _manifests[key] = None
+        if store.exists(name):
+            _manifests[key] = manifest.from_json(store.read_range(name, 0, store.size(name)).decode('utf-8'))
+    return _manifests[key]
+
+
+def object_run(obj_name: str) -> int:
+    """The pipeline.py run that wrote an object; 0 for the first run, which has no run suffix"""
+    match = RUN_PATTERN.search(obj_name.rsplit('/', 1)[-1])
+    return int(match.group(1)) if match else 0
+
+
+def keep_object(obj_name: str, partition: str) -> bool:
+    """With --new-data-since, train objects of later runs and a deterministic --replay-fraction of the others"""
+    if partition != 'train' or new_data_run is None or object_run(obj_name) >= new_data_run:
+        return True
+    digest = hashlib.md5('replay:{}'.format(obj_name).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') < replay_fraction * (1 << 64)
+
+
+def manifest_shards(bucket_name: str, prefix: str, partition: str) -> Optional[List[Dict[str, Any]]]:
+    """Shards of `partition` passing --shard-filter and --new-data-since, or None without a manifest"""
+    data_manifest = get_manifest(bucket_name, prefix)
+    if data_manifest is None:
+        if shard_filter:
+            tf.get_logger().warning("No manifest under {}; --shard-filter is ignored".format(prefix))
+        return None
+    return [
+        shard for shard in manifest.shards(data_manifest, partition, shard_filter)
+        if keep_object(shard['path'], partition)
+    ]
+
+
+def list_objects(bucket_name: str, prefix: str, partition: str) -> Iterator[str]:
+    shards = manifest_shards(bucket_name, prefix, partition)
+    if shards is not None:
+        for shard in shards:
+            yield "{}/{}".format(prefix, shard['path'])
+        return
+    for obj_name in get_object_reader(bucket_name).list("{}/{}".format(prefix, partition)):
+        if obj_name.endswith('.avro') and keep_object(obj_name, partition):
+            yield obj_name
 
 
-@tf.function
 def list_blobs(bucket_name: str, prefix: str, partition: str) -> List[str]:
+    return list(list_objects(bucket_name, prefix, partition))
 
-    obj_names = []
 
-    for blob in client.list_blobs(
-        bucket_name, 
-        prefix="{}/{}".format(prefix, partition)
-    ):
-        obj_names.append(tf.constant(blob.name))
-    return obj_names
+def planned_objects(bucket_name: str, prefix: str, partition: str, num_workers: int,
+                    task_index: int) -> Optional[List[str]]:
+    """This worker's objects from the manifest, balanced by rows; None to list and shard by object count"""
+    shards = manifest_shards(bucket_name, prefix, partition)
+    if shards is None:
+        return None
+    return ["{}/{}".format(prefix, shard['path']) for shard in manifest.plan(shards, num_workers, task_index)]
 
 
-def download_blob(client: storage.Client, obj_name: str, bucket_name: str) -> bytes:
-    return storage.blob.Blob(obj_name, client.bucket(bucket_name)).download_as_string()
+def get_sample_count(bucket_name: str, prefix: str, partition: str, sample_fraction=1.,
+                     negative_rate=1.) -> Optional[int]:
+    """Rows of `partition` from the manifest, like bigquery.get_sample_count; None without a manifest"""
+    shards = manifest_shards(bucket_name, prefix, partition)
+    if shards is None:
+        return None
+    return manifest.row_count(shards, features.LABEL, sample_fraction, negative_rate)
+
+
+def generate_object_names(bucket_name_bytes: bytes, prefix_bytes: bytes, partition_bytes: bytes):
+    for obj_name in list_objects(
+            bucket_name_bytes.decode('utf-8'),
+            prefix_bytes.decode('utf-8'),
+            partition_bytes.decode('utf-8')):
+        yield obj_name
 
 
 def fetch_gcs_avro(blob: bytes):
@@ -34,86 +160,156 @@ def fetch_gcs_avro(blob: bytes):
         yield record
 
 
-def generate_blob(bucket_name_bytes: bytes, obj_name_bytes: bytes):
+# Set by the training loop when it checkpoints its input position. Rows are
+# then tagged with their object and record index, and reading resumes from it.
+input_position = None
+
+
+def keep_block(obj_name: str, block_index: int, sample_fraction: float) -> bool:
+    """Deterministic block-level sample: the same blocks are kept on every epoch and worker"""
+    digest = hashlib.md5('{}:{}'.format(obj_name, block_index).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') < sample_fraction * (1 << 64)
+
+
+def generate_blob(bucket_name_bytes: bytes, obj_name_bytes: bytes, with_position=False, sample_fraction=1.,
+                  negative_rate=1.):
     bucket_name = bucket_name_bytes.decode('utf-8')
     obj_name = obj_name_bytes.decode('utf-8')
-    tf.get_logger().debug("Generating rows from GCS object gs://{}/{}".format(bucket_name, obj_name))
-    blob_bytes = download_blob(
-        client,
-        obj_name,
-        bucket_name,
-    )
-    for row in fetch_gcs_avro(blob_bytes):
-        yield(
-            tuple(features_from_row(row))
-        )
+    offset = 0
+    skip = frozenset()
+    if with_position:
+        stream_index = input_position.stream_index(obj_name)
+        offset = input_position.start_offset(obj_name)
+        skip = input_position.skip(obj_name)
+    tf.get_logger().debug("Generating rows from GCS object gs://{}/{} at record {}".format(bucket_name, obj_name, offset))
+    # Blocks are decoded as their byte ranges arrive; closing the stream frees its read-ahead
+    with get_object_reader(bucket_name).open(obj_name) as blob_io:
+        record_index = 0
+        for block_index, block in enumerate(block_reader(blob_io, reader_schema=header_schema(blob_io))):
+            # Skip whole blocks before the resume offset or outside the sample without decoding them
+            if record_index + block.num_records <= offset:
+                record_index += block.num_records
+                continue
+            if sample_fraction < 1. and not keep_block(obj_name, block_index, sample_fraction):
+                if with_position:
+                    input_position.skip_rows(obj_name, range(max(record_index, offset), record_index + block.num_records))
+                record_index += block.num_records
+                continue
+            dropped = []
+            for row in block:
+                if record_index >= offset and record_index not in skip:
+                    values = features_from_row(row)
+                    if negative_rate >= 1. or downsampling.keep_row(values, negative_rate):
+                        if with_position:
+                            values.extend([stream_index, record_index])
+                        yield tuple(values)
+                    elif with_position:
+                        dropped.append(record_index)
+                record_index += 1
+            if dropped:
+                input_position.skip_rows(obj_name, dropped)
+
+
+def header_schema(blob_io: io.BufferedReader):
+    """Projected reader schema from the header in the object's first range; None decodes every column"""
+    try:
+        return projected_schema(block_reader(io.BytesIO(blob_io.raw.first_range())).writer_schema)
+    except (EOFError, ValueError):
+        # The header does not fit in one range
+        return None
+
+
+def projected_schema(writer_schema: dict) -> dict:
+    """Reader schema with only the label and selected features, so other columns are skipped rather than decoded"""
+    columns = features.columns()
+    schema = dict(writer_schema)
+    schema['fields'] = [field for field in writer_schema['fields'] if field['name'] in columns]
+    return schema
 
 
 def features_from_row(row: dict):
     feat_values = []
     for feat in features.defs():
         feat_values.append(row.get(feat.get('name')))
-    feat_values.append(row.get('cash'))
+    feat_values.append(row.get(features.LABEL))
     return feat_values
 
 
 @tf.function
 def get_data(bucket_name: str, prefix: str, partition: str, batch_size: int,
              epochs: int, chunk_size: int, cycle_length: int, num_workers: int,
-             task_index: int, map_function='keras') -> tf.data.Dataset:
+             task_index: int, map_function='keras', with_position=False,
+             sample_fraction=1., negative_rate=1., stage=None) -> tf.data.Dataset:
+    """Batches of `partition`; `stage` builds the pipeline only up to that --memory-profile stage"""
     if map_function == 'keras':
         map_fn = keras_map_fn
     elif map_function == 'estimator':
         map_fn = estimator_map_fn
-    
-    # blobs = list_blobs(bucket_name, prefix, partition)
 
-    # tf.get_logger().info("Starting to read from {} GCS objects".format(len(blobs)))
+    output_types = features.get_generator_output()
+    output_shapes = features.get_generator_output_shape()
+    if with_position:
+        # Elements become (features, label, [object, record])
+        map_fn = keras_position_map_fn
+        output_types += [tf.dtypes.int64, tf.dtypes.int64]
+        output_shapes += [tf.TensorShape([]), tf.TensorShape([])]
 
-    # dataset = tf.data.Dataset.from_tensor_slices(
-    #     blobs
-    # )
+    tf.get_logger().info("Reading GCS objects under gs://{}/{}/{}".format(bucket_name, prefix, partition))
 
-    dataset = tf.data.Dataset.list_files(
-        "gs://{}/{}/{}/*.avro".format(bucket_name, prefix, partition)
-    ).map(
-        lambda file_path:
-        tf.io.read_file(file_path)
-    )
+    planned = planned_objects(bucket_name, prefix, partition, num_workers, task_index)
+    if planned is not None:
+        tf.get_logger().info("Reading {} objects of {} from the manifest".format(len(planned), partition))
+        obj_names = tf.data.Dataset.from_tensor_slices(tf.constant(planned, dtype=tf.string))
+    else:
+        # Objects are listed in the background and read while later ones are still being listed
+        obj_names = tf.data.Dataset.from_generator(
+            generate_object_names,
+            tf.string,
+            output_shapes=tf.TensorShape([]),
+            args=(bucket_name, prefix, partition)
+        ).shard(
+            num_workers,
+            task_index
+        )
+
+    def object_rows(obj_name):
+        rows_ds = tf.data.Dataset.from_generator(
+            generate_blob,
+            tuple(output_types),
+            output_shapes=tuple(output_shapes),
+            args=(bucket_name, obj_name, with_position, sample_fraction, negative_rate)
+        )
+        if profiling.stage_reached(stage, 'interleave'):
+            rows_ds = rows_ds.prefetch(
+                buffer_size=batch_size*5
+            )
+        if profiling.stage_reached(stage, 'shuffle'):
+            rows_ds = rows_ds.shuffle(
+                buffer_size=batch_size*5
+            )
+        return rows_ds
 
+    if stage == 'reader':
+        # One generator, without the interleave and its buffers
+        return obj_names.take(1).flat_map(object_rows)
 
-    
-    # .shard(
-    #         num_workers,
-    #         task_index
-    # ).interleave(
-    #     lambda obj_name:
-    #     print(obj_name),
-    #     # tf.data.Dataset.from_generator(
-    #     #     generate_blob,
-    #     #     tuple(features.get_generator_output()),
-    #     #     output_shapes=tuple(features.get_generator_output_shape()),
-    #     #     args=(bucket_name, obj_name)
-    #     # ).shard(
-    #     #     num_workers,
-    #     #     task_index
-    #     # ).prefetch(
-    #     #     buffer_size=batch_size*5
-    #     # ).shuffle(
-    #     #     buffer_size=batch_size*5
-    #     # ),
-    #     num_parallel_calls=tf.data.experimental.AUTOTUNE,
-    #     cycle_length=cycle_length,
-    #     # block_length=batch_size,
-    # ).interleave(
-    #     map_fn,
-    #     num_parallel_calls=tf.data.experimental.AUTOTUNE,
-    #     cycle_length=cycle_length
-    # ).batch(
-    #     batch_size
-    # ).prefetch(
-    #     math.ceil((batch_size*5) / batch_size)
-    # ).repeat(epochs)
+    dataset = obj_names.interleave(
+        object_rows,
+        num_parallel_calls=tf.data.experimental.AUTOTUNE,
+        cycle_length=cycle_length,
+    ).interleave(
+        map_fn,
+        num_parallel_calls=tf.data.experimental.AUTOTUNE,
+        cycle_length=cycle_length
+    )
+    if not profiling.stage_reached(stage, 'batch'):
+        return dataset
+
+    dataset = dataset.batch(
+        batch_size
+    ).prefetch(
+        math.ceil((batch_size*5) / batch_size)
+    ).repeat(epochs)
 
     return dataset
 
@@ -149,3 +345,21 @@ def keras_map_fn(*args):
             tf.convert_to_tensor([args[len(args)-1]])
         )
     )
+
+
+@tf.function
+def keras_position_map_fn(*args):
+    # Same as keras_map_fn, with the object index and record index after the label
+    feat_cols = []
+    i = 0
+    while i < len(args) - 3:
+        feat_cols.append(args[i])
+        i += 1
+
+    return tf.data.Dataset.from_tensors(
+        (
+            tf.convert_to_tensor(tuple(feat_cols), dtype=tf.dtypes.float32),
+            tf.convert_to_tensor([args[len(args)-3]]),
+            tf.stack([args[len(args)-2], args[len(args)-1]])
+        )
+    )
@@ -6,6 +6,8 @@ from google.cloud import bigquery_storage_v1beta1
 from google.cloud import bigquery
 from google.api_core import retry
 
+from trainer.data import features as features
+
 client = bigquery_storage_v1beta1.BigQueryStorageClient()
 
 
@@ -21,40 +23,67 @@ def get_table_ref(table_id: str) -> bigquery_storage_v1beta1.types.TableReferenc
     return table_ref
 
 
-def get_read_options(partition_name=None):
-    """Selects the columns from the  table. Ordering here doesn't matter.
+# Rows are sampled by a hash of this column so the sample is the same on every read
+SAMPLE_KEY = "unique_key"
+
+# Hash buckets the sample fraction is expressed in
+SAMPLE_BUCKETS = 1000000
+
+
+def sample_restriction(sample_fraction: float) -> str:
+    """Deterministic predicate keeping about `sample_fraction` of the rows"""
+    return "ABS(MOD(FARM_FINGERPRINT({}), {})) < {}".format(
+        SAMPLE_KEY,
+        SAMPLE_BUCKETS,
+        int(round(sample_fraction * SAMPLE_BUCKETS))
+    )
+
+
+# Column --new-data-since is compared with
+NEW_DATA_KEY = "start_time"
+
+# Predicate on the train partition for --new-data-since and --replay-fraction, set by configure()
+train_restriction = ""
+
+
+def new_data_restriction(since: str, replay_fraction=0.) -> str:
+    """Rows from `since` on, and a deterministic `replay_fraction` sample of the older rows"""
+    restriction = "{} >= CAST('{}' AS TIMESTAMP)".format(NEW_DATA_KEY, since)
+    if replay_fraction > 0.:
+        # Salted so the replay sample is independent of the --sample-fraction one
+        restriction = "({} OR ABS(MOD(FARM_FINGERPRINT(CONCAT('replay', {})), {})) < {})".format(
+            restriction,
+            SAMPLE_KEY,
+            SAMPLE_BUCKETS,
+            int(round(replay_fraction * SAMPLE_BUCKETS))
+        )
+    return restriction
+
+
+def configure(params):
+    """Applies --new-data-since and --replay-fraction"""
+    global train_restriction
+    train_restriction = ""
+    if params.get('new_data_since') and params.get('data_source') != 'avro':
+        train_restriction = new_data_restriction(params['new_data_since'], params.get('replay_fraction', 0.))
+
+
+def get_read_options(partition_name=None, sample_fraction=1.):
+    """Selects the label and the selected features from the table. Ordering here doesn't matter.
     Bigquery will return columns in the order they appear in the schema."""
     read_options = bigquery_storage_v1beta1.types.TableReadOptions()
-    read_options.selected_fields.append("cash")
-    read_options.selected_fields.append("year_norm")
-    read_options.selected_fields.append("start_time_norm_midnight")
-    read_options.selected_fields.append("start_time_norm_noon")
-    read_options.selected_fields.append("pickup_lat_std")
-    read_options.selected_fields.append("pickup_long_std")
-    read_options.selected_fields.append("pickup_lat_centered")
-    read_options.selected_fields.append("pickup_long_centered")
-    read_options.selected_fields.append("day_of_week_MONDAY")
-    read_options.selected_fields.append("day_of_week_TUESDAY")
-    read_options.selected_fields.append("day_of_week_WEDNESDAY")
-    read_options.selected_fields.append("day_of_week_THURSDAY")
-    read_options.selected_fields.append("day_of_week_FRIDAY")
-    read_options.selected_fields.append("day_of_week_SATURDAY")
-    read_options.selected_fields.append("day_of_week_SUNDAY")
-    read_options.selected_fields.append("month_JANUARY")
-    read_options.selected_fields.append("month_FEBRUARY")
-    read_options.selected_fields.append("month_MARCH")
-    read_options.selected_fields.append("month_APRIL")
-    read_options.selected_fields.append("month_MAY")
-    read_options.selected_fields.append("month_JUNE")
-    read_options.selected_fields.append("month_JULY")
-    read_options.selected_fields.append("month_AUGUST")
-    read_options.selected_fields.append("month_SEPTEMBER")
-    read_options.selected_fields.append("month_OCTOBER")
-    read_options.selected_fields.append("month_NOVEMBER")
-    read_options.selected_fields.append("month_DECEMBER")
+    for column in features.columns():
+        read_options.selected_fields.append(column)
 
+    restrictions = []
     if partition_name:
-        read_options.row_restriction = 'ml_partition = "{}"'.format(partition_name)    
+        restrictions.append('ml_partition = "{}"'.format(partition_name))
+    if sample_fraction < 1.:
+        restrictions.append(sample_restriction(sample_fraction))
+    if partition_name == 'train' and train_restriction:
+        restrictions.append(train_restriction)
+    if restrictions:
+        read_options.row_restriction = " AND ".join(restrictions)
     return read_options
 
 
@@ -83,9 +112,11 @@ def get_session(client: bigquery_storage_v1beta1.BigQueryStorageClient,
 
 
 def get_reader(client: bigquery_storage_v1beta1.BigQueryStorageClient,
-               stream: bigquery_storage_v1beta1.types.Stream) -> bigquery_storage_v1beta1.reader.ReadRowsStream:
+               stream: bigquery_storage_v1beta1.types.Stream,
+               offset=0) -> bigquery_storage_v1beta1.reader.ReadRowsStream:
+    """Reads a stream starting at row `offset`"""
     return client.read_rows(
-        bigquery_storage_v1beta1.types.StreamPosition(stream=stream), 
+        bigquery_storage_v1beta1.types.StreamPosition(stream=stream, offset=offset), 
         timeout=172800,
         retry=retry.Retry(
             predicate=retry.if_transient_error
@@ -93,11 +124,11 @@ def get_reader(client: bigquery_storage_v1beta1.BigQueryStorageClient,
     )
 
 
-def get_data_partition_sharded(table_id: str, partition_name: str, shards=1) -> Tuple[bigquery_storage_v1beta1.types.ReadSession, List[bigquery_storage_v1beta1.types.ReadSession]]:
+def get_data_partition_sharded(table_id: str, partition_name: str, shards=1, sample_fraction=1.) -> Tuple[bigquery_storage_v1beta1.types.ReadSession, List[bigquery_storage_v1beta1.types.ReadSession]]:
     tableref = get_table_ref(table_id)
     session = get_session(client,
                           tableref,
-                          get_read_options(partition_name),
+                          get_read_options(partition_name, sample_fraction),
                           "projects/{}".format(tableref.project_id),
                           shards)
     return session
@@ -111,18 +142,31 @@ def get_reader_for_stream(session_pickled: bytes, stream_name_bytes: bytes):
             return get_reader(client, stream)
 
 
-def get_sample_count(table_id, partition):
+def get_sample_count(table_id, partition, sample_fraction=1., negative_rate=1.):
     """
 
     :param table_id:
     :param partition:
+    :param sample_fraction: count only the rows --sample-fraction keeps
+    :param negative_rate: expected count after keeping this fraction of the negative (non-cash) rows
     :return:
     """
+    restriction = ""
+    if sample_fraction < 1.:
+        restriction = " AND " + sample_restriction(sample_fraction)
+    if partition == 'train' and train_restriction:
+        restriction += " AND " + train_restriction
+    count = "COUNT(*)"
+    if negative_rate < 1.:
+        count = "CAST(CEIL(COUNTIF({label} = 1) + {rate} * COUNTIF({label} != 1)) AS INT64)".format(
+            label=features.LABEL,
+            rate=negative_rate
+        )
     client = bigquery.Client()
     query_job = client.query('''
-        SELECT COUNT(*) FROM `ml-sandbox-1-191918.chicagotaxi.{}` 
-        WHERE ml_partition='{}';
-        '''.format(table_id, partition))
+        SELECT {} FROM `ml-sandbox-1-191918.chicagotaxi.{}` 
+        WHERE ml_partition='{}'{};
+        '''.format(count, table_id, partition, restriction))
 
     results = query_job.result()
 
@@ -5,27 +5,60 @@ from typing import Tuple, Iterator
 
 import tensorflow as tf
 
+import trainer.profiling as profiling
 from trainer.data import bigquery as data
+from trainer.data import downsampling as downsampling
 from trainer.data import features as features
 
 
-def bq_stream_generator(table_id: bytes, partition: bytes):
-    session = data.get_data_partition_sharded(table_id.decode("utf-8"), partition.decode("utf-8"), shards=100)
-    encoded_session = codecs.encode(pickle.dumps(session), "base64")
+# Set by the training loop when it checkpoints its input position. Rows are
+# then tagged with their stream and offset, and reading resumes from it.
+input_position = None
+
+# Size of the last pickled read session; every stream element carries a copy
+session_bytes = 0
+
+
+def bq_stream_generator(table_id: bytes, partition: bytes, sample_fraction: float, with_position=False):
+    """Streams of a read session on `partition`. Only the pass recording its position stores or resumes a session"""
+    global session_bytes
+    if with_position and input_position.session is not None:
+        # Resume on the read session the saved offsets refer to
+        encoded_session = input_position.session
+        session = pickle.loads(codecs.decode(encoded_session, "base64"))
+    else:
+        session = data.get_data_partition_sharded(
+            table_id.decode("utf-8"),
+            partition.decode("utf-8"),
+            shards=100,
+            sample_fraction=sample_fraction
+        )
+        encoded_session = codecs.encode(pickle.dumps(session), "base64")
+        if with_position:
+            input_position.session = encoded_session
+    session_bytes = len(encoded_session)
     for stream in session.streams:
         tf.get_logger().info("Adding BigQuery read session %s to dataset" % (stream.name))
         yield(tf.constant(encoded_session), tf.constant(stream.name))
 
 
-def get_reader_for_stream(session_pickled: bytes, stream_name_bytes: bytes):
+def get_reader_for_stream(session_pickled: bytes, stream_name_bytes: bytes, with_position=False, negative_rate=1.):
     session = pickle.loads(codecs.decode(session_pickled, "base64"))
     stream_name = stream_name_bytes.decode("utf-8")
     for stream in session.streams:
         if stream.name == stream_name:
-            tf.get_logger().info("Reading from BigQuery read session %s" % (stream.name))
-            reader = data.get_reader(data.client, stream)
+            offset = 0
+            skip = frozenset()
+            if with_position:
+                stream_index = input_position.stream_index(stream_name)
+                offset = input_position.start_offset(stream_name)
+                skip = input_position.skip(stream_name)
+            tf.get_logger().info("Reading from BigQuery read session %s at offset %d" % (stream.name, offset))
+            reader = data.get_reader(data.client, stream, offset)
             rows = reader.rows(session)
-            for row in rows:
+            for row_offset, row in enumerate(rows, start=offset):
+                if row_offset in skip:
+                    continue
                 # features_dict = {}
                 # for feat in features.defs():
                 #     features_dict[feat.get("name")] = tf.constant(row.get(feat.get("name")))
@@ -35,7 +68,13 @@ def get_reader_for_stream(session_pickled: bytes, stream_name_bytes: bytes):
                 for feat in features.defs():
                     cols.append(row.get(feat.get("name")))
                 # add label
-                cols.append(row.get("cash"))
+                cols.append(row.get(features.LABEL))
+                if negative_rate < 1. and not downsampling.keep_row(cols, negative_rate):
+                    if with_position:
+                        input_position.skip_rows(stream_name, [row_offset])
+                    continue
+                if with_position:
+                    cols.extend([stream_index, row_offset])
 
                 yield tuple(cols)
 
@@ -43,12 +82,22 @@ def get_reader_for_stream(session_pickled: bytes, stream_name_bytes: bytes):
 @tf.function
 def get_data(table_id: str, partition: str, batch_size: int,
              epochs: int, chunk_size: int, cycle_length: int,
-             num_workers: int, task_index: int, map_function='keras') -> tf.data.Dataset:
+             num_workers: int, task_index: int, map_function='keras',
+             with_position=False, sample_fraction=1., negative_rate=1., stage=None) -> tf.data.Dataset:
+    """Batches of `partition`; `stage` builds the pipeline only up to that --memory-profile stage"""
     if map_function == 'keras':
         map_fn = keras_map_fn
     elif map_function == 'estimator':
         map_fn = estimator_map_fn
 
+    output_types = features.get_generator_output()
+    output_shapes = features.get_generator_output_shape()
+    if with_position:
+        # Elements become (features, label, [stream, offset])
+        map_fn = keras_position_map_fn
+        output_types += [tf.dtypes.int64, tf.dtypes.int64]
+        output_shapes += [tf.TensorShape([]), tf.TensorShape([])]
+
     # session = data.get_data_partition_sharded(table_id, partition, shards=100)
     # encoded_session = codecs.encode(pickle.dumps(session), "base64")
     # streams = []
@@ -68,27 +117,42 @@ def get_data(table_id: str, partition: str, batch_size: int,
         bq_stream_generator,
         (tf.string, tf.string),
         output_shapes=(tf.TensorShape([]), tf.TensorShape([])),
-        args=(table_id, partition)
+        args=(table_id, partition, sample_fraction, with_position)
     ).shard(
         num_workers,
         task_index
     )
     
-    elements_ds = streams_ds.interleave(
-        lambda session, stream:
-        tf.data.Dataset.from_generator(
+    def stream_rows(session, stream):
+        rows_ds = tf.data.Dataset.from_generator(
             get_reader_for_stream,
-            tuple(features.get_generator_output()),
-            output_shapes=tuple(features.get_generator_output_shape()),
-            args=(session, stream)
-        ).shard(
-            num_workers,
-            task_index
-        ).prefetch(
-            buffer_size=batch_size*5
-        ).shuffle(
-            buffer_size=batch_size*5
-        ),
+            tuple(output_types),
+            output_shapes=tuple(output_shapes),
+            args=(session, stream, with_position, negative_rate)
+        )
+        if not with_position:
+            # Row offsets must stay contiguous per stream when positions are
+            # tracked; streams are already sharded across workers above.
+            rows_ds = rows_ds.shard(
+                num_workers,
+                task_index
+            )
+        if profiling.stage_reached(stage, 'interleave'):
+            rows_ds = rows_ds.prefetch(
+                buffer_size=batch_size*5
+            )
+        if profiling.stage_reached(stage, 'shuffle'):
+            rows_ds = rows_ds.shuffle(
+                buffer_size=batch_size*5
+            )
+        return rows_ds
+
+    if stage == 'reader':
+        # One stream, without the interleave and its buffers
+        return streams_ds.take(1).flat_map(stream_rows)
+
+    elements_ds = streams_ds.interleave(
+        stream_rows,
         num_parallel_calls=tf.data.experimental.AUTOTUNE,
         cycle_length=cycle_length,
         # block_length=batch_size,
@@ -96,7 +160,11 @@ def get_data(table_id: str, partition: str, batch_size: int,
         map_fn,
         num_parallel_calls=tf.data.experimental.AUTOTUNE,
         cycle_length=cycle_length
-    ).batch(
+    )
+    if not profiling.stage_reached(stage, 'batch'):
+        return elements_ds
+
+    elements_ds = elements_ds.batch(
         batch_size
     ).prefetch(
         math.ceil((batch_size*5) / batch_size)
@@ -138,3 +206,21 @@ def keras_map_fn(*args):
             tf.convert_to_tensor([args[len(args)-1]])
         )
     )
+
+
+@tf.function
+def keras_position_map_fn(*args):
+    # Same as keras_map_fn, with the stream index and offset after the label
+    feat_cols = []
+    i = 0
+    while i < len(args) - 3:
+        feat_cols.append(args[i])
+        i += 1
+
+    return tf.data.Dataset.from_tensors(
+        (
+            tf.convert_to_tensor(tuple(feat_cols), dtype=tf.dtypes.float32),
+            tf.convert_to_tensor([args[len(args)-3]]),
+            tf.stack([args[len(args)-2], args[len(args)-1]])
+        )
+    )
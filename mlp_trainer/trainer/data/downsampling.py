@@ -0,0 +1,33 @@
+import hashlib
+from typing import Sequence
+
+import tensorflow as tf
+
+# How a model trained on downsampled rows is corrected back to the true label rate:
+# `loss` weights the kept negatives by 1 / rate in the loss and train metrics,
+# `export` trains unweighted and corrects the predicted probabilities instead.
+CORRECTIONS = ['loss', 'export']
+
+
+def keep_row(values: Sequence, negative_rate: float) -> bool:
+    """Keeps every positive (cash) row and `negative_rate` of the negatives.
+
+    `values` are a row's features followed by its label. Negatives are kept
+    by a hash of their values, so every epoch, restart, worker and reader
+    keeps the same rows for the same --features.
+    """
+    if values[-1] > .5:
+        return True
+    digest = hashlib.md5(repr(tuple(values)).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') < float(negative_rate) * (1 << 64)
+
+
+def weights(labels, negative_rate: float):
+    """Importance weight of each example: 1 for positives, 1 / negative_rate for negatives"""
+    labels = tf.reshape(tf.cast(labels, tf.float32), [-1])
+    return labels + (1. - labels) / negative_rate
+
+
+def correct_probability(probabilities, negative_rate: float):
+    """Maps a probability learned on downsampled negatives back to the full data rate"""
+    return probabilities / (probabilities + (1. - probabilities) / negative_rate)
@@ -0,0 +1,438 @@
+"""Local port of the dataflow-etl feature engineering, vectorized with pandas.
+
+Raw Chicago taxi trips (CSV or newline delimited JSON files, e.g. a
+BigQuery export of `bigquery-public-data.chicago_taxi_trips.taxi_trips`)
+are encoded into the rows the Dataflow job writes to BigQuery, in two
+streaming passes over the files on a process pool:
+
+1. Every file is read in `--chunk-rows` chunks and the filtered trips are
+   reduced to mergeable statistics: pickup latitude and longitude count,
+   sum, sum of squares, min and max (StdFn/AverageFn), min and max year and,
+   with --hot-encode-company, the cleaned company names.
+2. Every file is read again and each chunk is filtered, encoded with the
+   merged statistics (FilterRowsFn, CenteredLatLongFn, TripTimesFn,
+   CodeCashFn, TripMilesFn, SetMLPartitionsFn, EncodeCompanyFn,
+   TransformLatLongFn, ScaleYearFn, SampleDataFn) and appended to one
+   output file per input file.
+
+The output directory also gets a `_manifest.json` with each file's rows per
+ml_partition and column statistics, and the constants the features were
+encoded with (`encoding`). JSON output can be fed to
+`pipeline.py --input_path`, which sizes its shards from the manifest. Run
+from `mlp_trainer/`:
+
+    python -m trainer.data.etl --input='/data/raw/trips-*.csv' --output-dir=/data/encoded
+"""
+import argparse
+import glob
+import logging
+import math
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterator, List
+
+import numpy as np
+import pandas as pd
+
+from trainer.data import manifest as manifest
+
+DAYS_OF_WEEK_PREFIX = 'day_of_week_'
+COMPANY_PREFIX = 'company_'
+
+# Monday first, as pandas numbers them
+DAYS_OF_WEEK = [DAYS_OF_WEEK_PREFIX + day for day in [
+    'MONDAY', 'TUESDAY', 'WEDNESDAY', 'THURSDAY', 'FRIDAY', 'SATURDAY', 'SUNDAY']]
+
+MONTHS = ['month_' + month for month in [
+    'JANUARY', 'FEBRUARY', 'MARCH', 'APRIL', 'MAY', 'JUNE',
+    'JULY', 'AUGUST', 'SEPTEMBER', 'OCTOBER', 'NOVEMBER', 'DECEMBER']]
+
+PAYMENT_TYPES = ['Cash', 'Credit Card', 'Dispute', 'Mobile']
+
+# Raw trip columns the transforms read
+RAW_COLUMNS = [
+    'unique_key', 'trip_start_timestamp', 'trip_seconds', 'trip_miles', 'fare',
+    'payment_type', 'company', 'pickup_latitude', 'pickup_longitude',
+]
+
+# Output columns ahead of the one-hot encodings, as OutputTableRowsFn sets them
+TABLE_COLUMNS = [
+    'unique_key', 'cash', 'year', 'year_norm', 'start_time', 'start_time_norm_midnight',
+    'start_time_norm_noon', 'trip_miles', 'company', 'ml_partition', 'distance_from_center',
+    'pickup_latitude', 'pickup_longitude', 'pickup_lat_centered', 'pickup_long_centered',
+    'pickup_lat_norm', 'pickup_long_norm', 'pickup_lat_std', 'pickup_long_std',
+]
+
+OUTPUT_FORMATS = ['json', 'csv']
+
+# Seconds of 11:59:59 PM, the end of TripTimesFn's time scales
+MAX_DAY_SECONDS = 23 * 3600 + 59 * 60 + 59
+NOON_SECONDS = 12 * 3600
+
+
+def available_cpus() -> int:
+    return len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+
+
+def read_chunks(path: str, chunk_rows: int) -> Iterator[pd.DataFrame]:
+    """The raw trip columns of `path` in chunks of up to `chunk_rows` rows"""
+    if path.endswith('.json'):
+        for chunk in pd.read_json(path, lines=True, chunksize=chunk_rows):
+            yield chunk.reindex(columns=RAW_COLUMNS)
+    else:
+        yield from pd.read_csv(path, usecols=lambda column: column in RAW_COLUMNS, chunksize=chunk_rows)
+
+
+def start_times(values: pd.Series) -> pd.Series:
+    """UTC start times from BigQuery's epoch microseconds or timestamp strings"""
+    if pd.api.types.is_numeric_dtype(values):
+        return pd.to_datetime(values, unit='us', utc=True, errors='coerce')
+    return pd.to_datetime(values, utc=True, errors='coerce')
+
+
+def filter_rows(chunk: pd.DataFrame) -> pd.DataFrame:
+    """Trips FilterRowsFn keeps. Missing values count as empty or 0, as the BigQuery reader maps them"""
+    chunk = chunk.reindex(columns=RAW_COLUMNS)
+    start = start_times(chunk['trip_start_timestamp'])
+    keep = (
+        (chunk['company'].fillna('') != '')
+        & (chunk['trip_miles'].fillna(0) > 0)
+        & (chunk['trip_seconds'].fillna(0) > 0)
+        & (chunk['fare'].fillna(0) > 0)
+        & chunk['payment_type'].isin(PAYMENT_TYPES)
+        & start.notna()
+        & (start > pd.Timestamp(0, tz='UTC'))
+        & (chunk['pickup_latitude'].fillna(0) != 0)
+        & (chunk['pickup_longitude'].fillna(0) != 0)
+    )
+    trips = chunk[keep].copy()
+    trips['start'] = start[keep]
+    return trips
+
+
+def clean_company(companies: pd.Series) -> pd.Series:
+    """CleanForColumnName: whitespace to `_`, other non-word characters dropped, lower case"""
+    return (companies.fillna('')
+            .str.replace(r'\s', '_', regex=True)
+            .str.replace(r'[^A-Za-z0-9_]', '', regex=True)
+            .str.lower())
+
+
+def empty_stats() -> Dict[str, Any]:
+    stats = {'min_year': None, 'max_year': None, 'companies': set(), 'rows': 0}
+    for column in ['pickup_latitude', 'pickup_longitude']:
+        stats[column] = {'count': 0, 'sum': 0.0, 'sum_sq': 0.0, 'min': math.inf, 'max': -math.inf}
+    return stats
+
+
+def merge_stats(stats: Dict[str, Any], other: Dict[str, Any]) -> Dict[str, Any]:
+    """Combines the statistics of two sets of trips, like the Combine.globally accumulators"""
+    for column in ['pickup_latitude', 'pickup_longitude']:
+        accum, other_accum = stats[column], other[column]
+        accum['count'] += other_accum['count']
+        accum['sum'] += other_accum['sum']
+        accum['sum_sq'] += other_accum['sum_sq']
+        accum['min'] = min(accum['min'], other_accum['min'])
+        accum['max'] = max(accum['max'], other_accum['max'])
+    for key, pick in [('min_year', min), ('max_year', max)]:
+        values = [value for value in [stats[key], other[key]] if value is not None]
+        stats[key] = pick(values) if values else None
+    stats['companies'] |= other['companies']
+    stats['rows'] += other['rows']
+    return stats
+
+
+def chunk_stats(trips: pd.DataFrame, options: Dict[str, Any]) -> Dict[str, Any]:
+    stats = empty_stats()
+    if trips.empty:
+        return stats
+    for column in ['pickup_latitude', 'pickup_longitude']:
+        values = trips[column].to_numpy(dtype=np.float64)
+        stats[column] = {
+            'count': len(values),
+            'sum': float(values.sum()),
+            'sum_sq': float(np.square(values).sum()),
+            'min': float(values.min()),
+            'max': float(values.max()),
+        }
+    years = trips['start'].dt.year
+    stats['min_year'] = int(years.min())
+    stats['max_year'] = int(years.max())
+    if options['hot_encode_company']:
+        stats['companies'] = set(clean_company(trips['company']).unique())
+    stats['rows'] = len(trips)
+    return stats
+
+
+def file_stats(path: str, options: Dict[str, Any]) -> Dict[str, Any]:
+    """Pass 1 over one file"""
+    stats = empty_stats()
+    for chunk in read_chunks(path, options['chunk_rows']):
+        merge_stats(stats, chunk_stats(filter_rows(chunk), options))
+    return stats
+
+
+def finalize_stats(stats: Dict[str, Any]) -> Dict[str, Any]:
+    """Mean and population standard deviation (StdFn) and the company columns"""
+    for column in ['pickup_latitude', 'pickup_longitude']:
+        accum = stats[column]
+        mean = accum['sum'] / accum['count'] if accum['count'] else math.nan
+        variance = accum['sum_sq'] / accum['count'] - mean ** 2 if accum['count'] else math.nan
+        accum['mean'] = mean
+        accum['std'] = math.sqrt(max(variance, 0.0))
+    stats['company_columns'] = sorted(COMPANY_PREFIX + company for company in stats['companies'])
+    return stats
+
+
+def encoding(stats: Dict[str, Any], options: Dict[str, Any]) -> Dict[str, Any]:
+    """The constants encode() applies, to encode new requests the same way"""
+    return {
+        'pickup_latitude': {name: stats['pickup_latitude'][name] for name in ['mean', 'std', 'min', 'max']},
+        'pickup_longitude': {name: stats['pickup_longitude'][name] for name in ['mean', 'std', 'min', 'max']},
+        'map_center_lat': options['map_center_lat'],
+        'map_center_long': options['map_center_long'],
+        'min_year': stats['min_year'],
+        'max_year': stats['max_year'],
+    }
+
+
+def normalize_times(seconds: np.ndarray, hours: np.ndarray, minutes: np.ndarray,
+                    secs: np.ndarray) -> Dict[str, np.ndarray]:
+    """TripTimesFn.normalizeTime, to midnight (0 to 1) and to noon (-1 to 1)"""
+    midnight = seconds / MAX_DAY_SECONDS
+    noon = np.where(
+        hours > 12,
+        (seconds - NOON_SECONDS) / (MAX_DAY_SECONDS - NOON_SECONDS),
+        (seconds - NOON_SECONDS) / NOON_SECONDS
+    )
+    # The Kotlin guard zeroes every time off the hour, minute and second
+    # outside 12 o'clock; kept so both engines write the same values
+    noon = np.where((hours != 12) & (minutes != 0) & (secs != 0), 0.0, noon)
+    return {'start_time_norm_midnight': midnight, 'start_time_norm_noon': noon}
+
+
+def ml_partitions(rng: np.random.Generator, size: int, options: Dict[str, Any]) -> np.ndarray:
+    """SetMLPartitionsFn's weighted random partition per row"""
+    weighted = [(weight, name) for weight, name in [
+        (options['train_weight'], 'train'),
+        (options['test_weight'], 'test'),
+        (options['validation_weight'], 'validation'),
+    ] if weight > 0]
+    bounds = np.cumsum([weight for weight, _ in weighted])
+    picks = np.searchsorted(bounds, rng.random(size) * bounds[-1], side='right')
+    return np.array([name for _, name in weighted])[picks]
+
+
+def encode(trips: pd.DataFrame, stats: Dict[str, Any], options: Dict[str, Any],
+           rng: np.random.Generator) -> pd.DataFrame:
+    """Encodes filtered trips into output rows with the pass 1 statistics"""
+    start = trips['start']
+    hours = start.dt.hour.to_numpy()
+    minutes = start.dt.minute.to_numpy()
+    secs = start.dt.second.to_numpy()
+    years = start.dt.year.to_numpy()
+    lats = trips['pickup_latitude'].to_numpy(dtype=np.float64)
+    longs = trips['pickup_longitude'].to_numpy(dtype=np.float64)
+    lat, long = stats['pickup_latitude'], stats['pickup_longitude']
+
+    columns = {
+        'unique_key': trips['unique_key'].fillna('').astype(str).to_numpy(),
+        'cash': (trips['payment_type'] == 'Cash').astype(np.int64).to_numpy(),
+        'year': years,
+        'start_time': start.dt.strftime('%Y-%m-%d %H:%M:%S').to_numpy(),
+        'trip_miles': trips['trip_miles'].to_numpy(dtype=np.float64),
+        'company': trips['company'].to_numpy(),
+        'ml_partition': ml_partitions(rng, len(trips), options),
+        'distance_from_center': np.zeros(len(trips)),
+        'pickup_latitude': lats,
+        'pickup_longitude': longs,
+        'pickup_lat_centered': options['map_center_lat'] - lats,
+        'pickup_long_centered': options['map_center_long'] - longs,
+        'pickup_lat_norm': (lats - lat['min']) / (lat['max'] - lat['min']),
+        'pickup_long_norm': (longs - long['min']) / (long['max'] - long['min']),
+        'pickup_lat_std': (lats - lat['mean']) / lat['std'],
+        'pickup_long_std': (longs - long['mean']) / long['std'],
+    }
+    with np.errstate(divide='ignore', invalid='ignore'):
+        year_norm = (years - stats['min_year']) / float(stats['max_year'] - stats['min_year'])
+    columns['year_norm'] = np.nan_to_num(year_norm, nan=0.0)
+    columns.update(normalize_times(hours * 3600.0 + minutes * 60 + secs, hours, minutes, secs))
+
+    day_of_week = start.dt.dayofweek.to_numpy()
+    for index, name in enumerate(DAYS_OF_WEEK):
+        columns[name] = (day_of_week == index).astype(np.int64)
+    month = start.dt.month.to_numpy()
+    for index, name in enumerate(MONTHS):
+        columns[name] = (month == index + 1).astype(np.int64)
+    if options['hot_encode_company']:
+        companies = (COMPANY_PREFIX + clean_company(trips['company'])).to_numpy()
+        for name in stats['company_columns']:
+            columns[name] = (companies == name).astype(np.int64)
+
+    rows = pd.DataFrame(columns, index=trips.index)[output_columns(stats, options)]
+    if options['sample_size'] < 100:
+        rows = rows[rng.integers(0, 100, len(rows)) < options['sample_size']]
+    return rows
+
+
+def output_columns(stats: Dict[str, Any], options: Dict[str, Any]) -> List[str]:
+    columns = TABLE_COLUMNS + DAYS_OF_WEEK + MONTHS
+    if options['hot_encode_company']:
+        columns = columns + stats['company_columns']
+    return columns
+
+
+def output_path(options: Dict[str, Any], index: int, num_files: int) -> str:
+    return os.path.join(options['output_dir'], 'trips-{:05d}-of-{:05d}.{}'.format(
+        index, num_files, options['output_format']))
+
+
+def add_column_stats(column_stats: Dict[str, Dict[str, float]], rows: pd.DataFrame):
+    numeric = rows.select_dtypes(include='number')
+    if numeric.empty:
+        return
+    for name, minimum, maximum, total, count in zip(
+            numeric.columns, numeric.min(), numeric.max(), numeric.sum(), numeric.count()):
+        manifest.add_values(column_stats, name, float(minimum), float(maximum), float(total), int(count))
+
+
+def encode_file(path: str, index: int, num_files: int, stats: Dict[str, Any],
+                options: Dict[str, Any]) -> Dict[str, Any]:
+    """Pass 2 over one file; returns the manifest entry of the file written"""
+    rng = np.random.default_rng([options['seed'], index])
+    output = output_path(options, index, num_files)
+    column_stats = {}
+    partitions = {}
+    written = 0
+    with open(output, 'w') as f:
+        for chunk_index, chunk in enumerate(read_chunks(path, options['chunk_rows'])):
+            rows = encode(filter_rows(chunk), stats, options, rng)
+            if options['output_format'] == 'csv':
+                rows.to_csv(f, header=chunk_index == 0, index=False)
+            elif len(rows):
+                f.write(rows.to_json(orient='records', lines=True).rstrip('\n') + '\n')
+            add_column_stats(column_stats, rows)
+            for partition, count in rows['ml_partition'].value_counts().items():
+                partitions[partition] = partitions.get(partition, 0) + int(count)
+            written += len(rows)
+    entry = manifest.shard(os.path.basename(output), None, options['output_format'], 'null', written,
+                           os.path.getsize(output), column_stats)
+    # Rows of every ml_partition are mixed in each file
+    entry['partitions'] = partitions
+    return entry
+
+
+def run(options: Dict[str, Any]) -> Dict[str, Any]:
+    """Runs both passes over the files matching options['input']; returns the statistics"""
+    paths = sorted(glob.glob(options['input']))
+    if not paths:
+        raise ValueError("No raw trip files match {}".format(options['input']))
+    os.makedirs(options['output_dir'], exist_ok=True)
+    workers = options['workers'] or available_cpus()
+    context = multiprocessing.get_context('spawn')
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(paths)), mp_context=context) as pool:
+        start = time.time()
+        stats = empty_stats()
+        for file_result in pool.map(file_stats, paths, [options] * len(paths)):
+            merge_stats(stats, file_result)
+        if not stats['rows']:
+            raise ValueError("No trips in {} pass the row filter".format(options['input']))
+        stats = finalize_stats(stats)
+        logging.info("Pass 1: %d trips in %d files in %.1f secs; years %d-%d",
+                     stats['rows'], len(paths), time.time() - start, stats['min_year'], stats['max_year'])
+
+        start = time.time()
+        shards = list(pool.map(
+            encode_file,
+            paths,
+            range(len(paths)),
+            [len(paths)] * len(paths),
+            [stats] * len(paths),
+            [options] * len(paths)
+        ))
+        logging.info("Pass 2: wrote %d rows to %s in %.1f secs",
+                     sum(shard['rows'] for shard in shards), options['output_dir'], time.time() - start)
+
+    data_manifest = manifest.new(shards)
+    data_manifest['encoding'] = encoding(stats, options)
+    with open(os.path.join(options['output_dir'], manifest.MANIFEST_FILE), 'w') as f:
+        f.write(manifest.to_json(data_manifest))
+    return stats
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--input',
+        type=str,
+        required=True,
+        help='Glob of raw trip files: CSV, or newline delimited JSON ending in .json')
+    parser.add_argument(
+        '--output-dir',
+        type=str,
+        required=True,
+        help='Directory for the encoded files, one per input file')
+    parser.add_argument(
+        '--output-format',
+        type=str,
+        choices=OUTPUT_FORMATS,
+        help='Encoded file format: json (newline delimited, for pipeline.py --input_path) or csv. Default: json',
+        default='json')
+    parser.add_argument(
+        '--workers',
+        type=int,
+        help='Worker processes. 0 uses the available CPUs. Default: 0',
+        default=0)
+    parser.add_argument(
+        '--chunk-rows',
+        type=int,
+        help='Rows a worker reads and transforms at once. Default: 200000',
+        default=200000)
+    parser.add_argument(
+        '--map-center-lat',
+        type=float,
+        help='Latitude to center pickup latitudes on. Default: 41.8839 (Chicago City Hall)',
+        default=41.8839)
+    parser.add_argument(
+        '--map-center-long',
+        type=float,
+        help='Longitude to center pickup longitudes on. Default: -87.6319 (Chicago City Hall)',
+        default=-87.6319)
+    parser.add_argument(
+        '--hot-encode-company',
+        action='store_true',
+        help='One-hot-encode the company column')
+    parser.add_argument(
+        '--train-weight',
+        type=float,
+        help='Weight of the train partition. Default: 70.0',
+        default=70.0)
+    parser.add_argument(
+        '--test-weight',
+        type=float,
+        help='Weight of the test partition. Default: 15.0',
+        default=15.0)
+    parser.add_argument(
+        '--validation-weight',
+        type=float,
+        help='Weight of the validation partition. Default: 15.0',
+        default=15.0)
+    parser.add_argument(
+        '--sample-size',
+        type=int,
+        help='Percent of trips to keep, 0-100. Default: 100',
+        default=100)
+    parser.add_argument(
+        '--seed',
+        type=int,
+        help='Seed of the partition and sampling draws. Default: 0',
+        default=0)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
+    run(vars(get_args()))
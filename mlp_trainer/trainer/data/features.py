@@ -1,9 +1,15 @@
-from typing import List, Dict
+from typing import Any, List, Dict, Optional
 
 import tensorflow as tf
 
-def defs():
-    return [
+# Label column and the dtype it is stored as
+LABEL = "cash"
+LABEL_DTYPE = tf.dtypes.int64
+
+# Every model input column, in the order the model sees them. The BigQuery
+# read options, the tf.Transform metadata and the model input width are all
+# derived from this list.
+FEATURES = [
     { "name": "year_norm", "dtype": tf.dtypes.float32},
     { "name": "start_time_norm_midnight", "dtype": tf.dtypes.float32},
     { "name": "start_time_norm_noon", "dtype": tf.dtypes.float32},
@@ -32,6 +38,50 @@ def defs():
     { "name": "month_DECEMBER", "dtype": tf.dtypes.float32},
 ]
 
+# Names of the features in use; None uses all of FEATURES
+selected = None
+
+
+def select(feature_names: Optional[List[str]]) -> List[Dict[str, Any]]:
+    """Restricts defs() to `feature_names`, keeping registry order. None selects every feature"""
+    global selected
+    if feature_names:
+        known = [feature.get("name") for feature in FEATURES]
+        unknown = [name for name in feature_names if name not in known]
+        if unknown:
+            raise ValueError("Unknown features: {}. Known features: {}".format(unknown, known))
+        selected = list(feature_names)
+    else:
+        selected = None
+    return defs()
+
+
+def defs() -> List[Dict[str, Any]]:
+    if selected is None:
+        return FEATURES
+    return [feature for feature in FEATURES if feature.get("name") in selected]
+
+
+def names() -> List[str]:
+    return [feature.get("name") for feature in defs()]
+
+
+def columns() -> List[str]:
+    """Columns to read: the label and the selected features"""
+    return [LABEL] + names()
+
+
+def num_features() -> int:
+    return len(defs())
+
+
+def feature_spec() -> Dict[str, tf.io.FixedLenFeature]:
+    """Parsing spec of the stored rows: the label and every registered feature"""
+    spec = {LABEL: tf.io.FixedLenFeature([], LABEL_DTYPE)}
+    for feature in FEATURES:
+        spec[feature.get("name")] = tf.io.FixedLenFeature([], feature.get("dtype"))
+    return spec
+
 
 def serving_input_receiver_fn():
     # inputs = tf.ones(
@@ -43,7 +93,7 @@ def serving_input_receiver_fn():
     #     "features": inputs,
     # }
 
-    inputs = tf.compat.v1.placeholder(dtype=tf.float32, shape=[None, 26])  # this is raw input
+    inputs = tf.compat.v1.placeholder(dtype=tf.float32, shape=[None, num_features()])  # this is raw input
     features = inputs  # we simply feed the raw input to estimator
     
 
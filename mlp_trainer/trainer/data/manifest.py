@@ -0,0 +1,152 @@
+"""Dataset manifests: the shards of a data directory with their row counts and column statistics.
+
+Writers put a `_manifest.json` in the directory that holds the partition
+subdirectories (`{location}/` for TFRecords, `{location}/avro/` for Avro).
+Readers use it to plan shards across workers, count steps per epoch and
+skip shards whose column ranges cannot match --shard-filter, without
+listing or scanning the data. A manifest looks like:
+
+    {"version": 1, "shards": [
+        {"path": "train/train-00000-of-00004.avro", "partition": "train", "format": "avro",
+         "codec": "deflate", "rows": 250000, "bytes": 8123456,
+         "columns": {"cash": {"min": 0, "max": 1, "mean": 0.38}, ...}},
+        ...]}
+
+Shard paths are relative to the manifest's directory. This module has no
+TensorFlow or storage dependency; callers read and write the JSON text.
+"""
+import json
+import math
+import numbers
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+MANIFEST_FILE = '_manifest.json'
+VERSION = 1
+
+FILTER_OPS = ['>=', '<=', '>', '<', '=']
+
+
+def new(shards=None) -> Dict[str, Any]:
+    return {'version': VERSION, 'shards': list(shards or [])}
+
+
+def from_json(text: str) -> Dict[str, Any]:
+    manifest = json.loads(text)
+    if manifest.get('version') != VERSION:
+        raise ValueError("Unsupported manifest version {}".format(manifest.get('version')))
+    return manifest
+
+
+def to_json(manifest: Dict[str, Any]) -> str:
+    return json.dumps(manifest, indent=2, sort_keys=True)
+
+
+def merge(manifest: Dict[str, Any], shards: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Adds `shards` to `manifest`, replacing shards with the same path"""
+    paths = {shard['path'] for shard in shards}
+    kept = [shard for shard in manifest['shards'] if shard['path'] not in paths]
+    return new(sorted(kept + list(shards), key=lambda shard: shard['path']))
+
+
+def add_values(stats: Dict[str, Dict[str, float]], name: str, minimum: float, maximum: float,
+               total: float, count: int):
+    """Folds a batch of values of column `name`, given as its min, max, sum and count, into `stats`"""
+    if count == 0:
+        return
+    column = stats.get(name)
+    if column is None:
+        stats[name] = {'min': minimum, 'max': maximum, 'sum': total, 'count': count}
+        return
+    column['min'] = min(column['min'], minimum)
+    column['max'] = max(column['max'], maximum)
+    column['sum'] += total
+    column['count'] += count
+
+
+def add_row(stats: Dict[str, Dict[str, float]], row: Dict[str, Any]):
+    """Folds the numeric values of one row, including NumPy scalars, into `stats`"""
+    for name, value in row.items():
+        if isinstance(value, numbers.Number) and not isinstance(value, bool):
+            value = float(value)
+            add_values(stats, name, value, value, value, 1)
+
+
+def column_stats(stats: Dict[str, Dict[str, float]]) -> Dict[str, Dict[str, float]]:
+    """Per column min, max and mean of accumulated `stats`"""
+    return {
+        name: {'min': column['min'], 'max': column['max'], 'mean': column['sum'] / column['count']}
+        for name, column in sorted(stats.items())
+    }
+
+
+def shard(path: str, partition: Optional[str], file_format: str, codec: str, rows: int, size: int,
+          stats: Dict[str, Dict[str, float]]) -> Dict[str, Any]:
+    return {
+        'path': path,
+        'partition': partition,
+        'format': file_format,
+        'codec': codec,
+        'rows': rows,
+        'bytes': size,
+        'columns': column_stats(stats),
+    }
+
+
+def parse_filter(text: str) -> List[Tuple[str, str, float]]:
+    """`year_norm>=0.5,cash=1` as (column, op, value) conditions; all must hold"""
+    conditions = []
+    for condition in [part.strip() for part in (text or '').split(',') if part.strip()]:
+        match = re.match(r'^\s*(\w+)\s*({})\s*(\S+)\s*$'.format('|'.join(map(re.escape, FILTER_OPS))), condition)
+        if match is None:
+            raise ValueError("Bad shard filter condition '{}'; expected e.g. year_norm>=0.5".format(condition))
+        conditions.append((match.group(1), match.group(2), float(match.group(3))))
+    return conditions
+
+
+def may_match(entry: Dict[str, Any], conditions: List[Tuple[str, str, float]]) -> bool:
+    """False when the shard's column ranges rule out every row. Columns without stats never rule a shard out"""
+    for name, op, value in conditions:
+        column = entry['columns'].get(name)
+        if column is None:
+            continue
+        if ((op == '>=' and column['max'] < value) or
+                (op == '>' and column['max'] <= value) or
+                (op == '<=' and column['min'] > value) or
+                (op == '<' and column['min'] >= value) or
+                (op == '=' and not column['min'] <= value <= column['max'])):
+            return False
+    return True
+
+
+def shards(manifest: Dict[str, Any], partition: str, conditions=None) -> List[Dict[str, Any]]:
+    """Shards of `partition` that may hold rows passing `conditions`"""
+    return [
+        entry for entry in manifest['shards']
+        if entry['partition'] == partition and may_match(entry, conditions or [])
+    ]
+
+
+def plan(entries: List[Dict[str, Any]], num_workers: int, task_index: int) -> List[Dict[str, Any]]:
+    """This worker's shards, balancing rows across workers rather than shard counts"""
+    if num_workers <= 1:
+        return list(entries)
+    loads = [0] * num_workers
+    assigned = [[] for _ in range(num_workers)]
+    for entry in sorted(entries, key=lambda entry: (-entry['rows'], entry['path'])):
+        worker = loads.index(min(loads))
+        loads[worker] += entry['rows']
+        assigned[worker].append(entry)
+    return sorted(assigned[max(task_index, 0)], key=lambda entry: entry['path'])
+
+
+def row_count(entries: List[Dict[str, Any]], label: str, sample_fraction=1., negative_rate=1.) -> int:
+    """Expected rows read from `entries`, with the negatives of `label` kept at `negative_rate`"""
+    rows = 0.
+    for entry in entries:
+        shard_rows = entry['rows']
+        if negative_rate < 1.:
+            positives = shard_rows * entry['columns'].get(label, {}).get('mean', 1.)
+            shard_rows = positives + negative_rate * (shard_rows - positives)
+        rows += shard_rows
+    return int(math.ceil(rows * sample_fraction))
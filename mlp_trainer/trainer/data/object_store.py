@@ -0,0 +1,234 @@
+"""Concurrent ranged reads of objects from GCS, a fake GCS server or a local directory.
+
+An ObjectReader lists objects in a background thread and downloads each
+object it opens as fixed size byte ranges on a shared thread pool, so
+several objects and several ranges of one large object are in flight at
+once. The bytes downloaded ahead of the consumers are bounded by
+`read_ahead_bytes`; each open object may always have one range in flight
+so a slow consumer cannot stall the others. An opened object is a file-like
+stream that returns bytes as soon as the range holding them has arrived,
+so Avro blocks are decoded while later ranges are still downloading.
+"""
+import collections
+import io
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, Optional, Tuple
+
+LOCAL_PREFIX = 'file://'
+
+# Names listed ahead of the consumer of ObjectReader.list
+LIST_QUEUE = 1000
+
+
+class LocalStore:
+    """A local directory standing in for a bucket; object names are paths relative to it"""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def list(self, prefix: str) -> Iterator[Tuple[str, int]]:
+        top = os.path.join(self.root, os.path.dirname(prefix))
+        for dirpath, dirnames, filenames in os.walk(top):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+                name = os.path.relpath(path, self.root)
+                if name.startswith(prefix):
+                    yield name, os.path.getsize(path)
+
+    def size(self, name: str) -> int:
+        return os.path.getsize(os.path.join(self.root, name))
+
+    def exists(self, name: str) -> bool:
+        return os.path.isfile(os.path.join(self.root, name))
+
+    def read_range(self, name: str, start: int, end: int) -> bytes:
+        with open(os.path.join(self.root, name), 'rb') as f:
+            f.seek(start)
+            return f.read(end - start)
+
+
+class GCSStore:
+    """A GCS bucket, or a bucket of a fake GCS server at `endpoint` (e.g. http://localhost:4443)"""
+
+    def __init__(self, bucket_name: str, endpoint: Optional[str] = None):
+        from google.cloud import storage
+        if endpoint:
+            from google.auth.credentials import AnonymousCredentials
+            self.client = storage.Client(
+                project='local',
+                credentials=AnonymousCredentials(),
+                client_options={'api_endpoint': endpoint}
+            )
+        else:
+            self.client = storage.Client()
+        self.bucket = self.client.bucket(bucket_name)
+
+    def list(self, prefix: str) -> Iterator[Tuple[str, int]]:
+        for blob in self.client.list_blobs(self.bucket, prefix=prefix):
+            yield blob.name, blob.size
+
+    def size(self, name: str) -> int:
+        return self.bucket.get_blob(name).size
+
+    def exists(self, name: str) -> bool:
+        return self.bucket.blob(name).exists()
+
+    def read_range(self, name: str, start: int, end: int) -> bytes:
+        # GCS ranges include their end byte
+        return self.bucket.blob(name).download_as_string(start=start, end=end - 1)
+
+
+def get_store(bucket_name: str, endpoint: Optional[str] = None):
+    """`file:///path` or an absolute path reads a local directory, anything else a (fake) GCS bucket"""
+    if bucket_name.startswith(LOCAL_PREFIX):
+        return LocalStore(bucket_name[len(LOCAL_PREFIX):])
+    if os.path.isabs(bucket_name):
+        return LocalStore(bucket_name)
+    return GCSStore(bucket_name, endpoint)
+
+
+class ByteBudget:
+    """Bytes downloaded but not yet consumed, shared by every object of a reader"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self, size: int) -> bool:
+        with self._lock:
+            if self.used + size > self.limit:
+                return False
+            self.used += size
+            return True
+
+    def force_acquire(self, size: int):
+        with self._lock:
+            self.used += size
+
+    def release(self, size: int):
+        with self._lock:
+            self.used -= size
+
+
+class ObjectStream(io.RawIOBase):
+    """Sequential reads of one object, fetched as concurrent ranges ahead of the read position"""
+
+    def __init__(self, reader: 'ObjectReader', name: str, size: int):
+        super().__init__()
+        self.reader = reader
+        self.name = name
+        self._ranges = [(start, min(start + reader.range_bytes, size)) for start in range(0, size, reader.range_bytes)]
+        self._next = 0
+        self._pending = collections.deque()
+        self._current = memoryview(b'')
+        self._current_size = 0
+        self._offset = 0
+        self._position = 0
+        self._fill()
+
+    def _fill(self):
+        while self._next < len(self._ranges) and len(self._pending) < self.reader.ranges_per_object:
+            start, end = self._ranges[self._next]
+            if self._pending or self._current_size:
+                if not self.reader.budget.try_acquire(end - start):
+                    return
+            else:
+                self.reader.budget.force_acquire(end - start)
+            future = self.reader.pool.submit(self.reader.store.read_range, self.name, start, end)
+            self._pending.append((end - start, future))
+            self._next += 1
+
+    def first_range(self) -> bytes:
+        """The bytes of the first range, e.g. to read a header, without consuming them"""
+        if self._current_size or self._next == 0:
+            raise ValueError("first_range() must be called before reading {}".format(self.name))
+        return self._pending[0][1].result()
+
+    def readable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        """Bytes read so far; fastavro's block reader records each block's offset"""
+        return self._position
+
+    def readinto(self, buffer) -> int:
+        while self._offset >= len(self._current):
+            if self._current_size:
+                self.reader.budget.release(self._current_size)
+                self._current = memoryview(b'')
+                self._current_size = 0
+            if not self._pending:
+                # The budget may have been full when the last range was fetched;
+                # holding nothing now, this object may always fetch its next range
+                self._fill()
+            if not self._pending:
+                return 0
+            size, future = self._pending.popleft()
+            self._current = memoryview(future.result())
+            self._current_size = size
+            self._offset = 0
+            self._fill()
+        count = min(len(buffer), len(self._current) - self._offset)
+        buffer[:count] = self._current[self._offset:self._offset + count]
+        self._offset += count
+        self._position += count
+        return count
+
+    def close(self):
+        if not self.closed:
+            held = self._current_size + sum(size for size, _ in self._pending)
+            for _, future in self._pending:
+                future.cancel()
+            self._pending.clear()
+            self._current = memoryview(b'')
+            self._current_size = 0
+            self.reader.budget.release(held)
+        super().close()
+
+
+class ObjectReader:
+    """Lists and opens the objects of one store, sharing a download pool and read-ahead budget"""
+
+    def __init__(self, store, threads=8, range_bytes=8 << 20, read_ahead_bytes=256 << 20, ranges_per_object=4):
+        self.store = store
+        self.range_bytes = range_bytes
+        self.ranges_per_object = ranges_per_object
+        self.budget = ByteBudget(read_ahead_bytes)
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='object-reader')
+        self._sizes = {}  # type: Dict[str, int]
+
+    def list(self, prefix: str) -> Iterator[str]:
+        """Object names under `prefix`, yielded while later pages are still being listed"""
+        names = queue.Queue(maxsize=LIST_QUEUE)
+        end = object()
+
+        def run():
+            try:
+                for name, size in self.store.list(prefix):
+                    self._sizes[name] = size
+                    names.put(name)
+            except Exception as e:
+                names.put(e)
+            names.put(end)
+
+        threading.Thread(target=run, name='object-lister', daemon=True).start()
+        while True:
+            item = names.get()
+            if item is end:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def size(self, name: str) -> int:
+        if name not in self._sizes:
+            self._sizes[name] = self.store.size(name)
+        return self._sizes[name]
+
+    def open(self, name: str) -> io.BufferedReader:
+        return io.BufferedReader(ObjectStream(self, name, self.size(name)), buffer_size=1 << 20)
@@ -0,0 +1,109 @@
+import json
+import threading
+from typing import Any, Dict, Iterable, Optional
+
+import numpy as np
+import tensorflow as tf
+
+
+class InputPosition(object):
+    """Tracks which rows of each input stream have been trained on.
+
+    A stream is a BigQuery read stream or an input file; rows are identified
+    by their offset in it. Rows reach the train step out of order because of
+    interleaving and shuffling, so each stream keeps a watermark (every row
+    before it has been trained on) plus the offsets past the watermark that
+    have also been trained on. Resuming starts each stream at its watermark
+    and skips those offsets, so no row is trained on twice or missed. Rows
+    the readers drop, e.g. sampled out blocks and downsampled negatives, are
+    marked with skip_rows() so the watermark moves past them.
+    """
+
+    def __init__(self):
+        self.session = None
+        self._names = []
+        self._watermarks = {}
+        self._done = {}
+        self._lock = threading.Lock()
+
+    def stream_index(self, name: str) -> int:
+        with self._lock:
+            if name not in self._names:
+                self._names.append(name)
+                self._watermarks[name] = 0
+                self._done[name] = set()
+            return self._names.index(name)
+
+    def start_offset(self, name: str) -> int:
+        with self._lock:
+            return self._watermarks.get(name, 0)
+
+    def skip(self, name: str) -> frozenset:
+        with self._lock:
+            return frozenset(self._done.get(name, ()))
+
+    def _mark(self, name: str, offsets: Iterable[int]):
+        done = self._done[name]
+        done.update(offsets)
+        watermark = self._watermarks[name]
+        while watermark in done:
+            done.remove(watermark)
+            watermark += 1
+        self._watermarks[name] = watermark
+
+    def record(self, positions: np.ndarray):
+        """Marks rows as trained on. `positions` is [batch, 2] of (stream index, offset)"""
+        if positions.size == 0:
+            return
+        with self._lock:
+            for stream in np.unique(positions[:, 0]):
+                self._mark(self._names[stream], positions[positions[:, 0] == stream, 1].tolist())
+
+    def skip_rows(self, name: str, offsets: Iterable[int]):
+        """Marks rows of stream `name` that are dropped before the train step as done"""
+        with self._lock:
+            self._mark(name, offsets)
+
+    def to_json(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'session': self.session.decode('ascii') if self.session is not None else None,
+                'streams': [
+                    {
+                        'name': name,
+                        'watermark': self._watermarks[name],
+                        'done': sorted(self._done[name]),
+                    } for name in self._names
+                ],
+            }
+
+    @classmethod
+    def from_json(cls, state: Dict[str, Any]) -> 'InputPosition':
+        position = cls()
+        if state.get('session'):
+            position.session = state['session'].encode('ascii')
+        for stream in state.get('streams', []):
+            position._names.append(stream['name'])
+            position._watermarks[stream['name']] = stream['watermark']
+            position._done[stream['name']] = set(stream['done'])
+        return position
+
+
+def _path(job_dir: str, checkpoint_number: int, task_key: str) -> str:
+    return '{}/input_position/ckpt-{}-{}.json'.format(job_dir, checkpoint_number, task_key)
+
+
+def save(job_dir: str, checkpoint_number: int, task_key: str, state: Dict[str, Any]):
+    """Writes the loop state saved alongside checkpoint `checkpoint_number`"""
+    path = _path(job_dir, checkpoint_number, task_key)
+    tf.io.gfile.makedirs(path.rsplit('/', 1)[0])
+    with tf.io.gfile.GFile(path, 'w') as f:
+        json.dump(state, f)
+
+
+def load(job_dir: str, checkpoint_number: int, task_key: str) -> Optional[Dict[str, Any]]:
+    path = _path(job_dir, checkpoint_number, task_key)
+    if not tf.io.gfile.exists(path):
+        return None
+    with tf.io.gfile.GFile(path) as f:
+        return json.load(f)
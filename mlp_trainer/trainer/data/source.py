@@ -0,0 +1,41 @@
+from typing import Any, Dict
+
+import tensorflow as tf
+
+from trainer.data import avro as avro_generator
+from trainer.data import bigquery_generator as bq_generator
+
+
+def get_data(params: Dict[str, Any], table_id: str, bucket_name: str, prefix: str, partition: str,
+             with_position=False, negative_rate=1., stage=None) -> tf.data.Dataset:
+    """Batches of `partition` read by this process from --data-source"""
+    if params['data_source'] == 'avro':
+        return avro_generator.get_data(
+            bucket_name,
+            prefix,
+            partition,
+            params['batch_size'],
+            1,
+            params['chunk_size'],
+            params['cycle_length'],
+            1,
+            0,
+            with_position=with_position,
+            sample_fraction=params['sample_fraction'],
+            negative_rate=negative_rate,
+            stage=stage,
+        )
+    return bq_generator.get_data(
+        table_id,
+        partition,
+        params['batch_size'],
+        1,
+        params['chunk_size'],
+        params['cycle_length'],
+        1,
+        0,
+        with_position=with_position,
+        sample_fraction=params['sample_fraction'],
+        negative_rate=negative_rate,
+        stage=stage,
+    )
@@ -0,0 +1,42 @@
+import numpy as np
+import tensorflow as tf
+
+from trainer.data import features as features
+
+# Columns before the day of week and month one-hots
+CONTINUOUS_FEATURES = 7
+
+
+def make_batch(batch_size: int, seed=0):
+    """Generates one batch shaped like the encoded taxi data.
+
+    Continuous features are standard normal, day of week and month are valid
+    one-hots and the label is drawn from a fixed logistic model of all the
+    registered features so that training can make progress.
+    """
+    rng = np.random.RandomState(seed)
+    num_features = len(features.FEATURES)
+
+    feats = np.zeros((batch_size, num_features), dtype=np.float32)
+    feats[:, :CONTINUOUS_FEATURES] = rng.normal(size=(batch_size, CONTINUOUS_FEATURES))
+    days = rng.randint(0, 7, size=batch_size)
+    months = rng.randint(0, 12, size=batch_size)
+    feats[np.arange(batch_size), CONTINUOUS_FEATURES + days] = 1.
+    feats[np.arange(batch_size), CONTINUOUS_FEATURES + 7 + months] = 1.
+
+    weights = np.random.RandomState(1234).normal(size=num_features)
+    logits = feats.dot(weights) - 1.
+    labels = (rng.uniform(size=batch_size) < 1. / (1. + np.exp(-logits))).astype(np.float32)
+
+    # Keep only the selected features, in registry order
+    registry = [feature.get("name") for feature in features.FEATURES]
+    feats = feats[:, [registry.index(name) for name in features.names()]]
+
+    return feats, labels.reshape((batch_size, 1))
+
+
+def get_data(batch_size: int, steps: int, seed=0) -> tf.data.Dataset:
+    """Repeats one in-memory batch so input cost is negligible"""
+    return tf.data.Dataset.from_tensors(
+        make_batch(batch_size, seed)
+    ).repeat(steps)
@@ -0,0 +1,22 @@
+import tensorflow as tf
+
+STRATEGIES = ['multi-worker', 'parameter-server', 'mirrored', 'one-device']
+
+
+def get_strategy(name: str, default: str, supported=STRATEGIES) -> tf.distribute.Strategy:
+    """Builds the --distribute-strategy strategy; an empty name uses the trainer's `default`"""
+    name = name or default
+    if name not in supported:
+        raise ValueError("--distribute-strategy {} is not supported by this trainer. Use one of: {}".format(
+            name, ', '.join(supported)))
+
+    tf.get_logger().info("Using distribute strategy {}".format(name))
+    if name == 'multi-worker':
+        return tf.distribute.experimental.MultiWorkerMirroredStrategy(
+            communication=tf.distribute.experimental.CollectiveCommunication.AUTO
+        )
+    if name == 'parameter-server':
+        return tf.distribute.experimental.ParameterServerStrategy()
+    if name == 'mirrored':
+        return tf.distribute.MirroredStrategy()
+    return tf.distribute.OneDeviceStrategy('/cpu:0')
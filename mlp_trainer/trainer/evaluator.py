@@ -0,0 +1,107 @@
+"""Sidecar evaluation of the checkpoints a training run writes to its job directory.
+
+Run next to a training job with `--task=evaluate`, or let `--sidecar-eval`
+start it as a child process of the training task.
+"""
+import multiprocessing
+from typing import Any, Dict, Tuple
+
+import tensorflow as tf
+
+import trainer.model as model
+import trainer.model_loop as model_loop
+import trainer.threads as threads
+import trainer.timing as timing
+import trainer.data.avro as avro_generator
+import trainer.data.features as features
+
+EVAL_DIR = 'eval_sidecar'
+
+# Seconds between checks for a new checkpoint while training is still running
+POLL_SECS = 10
+
+
+def checkpoint_number(checkpoint_path: str) -> int:
+    return int(checkpoint_path.rsplit('-', 1)[1])
+
+
+def eval_params(params: Dict[str, Any]) -> Dict[str, Any]:
+    """Gives the evaluator --eval-threads CPUs for compute and input"""
+    params = dict(params)
+    params['intra_op_threads'] = params['eval_threads']
+    params['inter_op_threads'] = 1
+    params['data_threads'] = params['eval_threads']
+    params['cycle_length'] = params['eval_threads']
+    return params
+
+
+def run(trainer: str, table_id: str, job_dir: str, bucket_name: str, prefix: str,
+        params: Dict[str, Any], training_done=None):
+    """Evaluates each new checkpoint in job_dir until training stops writing them.
+
+    A checkpoint is skipped when a newer one was written while the previous
+    evaluation ran, so a slow evaluator only ever falls one checkpoint behind.
+    Without `training_done` (a multiprocessing Event set by the training
+    task) the evaluator stops after --eval-timeout-secs without a new
+    checkpoint.
+    """
+    params = eval_params(params)
+    threads.configure(params)
+    features.select(params['features'])
+    avro_generator.configure(params)
+
+    if training_done is None:
+        timeout = params['eval_timeout_secs']
+        timeout_fn = lambda: True
+    else:
+        timeout = POLL_SECS
+        timeout_fn = training_done.is_set
+
+    writer = None
+    if trainer == 'loop':
+        # The Estimator writes its own evaluation summaries
+        writer = tf.summary.create_file_writer('{}/{}'.format(job_dir, EVAL_DIR))
+
+    tf.get_logger().info("Sidecar evaluator watching {} with {} threads".format(job_dir, params['eval_threads']))
+    skipped = 0
+    for checkpoint_path in tf.train.checkpoints_iterator(
+            job_dir,
+            min_interval_secs=params['eval_interval_secs'],
+            timeout=timeout,
+            timeout_fn=timeout_fn):
+        latest = tf.train.latest_checkpoint(job_dir)
+        if latest is not None and checkpoint_number(latest) > checkpoint_number(checkpoint_path):
+            skipped += 1
+            tf.get_logger().info("Skipping stale checkpoint {}; {} is newer".format(checkpoint_path, latest))
+            continue
+
+        start = timing.now()
+        if trainer == 'loop':
+            outputs = model_loop.evaluate_checkpoint(table_id, bucket_name, prefix, params, checkpoint_path)
+            with writer.as_default():
+                for name, value in outputs.items():
+                    tf.summary.scalar(name, value, step=checkpoint_number(checkpoint_path))
+            writer.flush()
+        else:
+            outputs = model.evaluate_checkpoint(table_id, job_dir, bucket_name, prefix, params, checkpoint_path)
+        tf.get_logger().info("Evaluated {} in {}s: {}".format(
+            checkpoint_path,
+            round(timing.now() - start, 2),
+            outputs
+        ))
+
+    tf.get_logger().info("Sidecar evaluator finished; skipped {} stale checkpoints".format(skipped))
+
+
+def start_sidecar(trainer: str, table_id: str, job_dir: str, bucket_name: str, prefix: str,
+                  params: Dict[str, Any]) -> Tuple[multiprocessing.Process, Any]:
+    """Starts run() in a fresh process. Set the returned event once training has finished"""
+    context = multiprocessing.get_context('spawn')
+    training_done = context.Event()
+    process = context.Process(
+        target=run,
+        args=(trainer, table_id, job_dir, bucket_name, prefix, params, training_done),
+        name='sidecar-evaluator',
+    )
+    process.start()
+    return process, training_done
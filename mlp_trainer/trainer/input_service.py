@@ -0,0 +1,286 @@
+"""Decodes input rows into batches in separate worker processes.
+
+Reading rows from the BigQuery Storage API or Avro and converting them to
+tensors in Python competes with the train step for the training task's
+cores. With --input-workers the training task instead runs a dispatcher:
+for each dataset it splits the partition into read units (BigQuery streams
+of one read session, or Avro objects) that the workers pick up, decode,
+shuffle and send back as `[rows, features]` arrays. The training process
+only re-slices those arrays into batches.
+
+Workers started with --input-workers run on the training host. More can be
+started on dedicated CPU hosts, pointed at the dispatcher's fixed
+--input-service-port:
+
+    python -m trainer.task --task=input-worker --input-service-address=trainer-host:50051
+
+The dispatcher speaks pickle, so anyone who can connect can run code on the
+training host. Without a fixed port it listens on localhost only, with a
+random key shared with its own workers. A fixed port listens on every
+interface and requires the INPUT_SERVICE_AUTHKEY secret on both sides.
+"""
+import codecs
+import logging
+import multiprocessing
+import os
+import pickle
+import queue
+import random
+from multiprocessing.managers import BaseManager
+from typing import Any, Dict, Iterator, Tuple
+
+import numpy as np
+import tensorflow as tf
+
+import trainer.data.avro as avro_generator
+import trainer.data.bigquery as data
+import trainer.data.bigquery_generator as generator
+import trainer.data.features as features
+
+# Environment variable holding the secret remote workers authenticate with
+AUTHKEY_ENV = 'INPUT_SERVICE_AUTHKEY'
+
+# Decoded chunks buffered between the workers and the training task
+QUEUE_CHUNKS = 64
+
+# Rows a worker shuffles together, in batches
+SHUFFLE_BATCHES = 5
+
+# Seconds stop() waits for a local worker to finish its unit
+STOP_TIMEOUT_SECS = 30
+
+# The running service of this training task, set by start()
+service = None
+
+_units = queue.Queue()
+_chunks = queue.Queue(maxsize=QUEUE_CHUNKS)
+
+
+def _get_units():
+    return _units
+
+
+def _get_chunks():
+    return _chunks
+
+
+class DispatcherManager(BaseManager):
+    pass
+
+
+DispatcherManager.register('units', callable=_get_units)
+DispatcherManager.register('chunks', callable=_get_chunks)
+
+
+def get_authkey(required: bool) -> bytes:
+    """The INPUT_SERVICE_AUTHKEY secret, or a random key when only local workers connect"""
+    authkey = os.environ.get(AUTHKEY_ENV)
+    if authkey:
+        return authkey.encode('utf-8')
+    if required:
+        raise ValueError("Set {} to the same secret for the training task and its remote input workers".format(
+            AUTHKEY_ENV))
+    return os.urandom(32)
+
+
+def parse_address(address: str) -> Tuple[str, int]:
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def request_config(params: Dict[str, Any], table_id: str, bucket_name: str, prefix: str,
+                   negative_rate=1.) -> Dict[str, Any]:
+    """What a worker needs to decode the units of one pass"""
+    return {
+        'data_source': params['data_source'],
+        'table_id': table_id,
+        'bucket_name': bucket_name,
+        'prefix': prefix,
+        'features': params['features'],
+        'batch_size': params['batch_size'],
+        'sample_fraction': params['sample_fraction'],
+        'negative_rate': negative_rate,
+        'avro_endpoint': params['avro_endpoint'],
+        'download_threads': params['download_threads'],
+        'download_range_mb': params['download_range_mb'],
+        'read_ahead_mb': params['read_ahead_mb'],
+    }
+
+
+def read_units(config: Dict[str, Any], partition: str) -> list:
+    """The units the workers decode independently: (session, stream) pairs or Avro object names"""
+    if config['data_source'] == 'avro':
+        return avro_generator.list_blobs(config['bucket_name'], config['prefix'], partition)
+
+    # One read session for all workers so their streams cover the partition exactly once
+    session = data.get_data_partition_sharded(
+        config['table_id'],
+        partition,
+        shards=100,
+        sample_fraction=config['sample_fraction']
+    )
+    encoded_session = codecs.encode(pickle.dumps(session), "base64")
+    return [(encoded_session, stream.name) for stream in session.streams]
+
+
+def unit_rows(config: Dict[str, Any], unit) -> Iterator[tuple]:
+    if config['data_source'] == 'avro':
+        return avro_generator.generate_blob(
+            config['bucket_name'].encode('utf-8'),
+            unit.encode('utf-8'),
+            sample_fraction=config['sample_fraction'],
+            negative_rate=config['negative_rate']
+        )
+
+    encoded_session, stream_name = unit
+    return generator.get_reader_for_stream(
+        encoded_session,
+        stream_name.encode('utf-8'),
+        negative_rate=config['negative_rate']
+    )
+
+
+def decode_unit(config: Dict[str, Any], unit) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """Shuffled (features, labels) chunks of one unit; the readers downsample the negatives"""
+    buffer_rows = config['batch_size'] * SHUFFLE_BATCHES
+    rows = []
+
+    def chunk(rows):
+        random.shuffle(rows)
+        values = np.asarray(rows, dtype=np.float32)
+        return values[:, :-1], values[:, -1:].astype(np.int64)
+
+    for row in unit_rows(config, unit):
+        rows.append(row)
+        if len(rows) >= buffer_rows:
+            yield chunk(rows)
+            rows = []
+    if rows:
+        yield chunk(rows)
+
+
+def run_worker(address: str, authkey=None):
+    """Decodes the units the dispatcher at `address` hands out until it shuts down.
+    Workers started on other hosts authenticate with INPUT_SERVICE_AUTHKEY."""
+    if authkey is None:
+        authkey = get_authkey(required=True)
+    manager = DispatcherManager(address=parse_address(address), authkey=authkey)
+    manager.connect()
+    units = manager.units()
+    chunks = manager.chunks()
+    selected = None
+
+    logging.info("Input worker %d connected to dispatcher %s", os.getpid(), address)
+    try:
+        while True:
+            item = units.get()
+            if item is None:
+                break
+            request_id, config, unit = item
+            if config['features'] != selected:
+                features.select(config['features'])
+                selected = config['features']
+            avro_generator.configure(config)
+            for feats, labels in decode_unit(config, unit):
+                chunks.put((request_id, feats, labels, False))
+            chunks.put((request_id, None, None, True))
+    except (EOFError, ConnectionError):
+        logging.info("Dispatcher %s went away; input worker %d exiting", address, os.getpid())
+
+
+class InputService:
+    """Dispatcher of a training task and the input workers it started"""
+
+    def __init__(self, port: int, num_workers: int):
+        context = multiprocessing.get_context('spawn')
+        # Only a fixed port is meant to be reached from other hosts
+        remote = port > 0
+        self.authkey = get_authkey(required=remote)
+        self.manager = DispatcherManager(
+            address=('' if remote else 'localhost', port),
+            authkey=self.authkey,
+            ctx=context
+        )
+        self.manager.start()
+        self.address = 'localhost:{}'.format(self.manager.address[1])
+        self.units = self.manager.units()
+        self.chunks = self.manager.chunks()
+        self.request_id = 0
+        self.workers = [
+            context.Process(target=run_worker, args=(self.address, self.authkey), name='input-worker-{}'.format(i))
+            for i in range(num_workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+        tf.get_logger().info("Input service dispatching on port {} to {} local workers".format(
+            self.manager.address[1], num_workers))
+
+    def batches(self, config: Dict[str, Any], partition: str) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """Dispatches one pass over `partition` and yields its batches as they are decoded"""
+        # Units of an abandoned pass would only delay this one
+        self._drain_units()
+        self.request_id += 1
+        request_id = self.request_id
+
+        units = read_units(config, partition)
+        for unit in units:
+            self.units.put((request_id, config, unit))
+        tf.get_logger().info("Dispatched {} read units of {} as request {}".format(len(units), partition, request_id))
+
+        batch_size = config['batch_size']
+        pending_feats = np.zeros([0, features.num_features()], dtype=np.float32)
+        pending_labels = np.zeros([0, 1], dtype=np.int64)
+        done = 0
+        while done < len(units):
+            chunk_request, feats, labels, unit_done = self.chunks.get()
+            if chunk_request != request_id:
+                continue
+            if unit_done:
+                done += 1
+                continue
+            pending_feats = np.concatenate([pending_feats, feats])
+            pending_labels = np.concatenate([pending_labels, labels])
+            while len(pending_feats) >= batch_size:
+                yield pending_feats[:batch_size], pending_labels[:batch_size]
+                pending_feats = pending_feats[batch_size:]
+                pending_labels = pending_labels[batch_size:]
+        if len(pending_feats) > 0:
+            yield pending_feats, pending_labels
+
+    def dataset(self, config: Dict[str, Any], partition: str) -> tf.data.Dataset:
+        return tf.data.Dataset.from_generator(
+            lambda: self.batches(config, partition),
+            (tf.float32, tf.int64),
+            output_shapes=(tf.TensorShape([None, features.num_features()]), tf.TensorShape([None, 1]))
+        ).prefetch(2)
+
+    def _drain_units(self):
+        while True:
+            try:
+                self.units.get_nowait()
+            except queue.Empty:
+                return
+
+    def stop(self):
+        self._drain_units()
+        for _ in self.workers:
+            self.units.put(None)
+        for worker in self.workers:
+            worker.join(timeout=STOP_TIMEOUT_SECS)
+            if worker.is_alive():
+                # Still blocked sending chunks of an abandoned pass
+                worker.terminate()
+        self.manager.shutdown()
+
+
+def start(params: Dict[str, Any]) -> InputService:
+    global service
+    service = InputService(params['input_service_port'], params['input_workers'])
+    return service
+
+
+def stop():
+    global service
+    if service is not None:
+        service.stop()
+        service = None
@@ -0,0 +1,116 @@
+import queue
+import threading
+from typing import Any, Callable, Dict, List
+
+import numpy as np
+import tensorflow as tf
+
+_STOP = object()
+
+
+class HostCheckpoint(object):
+    """Checkpoints host-side copies of a model and optimizer.
+
+    `model` and `optimizer` must be built the same way as the ones being
+    trained (but on the CPU and outside any distribution strategy) so the
+    written checkpoints restore into the trained objects.
+    """
+
+    def __init__(self, model: tf.keras.Model, optimizer, directory: str, max_to_keep=5):
+        self.model = model
+        self.optimizer = optimizer
+        self.checkpoint = tf.train.Checkpoint(optimizer=optimizer, model=model)
+        self.manager = tf.train.CheckpointManager(
+            self.checkpoint,
+            directory=directory,
+            max_to_keep=max_to_keep
+        )
+        self._built = False
+
+    def _build(self):
+        # Applying zero gradients creates the optimizer slots without moving
+        # the weights; set_weights then overwrites everything.
+        variables = self.model.trainable_variables
+        self.optimizer.apply_gradients(zip([tf.zeros_like(v) for v in variables], variables))
+        self._built = True
+
+    def save(self, model_weights: List[np.ndarray], optimizer_weights: List[np.ndarray], checkpoint_number: int) -> str:
+        if not self._built:
+            self._build()
+        self.model.set_weights(model_weights)
+        self.optimizer.set_weights(optimizer_weights)
+        return self.manager.save(checkpoint_number)
+
+
+class BackgroundWriter(object):
+    """Writes summaries and checkpoints off the training thread.
+
+    Values are copied to host memory on the calling thread before they are
+    queued, so training can keep updating the variables while a previous
+    snapshot is written. The queue is bounded: when the writer falls behind
+    by `max_queue` items, the training thread blocks instead of buffering
+    unbounded snapshots.
+    """
+
+    def __init__(self, writer, max_queue=8):
+        self.writer = writer
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='background-writer', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is _STOP:
+                    return
+                fn, args = item
+                fn(*args)
+            except Exception as e:  # pylint: disable=broad-except
+                tf.get_logger().error("Background write failed: {}".format(e))
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _put(self, fn: Callable, *args):
+        if self._error is not None:
+            raise self._error
+        self._queue.put((fn, args))
+
+    def submit(self, fn: Callable, *args):
+        """Queues `fn(*args)`. The arguments must already be host-side copies"""
+        self._put(fn, *args)
+
+    def scalars(self, values: Dict[str, Any], step: int):
+        snapshot = {name: float(value) for name, value in values.items()}
+        self._put(self._write_scalars, snapshot, step)
+
+    def _write_scalars(self, values: Dict[str, float], step: int):
+        with self.writer.as_default():
+            for name, value in values.items():
+                tf.summary.scalar(name, value, step=step)
+
+    def checkpoint(self, host_checkpoint: HostCheckpoint, model: tf.keras.Model, optimizer, checkpoint_number: int):
+        self._put(
+            self._write_checkpoint,
+            host_checkpoint,
+            model.get_weights(),
+            optimizer.get_weights(),
+            checkpoint_number,
+        )
+
+    def _write_checkpoint(self, host_checkpoint: HostCheckpoint, model_weights, optimizer_weights, checkpoint_number: int):
+        path = host_checkpoint.save(model_weights, optimizer_weights, checkpoint_number)
+        tf.get_logger().info("Checkpoint {} saved to {}".format(checkpoint_number, path))
+
+    def flush(self):
+        self._put(self.writer.flush)
+
+    def close(self):
+        """Writes everything still queued, flushes the summary writer and stops the thread"""
+        self._queue.put((self.writer.flush, ()))
+        self._queue.put(_STOP)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
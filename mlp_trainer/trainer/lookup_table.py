@@ -0,0 +1,329 @@
+"""Dense lookup table of an exported model's predictions, for scoring without the model.
+
+The model sees a trip as its year, time of day, pickup latitude and
+longitude, day of week and month, so for a fixed year its output is a
+function of three continuous values and two categories. `run` evaluates the
+exported model once on a grid of pickup latitude and longitude nodes x
+time of day nodes x 7 days x 12 months and stores the probabilities as a
+`[day, month, time, lat, long]` .npy array. LookupScorer memory-maps it and
+answers requests with the nearest node or a trilinear interpolation of the
+surrounding ones, so only the touched pages of the table are read.
+
+The grid covers raw coordinates and times, so the table needs the constants
+the features were encoded with: the `encoding` of a `trainer.data.etl`
+manifest, or a JSON file with the same keys. Run from `mlp_trainer/`:
+
+    python -m trainer.lookup_table --model-dir=model/saved_model --encoding=/data/encoded/_manifest.json \\
+        --output-dir=lookup
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+import numpy as np
+
+from trainer.data import etl as etl
+
+TABLE_FILE = 'lookup_table.npy'
+META_FILE = 'lookup_table.json'
+REPORT_FILE = 'lookup_table_report.json'
+VERSION = 1
+
+DTYPES = ['float16', 'float32']
+
+# Chicago taxi trip start times are rounded to 15 minutes
+TRIP_TIME_SECONDS = 900
+DAY_SECONDS = 24 * 3600
+
+
+def read_encoding(path: str) -> Dict[str, Any]:
+    """The encoding constants of an etl manifest, or of a JSON file holding only them"""
+    with open(path) as f:
+        encoding = json.load(f)
+    return encoding.get('encoding', encoding)
+
+
+def year_norm(year: int, encoding: Dict[str, Any]) -> float:
+    """ScaleYearFn; 0 when the data spans a single year"""
+    span = encoding['max_year'] - encoding['min_year']
+    return (year - encoding['min_year']) / float(span) if span else 0.
+
+
+def encode_requests(lats: np.ndarray, longs: np.ndarray, seconds: np.ndarray, days: np.ndarray,
+                    months: np.ndarray, year: int, encoding: Dict[str, Any],
+                    feature_names: List[str]) -> np.ndarray:
+    """Model input rows of trips, encoded like etl.encode. `days` count from Monday (0), `months` from 1"""
+    seconds = np.asarray(seconds, dtype=np.int64)
+    lat, long = encoding['pickup_latitude'], encoding['pickup_longitude']
+    columns = {
+        'year_norm': np.full(len(seconds), year_norm(year, encoding)),
+        'pickup_lat_std': (lats - lat['mean']) / lat['std'],
+        'pickup_long_std': (longs - long['mean']) / long['std'],
+        'pickup_lat_centered': encoding['map_center_lat'] - lats,
+        'pickup_long_centered': encoding['map_center_long'] - longs,
+    }
+    columns.update(etl.normalize_times(
+        seconds.astype(np.float64), seconds // 3600, seconds % 3600 // 60, seconds % 60))
+    for index, name in enumerate(etl.DAYS_OF_WEEK):
+        columns[name] = days == index
+    for index, name in enumerate(etl.MONTHS):
+        columns[name] = months == index + 1
+    return np.stack([np.asarray(columns[name], dtype=np.float32) for name in feature_names], axis=1)
+
+
+def grid_axes(meta: Dict[str, Any]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Latitude, longitude and seconds of day of the grid nodes"""
+    lats = np.linspace(meta['lat'][0], meta['lat'][1], meta['lat_cells'])
+    longs = np.linspace(meta['long'][0], meta['long'][1], meta['long_cells'])
+    seconds = np.round(np.arange(meta['time_buckets']) * DAY_SECONDS / meta['time_buckets']).astype(np.int64)
+    return lats, longs, seconds
+
+
+def predict_rows(predict: Callable[[np.ndarray], np.ndarray], rows: np.ndarray, batch_size: int) -> np.ndarray:
+    return np.concatenate([predict(rows[start:start + batch_size]) for start in range(0, len(rows), batch_size)])
+
+
+def build(predict: Callable[[np.ndarray], np.ndarray], meta: Dict[str, Any], directory: str,
+          batch_size=65536) -> np.ndarray:
+    """Writes the table of `predict` over the grid of `meta` and the metadata to `directory`"""
+    os.makedirs(directory, exist_ok=True)
+    lats, longs, seconds = grid_axes(meta)
+    table = np.lib.format.open_memmap(
+        os.path.join(directory, TABLE_FILE),
+        mode='w+',
+        dtype=meta['dtype'],
+        shape=(len(etl.DAYS_OF_WEEK), len(etl.MONTHS), len(seconds), len(lats), len(longs))
+    )
+    grid_seconds, grid_lats, grid_longs = [axis.reshape(-1) for axis in np.meshgrid(seconds, lats, longs, indexing='ij')]
+    for day in range(len(etl.DAYS_OF_WEEK)):
+        for month in range(1, len(etl.MONTHS) + 1):
+            rows = encode_requests(
+                grid_lats, grid_longs, grid_seconds,
+                np.full(len(grid_seconds), day), np.full(len(grid_seconds), month),
+                meta['year'], meta['encoding'], meta['features']
+            )
+            table[day, month - 1] = predict_rows(predict, rows, batch_size).reshape(table.shape[2:])
+    table.flush()
+    with open(os.path.join(directory, META_FILE), 'w') as f:
+        json.dump(meta, f, indent=2, sort_keys=True)
+    return table
+
+
+def axis_position(values: np.ndarray, start: float, step: float, size: int) -> np.ndarray:
+    """Fractional grid index of `values`, clamped to the grid"""
+    if size == 1 or step == 0:
+        return np.zeros(len(values))
+    return np.clip((values - start) / step, 0, size - 1)
+
+
+class LookupScorer:
+    """Scores trips from a memory-mapped table written by build()"""
+
+    def __init__(self, directory: str, interpolate=False):
+        with open(os.path.join(directory, META_FILE)) as f:
+            self.meta = json.load(f)
+        if self.meta['version'] != VERSION:
+            raise ValueError("Unsupported lookup table version {}".format(self.meta['version']))
+        self.table = np.load(os.path.join(directory, TABLE_FILE), mmap_mode='r')
+        self.interpolate = interpolate
+        lats, longs, seconds = grid_axes(self.meta)
+        self._axes = [
+            (0., DAY_SECONDS / len(seconds), len(seconds)),
+            (lats[0], lats[1] - lats[0] if len(lats) > 1 else 0., len(lats)),
+            (longs[0], longs[1] - longs[0] if len(longs) > 1 else 0., len(longs)),
+        ]
+
+    def score(self, lats: np.ndarray, longs: np.ndarray, seconds: np.ndarray, days: np.ndarray,
+              months: np.ndarray, interpolate=None) -> np.ndarray:
+        """Probability of a cash payment for each trip. `days` count from Monday (0), `months` from 1"""
+        interpolate = self.interpolate if interpolate is None else interpolate
+        days = np.asarray(days, dtype=np.int64)
+        months = np.asarray(months, dtype=np.int64) - 1
+        positions = [
+            axis_position(np.asarray(values, dtype=np.float64), *axis)
+            for values, axis in zip([seconds, lats, longs], self._axes)
+        ]
+        if not interpolate:
+            time_index, lat_index, long_index = [np.rint(position).astype(np.int64) for position in positions]
+            return self.table[days, months, time_index, lat_index, long_index].astype(np.float32)
+
+        # Trilinear over time, latitude and longitude. The last time node is
+        # not blended with midnight, which belongs to the next day.
+        lower, weights = [], []
+        for position, (_, _, size) in zip(positions, self._axes):
+            index = np.minimum(np.floor(position).astype(np.int64), max(size - 2, 0))
+            lower.append(index)
+            weights.append(position - index)
+        scores = np.zeros(len(days))
+        for corner in range(8):
+            indices, weight = [], np.ones(len(days))
+            for axis, (index, fraction) in enumerate(zip(lower, weights)):
+                upper = (corner >> axis) & 1
+                size = self._axes[axis][2]
+                indices.append(np.minimum(index + upper, size - 1))
+                weight = weight * (fraction if upper else 1. - fraction)
+            scores += weight * self.table[days, months, indices[0], indices[1], indices[2]]
+        return scores.astype(np.float32)
+
+
+def accuracy_report(scorer: LookupScorer, predict: Callable[[np.ndarray], np.ndarray], rows=100000, seed=0,
+                    batch_size=65536) -> Dict[str, Any]:
+    """Errors of the table against direct model calls on random trips in the grid's range.
+
+    Start times are drawn at the 15 minute resolution of the trip data, so
+    with the default 96 time buckets the errors come from the latitude and
+    longitude grid and the table's dtype.
+    """
+    meta = scorer.meta
+    rng = np.random.default_rng(seed)
+    lats = rng.uniform(meta['lat'][0], meta['lat'][1], rows)
+    longs = rng.uniform(meta['long'][0], meta['long'][1], rows)
+    seconds = rng.integers(0, DAY_SECONDS // TRIP_TIME_SECONDS, rows) * TRIP_TIME_SECONDS
+    days = rng.integers(0, len(etl.DAYS_OF_WEEK), rows)
+    months = rng.integers(1, len(etl.MONTHS) + 1, rows)
+
+    start = time.time()
+    direct = predict_rows(
+        predict,
+        encode_requests(lats, longs, seconds, days, months, meta['year'], meta['encoding'], meta['features']),
+        batch_size
+    )
+    report = {'rows': rows, 'model_rows_per_sec': rows / (time.time() - start)}
+    for name, interpolate in [('nearest', False), ('interpolated', True)]:
+        start = time.time()
+        scores = scorer.score(lats, longs, seconds, days, months, interpolate=interpolate)
+        elapsed = time.time() - start
+        errors = np.abs(scores - direct)
+        report[name] = {
+            'rows_per_sec': rows / elapsed,
+            'mean_abs_error': float(errors.mean()),
+            'p99_abs_error': float(np.percentile(errors, 99)),
+            'max_abs_error': float(errors.max()),
+            # Share of trips on the same side of 0.5 as the model
+            'decision_agreement': float(np.mean((scores >= .5) == (direct >= .5))),
+        }
+    return report
+
+
+def run(options: Dict[str, Any]) -> Dict[str, Any]:
+    """Builds the table of the latest model exported to options['model_dir'] and reports its accuracy"""
+    from trainer import serving
+    from trainer.data import features
+
+    features.select(options['features'].split(',') if options['features'] else None)
+    encoding = read_encoding(options['encoding'])
+    lat_range = options['lat_range'] or [encoding['pickup_latitude']['min'], encoding['pickup_latitude']['max']]
+    long_range = options['long_range'] or [encoding['pickup_longitude']['min'], encoding['pickup_longitude']['max']]
+    model_path = serving.latest_version(options['model_dir'])
+    meta = {
+        'version': VERSION,
+        'model': serving.version_id(model_path),
+        'year': options['year'],
+        'encoding': encoding,
+        'features': features.names(),
+        'lat': [float(value) for value in lat_range],
+        'long': [float(value) for value in long_range],
+        'lat_cells': options['lat_cells'],
+        'long_cells': options['long_cells'],
+        'time_buckets': options['time_buckets'],
+        'dtype': options['dtype'],
+    }
+
+    predict = serving.load_model(model_path)
+    start = time.time()
+    table = build(predict, meta, options['output_dir'], options['batch_size'])
+    logging.info("Wrote a %s table of %.1f MB in %.1f secs to %s", 'x'.join(map(str, table.shape)),
+                 table.nbytes / float(1 << 20), time.time() - start, options['output_dir'])
+
+    report = accuracy_report(LookupScorer(options['output_dir']), predict, options['report_rows'],
+                             batch_size=options['batch_size'])
+    report['table_bytes'] = table.nbytes
+    with open(os.path.join(options['output_dir'], REPORT_FILE), 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    logging.info("Lookup table accuracy: %s", report)
+    return report
+
+
+def parse_range(text: str) -> List[float]:
+    values = [float(value) for value in text.split(',')]
+    if len(values) != 2 or values[0] >= values[1]:
+        raise argparse.ArgumentTypeError("Expected `min,max`, got {}".format(text))
+    return values
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--model-dir',
+        type=str,
+        required=True,
+        help='Exported model: a SavedModel directory, or a directory of numbered SavedModel versions')
+    parser.add_argument(
+        '--encoding',
+        type=str,
+        required=True,
+        help='trainer.data.etl _manifest.json, or a JSON file of its `encoding`, the features were encoded with')
+    parser.add_argument(
+        '--output-dir',
+        type=str,
+        required=True,
+        help='Directory for lookup_table.npy, lookup_table.json and lookup_table_report.json')
+    parser.add_argument(
+        '--features',
+        type=str,
+        help='Comma separated features the model was trained on. Default: all features',
+        default='')
+    parser.add_argument(
+        '--year',
+        type=int,
+        help='Year of the trips the table scores. Default: the current year',
+        default=datetime.date.today().year)
+    parser.add_argument(
+        '--lat-range',
+        type=parse_range,
+        help='`min,max` pickup latitude of the grid. Default: the encoding\'s latitude range')
+    parser.add_argument(
+        '--long-range',
+        type=parse_range,
+        help='`min,max` pickup longitude of the grid. Default: the encoding\'s longitude range')
+    parser.add_argument(
+        '--lat-cells',
+        type=int,
+        help='Latitude nodes of the grid. Default: 64',
+        default=64)
+    parser.add_argument(
+        '--long-cells',
+        type=int,
+        help='Longitude nodes of the grid. Default: 64',
+        default=64)
+    parser.add_argument(
+        '--time-buckets',
+        type=int,
+        help='Time of day nodes of the grid; 96 matches the 15 minute trip times. Default: 96',
+        default=96)
+    parser.add_argument(
+        '--dtype',
+        type=str,
+        choices=DTYPES,
+        help='Table dtype. Default: float16',
+        default='float16')
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        help='Rows per model call. Default: 65536',
+        default=65536)
+    parser.add_argument(
+        '--report-rows',
+        type=int,
+        help='Random trips the table is compared with direct model calls on. Default: 100000',
+        default=100000)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
+    run(vars(get_args()))
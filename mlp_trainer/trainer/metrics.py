@@ -0,0 +1,140 @@
+from typing import Dict, List, Tuple
+
+import tensorflow as tf
+
+# Prediction histogram resolution; thresholds are multiples of 1 / DEFAULT_BINS
+DEFAULT_BINS = 200
+
+# Thresholds the precision/recall curve is reported at
+CURVE_THRESHOLDS = [round(0.05 * i, 2) for i in range(1, 20)]
+
+
+class ConfusionHistogram(tf.keras.metrics.Metric):
+    """Histogram of predicted probabilities, split by label.
+
+    Each prediction is binned once; the confusion matrix at any threshold
+    that is a multiple of 1 / num_bins, and every metric derived from it,
+    is a cumulative sum over the bins. Bin i holds predictions in
+    (i / num_bins, (i + 1) / num_bins], so a prediction is positive when it
+    is above the threshold, as in tf.keras.metrics.Precision and Recall.
+    """
+
+    def __init__(self, num_bins=DEFAULT_BINS, name='confusion_histogram', **kwargs):
+        super(ConfusionHistogram, self).__init__(name=name, **kwargs)
+        self.num_bins = num_bins
+        # Row 0 counts negatives, row 1 positives
+        self.histogram = self.add_weight(
+            'histogram',
+            shape=(2, num_bins),
+            initializer='zeros',
+            dtype=tf.float32,
+        )
+
+    def update_state(self, y_true, y_pred, sample_weight=None):
+        y_true = tf.reshape(tf.cast(y_true, tf.int32), [-1])
+        y_pred = tf.reshape(tf.cast(y_pred, tf.float32), [-1])
+        # Bin edges as float32 thresholds, so a prediction equal to a threshold
+        # falls below it exactly as in a float32 `y_pred > threshold`
+        edges = tf.constant([i / self.num_bins for i in range(self.num_bins)], dtype=tf.float32)
+        bins = tf.clip_by_value(
+            tf.searchsorted(edges, y_pred, side='left', out_type=tf.int32) - 1,
+            0,
+            self.num_bins - 1
+        )
+        if sample_weight is None:
+            weights = tf.ones_like(y_pred)
+        else:
+            weights = tf.reshape(tf.cast(sample_weight, tf.float32), [-1]) * tf.ones_like(y_pred)
+        counts = tf.math.unsorted_segment_sum(
+            weights,
+            y_true * self.num_bins + bins,
+            2 * self.num_bins
+        )
+        return self.histogram.assign_add(tf.reshape(counts, (2, self.num_bins)))
+
+    def result(self):
+        return self.histogram
+
+    def reset_states(self):
+        self.histogram.assign(tf.zeros((2, self.num_bins)))
+
+    def get_config(self):
+        config = super(ConfusionHistogram, self).get_config()
+        config['num_bins'] = self.num_bins
+        return config
+
+    def _cumulative(self) -> Tuple[tf.Tensor, tf.Tensor]:
+        # Element i counts predictions > i / num_bins
+        negatives = tf.cumsum(self.histogram[0], reverse=True)
+        positives = tf.cumsum(self.histogram[1], reverse=True)
+        return negatives, positives
+
+    def _bin(self, threshold: float) -> int:
+        return min(self.num_bins, max(0, int(round(threshold * self.num_bins))))
+
+    def confusion(self, threshold=0.5) -> Dict[str, tf.Tensor]:
+        """True/false positives/negatives when predicting positive above threshold"""
+        negatives, positives = self._cumulative()
+        total_negatives = tf.reduce_sum(self.histogram[0])
+        total_positives = tf.reduce_sum(self.histogram[1])
+        i = self._bin(threshold)
+        if i == self.num_bins:
+            true_pos = false_pos = tf.constant(0.)
+        else:
+            true_pos = positives[i]
+            false_pos = negatives[i]
+        return {
+            'true_positives': true_pos,
+            'false_positives': false_pos,
+            'true_negatives': total_negatives - false_pos,
+            'false_negatives': total_positives - true_pos,
+        }
+
+    def scores(self, threshold=0.5) -> Dict[str, tf.Tensor]:
+        """Accuracy, precision, recall and F1 at threshold"""
+        counts = self.confusion(threshold)
+        tp = counts['true_positives']
+        fp = counts['false_positives']
+        tn = counts['true_negatives']
+        fn = counts['false_negatives']
+        precision = tf.math.divide_no_nan(tp, tp + fp)
+        recall = tf.math.divide_no_nan(tp, tp + fn)
+        return {
+            'accuracy': tf.math.divide_no_nan(tp + tn, tp + fp + tn + fn),
+            'precision': precision,
+            'recall': recall,
+            'f1': tf.math.divide_no_nan(2. * precision * recall, precision + recall),
+        }
+
+    def auc(self) -> tf.Tensor:
+        """Area under the ROC curve through every bin edge (trapezoidal rule)"""
+        negatives, positives = self._cumulative()
+        zero = tf.zeros([1])
+        fpr = tf.math.divide_no_nan(tf.concat([negatives, zero], 0), negatives[0])
+        tpr = tf.math.divide_no_nan(tf.concat([positives, zero], 0), positives[0])
+        return tf.reduce_sum((fpr[:-1] - fpr[1:]) * (tpr[:-1] + tpr[1:]) / 2.)
+
+
+def eval_metric_ops(labels, predictions, prefix='test_', num_bins=DEFAULT_BINS,
+                    threshold=0.5, curve_thresholds: List[float] = CURVE_THRESHOLDS) -> Dict[str, Tuple[tf.Tensor, tf.Operation]]:
+    """Estimator eval_metric_ops for every metric, all from one ConfusionHistogram"""
+    histogram = ConfusionHistogram(num_bins=num_bins)
+    # The Estimator only initializes and resets the variables of metric ops it
+    # is given as Metric objects; these ops are (value, update_op) pairs
+    for variable in histogram.variables:
+        tf.compat.v1.add_to_collection(tf.compat.v1.GraphKeys.LOCAL_VARIABLES, variable)
+        tf.compat.v1.add_to_collection(tf.compat.v1.GraphKeys.METRIC_VARIABLES, variable)
+    update_op = histogram.update_state(labels, predictions)
+
+    values = {}
+    for name, value in histogram.scores(threshold).items():
+        values[name] = value
+    for name, value in histogram.confusion(threshold).items():
+        values[name] = value
+    values['auc'] = histogram.auc()
+    for curve_threshold in curve_thresholds:
+        scores = histogram.scores(curve_threshold)
+        values['precision_at_{}'.format(curve_threshold)] = scores['precision']
+        values['recall_at_{}'.format(curve_threshold)] = scores['recall']
+
+    return {prefix + name: (value, update_op) for name, value in values.items()}
@@ -3,9 +3,15 @@ import datetime
 from typing import Tuple
 
 import tensorflow as tf
-import tensorflow_addons as tfa
 
 import trainer.base_model as base_model
+import trainer.distribute as distribute
+import trainer.metrics as metrics
+import trainer.profiling as profiling
+import trainer.threads as threads
+import trainer.timing as timing
+import trainer.warm_start as warm_start
+import trainer.data.downsampling as downsampling
 import trainer.data.features as features
 import trainer.data.bigquery as data
 import trainer.data.bigquery_generator as bq_generator
@@ -23,6 +29,11 @@ def model_fn(features, labels, mode, params={}):
     training = (mode == tf.estimator.ModeKeys.TRAIN)
     preds = model(features, training=training)
 
+    negative_rate = params.get('negative_rate', 1.)
+    if negative_rate < 1. and params['downsample_correction'] == 'export' and not training:
+        # Trained on downsampled negatives without weights; undo the shift for eval and serving
+        preds = downsampling.correct_probability(preds, negative_rate)
+
     if mode == tf.estimator.ModeKeys.PREDICT:
         return tf.estimator.EstimatorSpec(
             mode=mode,
@@ -32,45 +43,18 @@ def model_fn(features, labels, mode, params={}):
     loss = tf.keras.losses.BinaryCrossentropy(
         reduction=tf.keras.losses.Reduction.NONE
     )(labels, preds)
+    if negative_rate < 1. and params['downsample_correction'] == 'loss' and training:
+        # Each kept negative stands in for 1 / negative_rate of them
+        loss = loss * downsampling.weights(labels, negative_rate)
     # print(loss)
     loss = tf.reduce_sum(loss) * (1. / params['batch_size'])
 
     # print(labels)
     # print(tf.reshape(labels, tf.TensorShape([None,1])))
 
-    eval_ops = {}
     if mode == tf.estimator.ModeKeys.EVAL:
-        acc = tf.keras.metrics.BinaryAccuracy()
-        acc.update_state(labels, preds)
-        eval_ops['test_accuracy'] = acc
-        f1 = tfa.metrics.FBetaScore(
-            num_classes=1,
-            average='micro',
-            beta=1.0,
-        )
-        f1.update_state(labels, preds)
-        eval_ops['test_f1'] = f1
-        auc = tf.keras.metrics.AUC()
-        auc.update_state(labels, preds)
-        eval_ops['test_auc'] = auc
-        precision = tf.keras.metrics.Precision()
-        precision.update_state(labels, preds)
-        eval_ops['test_precision'] = precision
-        recall = tf.keras.metrics.Recall()
-        recall.update_state(labels, preds)
-        eval_ops['test_recall'] = recall
-        false_negs = tf.keras.metrics.FalseNegatives()
-        false_negs.update_state(labels, preds)
-        eval_ops['test_false_negatives'] = false_negs
-        false_pos = tf.keras.metrics.FalsePositives()
-        false_pos.update_state(labels, preds)
-        eval_ops['test_false_positives'] = false_pos
-        true_neg = tf.keras.metrics.TrueNegatives()
-        true_neg.update_state(labels, preds)
-        eval_ops['test_true_negatives'] = true_neg
-        true_pos = tf.keras.metrics.TruePositives()
-        true_pos.update_state(labels, preds)
-        eval_ops['test_true_positives'] = true_pos
+        # One prediction histogram backs every metric and the precision/recall curve
+        eval_ops = metrics.eval_metric_ops(labels, preds)
         return tf.estimator.EstimatorSpec(
             mode=mode,
             loss=loss,
@@ -91,9 +75,6 @@ def model_fn(features, labels, mode, params={}):
             optimizer = tf.optimizers.SGD(
                 learning_rate=params['learning_rate']
             )
-        # optimizer = tf.train.experimental.enable_mixed_precision_graph_rewrite(
-        #     optimizer
-        # )
         optimizer.iterations = tf.compat.v1.train.get_or_create_global_step()
 
         update_ops = model.get_updates_for(None) + model.get_updates_for(features)
@@ -126,7 +107,9 @@ def input_fn_train_avro():
         global_params['cycle_length'],
         NUM_WORKERS,
         TASK_INDEX,
-    )
+        sample_fraction=global_params['sample_fraction'],
+        negative_rate=global_params['negative_rate'],
+    ).with_options(threads.dataset_options(global_params))
     return dataset
 
 
@@ -142,7 +125,8 @@ def input_fn_eval_avro():
         global_params['cycle_length'],
         NUM_WORKERS,
         TASK_INDEX,
-    )
+        sample_fraction=global_params['sample_fraction'],
+    ).with_options(threads.dataset_options(global_params))
     return dataset
 
 
@@ -157,7 +141,9 @@ def input_fn_train_bq():
         global_params['cycle_length'],
         NUM_WORKERS,
         TASK_INDEX,
-    )
+        sample_fraction=global_params['sample_fraction'],
+        negative_rate=global_params['negative_rate'],
+    ).with_options(threads.dataset_options(global_params))
     return dataset
 
 
@@ -172,7 +158,8 @@ def input_fn_eval_bq():
         global_params['cycle_length'],
         NUM_WORKERS,
         TASK_INDEX,
-    )
+        sample_fraction=global_params['sample_fraction'],
+    ).with_options(threads.dataset_options(global_params))
     return dataset
 
 def get_session_config(job_name: str, task_index: int):
@@ -187,6 +174,31 @@ def get_session_config(job_name: str, task_index: int):
     return None
 
 
+def get_train_hooks(params: dict) -> list:
+    hooks = []
+    profile_window = profiling.get_window(params)
+    if profile_window is not None:
+        hooks.append(profiling.ProfileWindowHook(profile_window))
+    if params.get('throughput_dir'):
+        hooks.append(timing.ThroughputHook(
+            params['throughput_dir'],
+            '{}-{}'.format(JOB_NAME or 'local', max(TASK_INDEX, 0)),
+            params['batch_size']
+        ))
+    return hooks
+
+
+def get_run_session_config(params: dict):
+    """Sizes the Estimator's session threadpools and turns on XLA auto-clustering with --jit-compile"""
+    session_config = threads.session_config(params)
+    if params.get('jit_compile') is not True:
+        return session_config
+    if params.get('grad_accum_steps', 1) > 1:
+        tf.get_logger().warning("--grad-accum-steps is only supported by the custom training loop and is ignored")
+    session_config.graph_options.optimizer_options.global_jit_level = tf.compat.v1.OptimizerOptions.ON_1
+    return session_config
+
+
 def make_job_output(job_dir: str, add_suffix: bool):
     if add_suffix is True:
         return "{}/{}".format(
@@ -238,22 +250,16 @@ def train_and_evaluate_dist(
     BUCKET_NAME = bucket_name
     PREFIX = prefix
 
-    # strategy = tf.distribute.MirroredStrategy()
-
-    # strategy = tf.distribute.experimental.MultiWorkerMirroredStrategy()
-    strategy = tf.distribute.experimental.ParameterServerStrategy()
+    strategy = distribute.get_strategy(params['distribute_strategy'], 'parameter-server')
 
     tf.get_logger().info("NTC_DEBUG: Number of devices in strategy: {}".format(strategy.num_replicas_in_sync))
 
-    tf.summary.trace_on(
-        graph=False,
-        profiler=False
-    )
-
     train_steps_per_epoch = math.ceil(
-                data.get_sample_count(
+                get_sample_count(
                     table_id,
-                    partition='train'
+                    partition='train',
+                    sample_fraction=params['sample_fraction'],
+                    negative_rate=params['negative_rate'],
                 ) / params['batch_size']
             )
     
@@ -265,6 +271,7 @@ def train_and_evaluate_dist(
             train_steps_per_epoch*.25
         ),
         # session_config=get_session_config(job_name, task_index),
+        session_config=get_run_session_config(params),
         train_distribute=strategy,
         eval_distribute=strategy
     )
@@ -272,7 +279,8 @@ def train_and_evaluate_dist(
     classifier = tf.estimator.Estimator(
         model_fn=model_fn, 
         model_dir=make_job_output(job_dir, global_params['no_generated_job_path']), 
-        config=config
+        config=config,
+        warm_start_from=warm_start.estimator_settings(params),
     )
 
     if global_params['data_source'] == 'bigquery':
@@ -286,14 +294,16 @@ def train_and_evaluate_dist(
         classifier,
         train_spec=tf.estimator.TrainSpec(
             input_fn=input_fn_train,
-            max_steps=train_steps_per_epoch * params['epochs']
+            max_steps=warm_start.max_steps(train_steps_per_epoch, params),
+            hooks=get_train_hooks(params),
         ),
         eval_spec=tf.estimator.EvalSpec(
             input_fn=input_fn_eval,
             steps=math.ceil(
-                data.get_sample_count(
+                get_sample_count(
                     table_id,
-                    partition='validation'
+                    partition='validation',
+                    sample_fraction=params['sample_fraction'],
                 ) / params['batch_size']
             ),
             # throttle_secs=60,
@@ -301,11 +311,22 @@ def train_and_evaluate_dist(
     )
 
 
+def get_sample_count(table_id: str, partition: str, sample_fraction=1., negative_rate=1.) -> int:
+    """Rows of `partition`: from the Avro manifest when there is one, else a BigQuery COUNT"""
+    if global_params.get('data_source') == 'avro' and BUCKET_NAME:
+        count = avro_generator.get_sample_count(BUCKET_NAME, PREFIX, partition, sample_fraction, negative_rate)
+        if count is not None:
+            return count
+    return data.get_sample_count(table_id, partition, sample_fraction, negative_rate)
+
+
 def get_train_steps(table_id: str, params: dict) -> Tuple[int, int]:
     train_steps_per_epoch = math.ceil(
-            data.get_sample_count(
+            get_sample_count(
                 table_id,
-                partition='train'
+                partition='train',
+                sample_fraction=params['sample_fraction'],
+                negative_rate=params['negative_rate'],
             ) / params['batch_size']
         )
 
@@ -329,6 +350,7 @@ def create_mlp(job_dir: str, checkpoint_steps: int, params: dict):
         save_summary_steps=params['summary_write_steps'],
         # Evaluate halfway through the epoch
         save_checkpoints_steps=checkpoint_steps,
+        session_config=get_run_session_config(params),
     )
 
     mlp = tf.estimator.Estimator(
@@ -336,6 +358,8 @@ def create_mlp(job_dir: str, checkpoint_steps: int, params: dict):
         model_dir=job_dir, 
         config=config,
         params=params,
+        # Ignored once the job directory has a checkpoint, so a restarted warm start resumes
+        warm_start_from=warm_start.estimator_settings(params),
     )
 
     return mlp
@@ -373,11 +397,6 @@ def train_and_evaluate_local(
     BUCKET_NAME = bucket_name
     PREFIX = prefix
 
-    tf.summary.trace_on(
-        graph=False,
-        profiler=False
-    )
-
     train_steps_per_epoch, checkpoint_steps = get_train_steps(table_id, params)
     classifier = create_mlp(
         make_job_output(job_dir, global_params['no_generated_job_path']), 
@@ -402,23 +421,97 @@ def train_and_evaluate_local(
     #     )
     # ]
 
-    tf.estimator.train_and_evaluate(
-        classifier,
-        train_spec=tf.estimator.TrainSpec(
+    eval_steps = math.ceil(
+        get_sample_count(
+            table_id,
+            partition='validation',
+            sample_fraction=params['sample_fraction'],
+        ) / params['batch_size']
+    )
+
+    if global_params['sidecar_eval'] is True:
+        # Checkpoints are evaluated by the sidecar evaluator process
+        classifier.train(
             input_fn=input_fn_train,
-            max_steps=train_steps_per_epoch * params['epochs']
-        ),
-        eval_spec=tf.estimator.EvalSpec(
-            input_fn=input_fn_eval,
-            steps=math.ceil(
-                data.get_sample_count(
-                    table_id,
-                    partition='validation'
-                ) / params['batch_size']
+            max_steps=warm_start.max_steps(train_steps_per_epoch, params),
+            hooks=get_train_hooks(params),
+        )
+    else:
+        tf.estimator.train_and_evaluate(
+            classifier,
+            train_spec=tf.estimator.TrainSpec(
+                input_fn=input_fn_train,
+                max_steps=warm_start.max_steps(train_steps_per_epoch, params),
+                hooks=get_train_hooks(params),
             ),
-            # throttle_secs=60,
-            # exporters=exporters,
+            eval_spec=tf.estimator.EvalSpec(
+                input_fn=input_fn_eval,
+                steps=eval_steps,
+                # throttle_secs=60,
+                # exporters=exporters,
+            ),
+        )
+
+    if params['warm_start_baseline']:
+        report_warm_start(classifier, input_fn_eval, eval_steps, params)
+
+
+def report_warm_start(classifier: tf.estimator.Estimator, input_fn_eval, eval_steps: int, params: dict):
+    """Evaluates the warm-started, previous and fully retrained models on the same validation rows"""
+    def evaluate(name, checkpoint_path=None):
+        return classifier.evaluate(input_fn=input_fn_eval, steps=eval_steps, checkpoint_path=checkpoint_path, name=name)
+
+    warm_start.report(
+        classifier.model_dir,
+        evaluate('warm_start'),
+        evaluate('warm_start_baseline', warm_start.checkpoint_path(params['warm_start_baseline'])),
+        previous=evaluate('warm_start_previous', warm_start.checkpoint_path(params['warm_start_from'])),
+    )
+
+
+def evaluate_checkpoint(
+    table_id: str,
+    job_dir: str,
+    bucket_name: str,
+    prefix: str,
+    params: dict,
+    checkpoint_path: str,
+) -> dict:
+    """Evaluates one checkpoint on the validation partition, as train_and_evaluate does.
+
+    Results are also written as summaries to `eval_sidecar` in the job directory.
+    """
+    global global_table_id
+    global global_params
+    global TASK_INDEX
+    global NUM_WORKERS
+    global BUCKET_NAME
+    global PREFIX
+    global_table_id = table_id
+    global_params = params
+    TASK_INDEX = 0
+    NUM_WORKERS = 1
+    BUCKET_NAME = bucket_name
+    PREFIX = prefix
+
+    classifier = create_mlp(job_dir, 1, params)
+
+    if global_params['data_source'] == 'bigquery':
+        input_fn_eval = input_fn_eval_bq
+    elif global_params['data_source'] == 'avro':
+        input_fn_eval = input_fn_eval_avro
+
+    return classifier.evaluate(
+        input_fn=input_fn_eval,
+        steps=math.ceil(
+            get_sample_count(
+                table_id,
+                partition='validation',
+                sample_fraction=params['sample_fraction'],
+            ) / params['batch_size']
         ),
+        checkpoint_path=checkpoint_path,
+        name='sidecar',
     )
 
 
@@ -7,6 +7,7 @@ import tensorflow as tf
 import trainer.data.bigquery as data
 import trainer.data.bigquery_generator as generator
 import trainer.base_model as base_model
+import trainer.distribute as distribute
 
 
 def make_job_output(job_dir):
@@ -25,7 +26,11 @@ def train_and_evaluate(
     num_workers=1,
 ):
 
-    strategy = tf.distribute.MirroredStrategy()
+    strategy = distribute.get_strategy(
+        params['distribute_strategy'],
+        'mirrored',
+        supported=['multi-worker', 'mirrored', 'one-device']
+    )
 
     with strategy.scope():
         model = base_model.get(params)
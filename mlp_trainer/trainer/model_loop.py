@@ -1,4 +1,5 @@
-import time
+import itertools
+import signal
 from typing import Tuple
 from os import walk
 
@@ -8,50 +9,59 @@ import tensorflow as tf
 
 # from talos.model.normalizers import lr_normalizer
 
+import trainer.allreduce as allreduce
+import trainer.base_model as base_model
+import trainer.distribute as distribute
+import trainer.input_service as input_service
+import trainer.io_worker as io_worker
+import trainer.metrics as metrics
+import trainer.profiling as profiling
+import trainer.threads as threads
+import trainer.timing as timing
+import trainer.warm_start as warm_start
 import trainer.data.bigquery as data
 import trainer.data.bigquery_generator as generator
+import trainer.data.avro as avro_generator
+import trainer.data.downsampling as downsampling
+import trainer.data.features as features
+import trainer.data.position as position
+import trainer.data.source as source
 
 
-def base_model() -> tf.keras.Sequential:
-    return tf.keras.Sequential([
-        tf.keras.layers.Dense(
-            global_params['dense_neurons_1'],
-            input_shape=(26,),
-            kernel_initializer=global_params['kernel_initial_1']
-        ),
-        tf.keras.layers.BatchNormalization(axis=1),
-        tf.keras.layers.Activation(activation=global_params['activation']),
-        tf.keras.layers.Dropout(float(global_params['dropout_rate_1'])),
-        tf.keras.layers.Dense(
-            global_params['dense_neurons_2'],
-            kernel_initializer=global_params['kernel_initial_2'],
-            activation=global_params['activation']
-        ),
-        tf.keras.layers.Dropout(float(global_params['dropout_rate_2'])),
-        tf.keras.layers.Dense(
-            global_params['dense_neurons_3'],
-            kernel_initializer=global_params['kernel_initial_3'],
-            activation=global_params['activation']
-        ),
-        tf.keras.layers.Dense(
-            1,
-            activation='sigmoid'
-        )
-    ])
-
 global_table_id = ""
 global_params = {}
+BUCKET_NAME = ''
+PREFIX = ''
+
+
+def get_dataset(partition: str, with_position=False, negative_rate=1., stage=None) -> tf.data.Dataset:
+    if input_service.service is not None:
+        # Rows are decoded by the input workers; positions are not tracked
+        dataset = input_service.service.dataset(
+            input_service.request_config(global_params, global_table_id, BUCKET_NAME, PREFIX, negative_rate),
+            partition
+        )
+    else:
+        dataset = source.get_data(
+            global_params,
+            global_table_id,
+            BUCKET_NAME,
+            PREFIX,
+            partition,
+            with_position=with_position,
+            negative_rate=negative_rate,
+            stage=stage,
+        )
+    return dataset.with_options(threads.dataset_options(global_params))
+
 
 # @tf.function
 def input_fn_train(dist=False, strategy=None):
     # return tf.data.Dataset.from_tensors(({"year_norm":[1.]}, [1.]))
-    dataset = generator.get_data(
-        global_table_id,
+    dataset = get_dataset(
         'train',
-        global_params['batch_size'],
-        0,
-        global_params['chunk_size'],
-        global_params['cycle_length']
+        with_position=global_params['resumable'],
+        negative_rate=global_params['negative_rate'],
     )
     if dist is True:
         dataset = strategy.experimental_distribute_dataset(dataset)
@@ -61,19 +71,95 @@ def input_fn_train(dist=False, strategy=None):
 # @tf.function
 def input_fn_eval(dist=False, strategy=None):
     # return tf.data.Dataset.from_tensors(({"year_norm":[1.]}, [1.]))
-    dataset = generator.get_data(
-        global_table_id,
-        'test',
-        global_params['batch_size'],
-        0,
-        global_params['chunk_size'],
-        global_params['cycle_length']
-    )
+    dataset = get_dataset('test')
     if dist is True:
         dataset = strategy.experimental_distribute_dataset(dataset)
     return dataset
 
 
+def serving_predictions(predictions):
+    """Predictions as served: with --downsample-correction=export, corrected for the downsampled negatives"""
+    if global_params['negative_rate'] < 1. and global_params['downsample_correction'] == 'export':
+        return downsampling.correct_probability(predictions, global_params['negative_rate'])
+    return predictions
+
+
+def set_input_position(input_position):
+    """Points the readers at the position to tag rows with and resume from"""
+    generator.input_position = input_position
+    avro_generator.input_position = input_position
+
+
+def profile_input_memory(memory: profiling.MemoryProfiler, steps: int):
+    """Runs each input stage of the train pipeline on its own for about `steps` batches"""
+    memory.record('configured_buffer_capacity',
+                  profiling.configured_buffer_capacity(global_params, features.num_features()))
+    stages = profiling.INPUT_STAGES
+    if input_service.service is not None:
+        # The input workers read, interleave and shuffle in their own processes
+        stages = ['batch']
+        memory.record('input_service_queue_chunks', input_service.QUEUE_CHUNKS)
+    for stage in stages:
+        elements = steps if stage == 'batch' else steps * global_params['batch_size']
+        memory.start_stage(stage)
+        dataset = get_dataset('train', negative_rate=global_params['negative_rate'], stage=stage)
+        count = dataset.take(elements).reduce(tf.constant(0, tf.int64), lambda count, _: count + 1)
+        memory.end_stage()
+        memory.record('{}_elements'.format(stage), int(count))
+    if global_params['data_source'] == 'bigquery' and input_service.service is None:
+        memory.record('pickled_session_bytes', generator.session_bytes)
+
+
+def variable_bytes(variables) -> int:
+    return sum(v.shape.num_elements() * v.dtype.size for v in variables)
+
+
+def finish_memory_profile(memory: profiling.MemoryProfiler, model: tf.keras.Model, optimizer):
+    memory.record('model_variable_bytes', variable_bytes(model.variables))
+    memory.record('optimizer_variable_bytes', variable_bytes(optimizer.variables()))
+    memory.stop()
+
+
+def evaluate_checkpoint(table_id: str, bucket_name: str, prefix: str, params: dict, checkpoint_path: str) -> dict:
+    """Evaluates one checkpoint written by train_and_evaluate on the test partition"""
+    global global_table_id
+    global global_params
+    global BUCKET_NAME
+    global PREFIX
+    global_table_id = table_id
+    global_params = params
+    BUCKET_NAME = bucket_name
+    PREFIX = prefix
+
+    model = base_model.get(global_params)
+    # The optimizer slots in the checkpoint are not needed
+    tf.train.Checkpoint(model=model).restore(checkpoint_path).expect_partial()
+
+    loss_object = tf.keras.losses.BinaryCrossentropy()
+    test_loss = tf.keras.metrics.Mean(name='test_loss')
+    histogram = metrics.ConfusionHistogram()
+
+    @tf.function
+    def test_step(inputs):
+        features, labels = inputs
+        predictions = serving_predictions(model(features, training=False))
+        test_loss.update_state(loss_object(labels, predictions))
+        histogram.update_state(labels, predictions)
+
+    num_test_batches = 0
+    for x in get_dataset('test'):
+        test_step(x)
+        num_test_batches += 1
+
+    outputs = {'test_loss': float(test_loss.result()), 'test_auc': float(histogram.auc())}
+    for name, value in histogram.scores().items():
+        outputs['test_{}'.format(name)] = float(value)
+    for name, value in histogram.confusion().items():
+        outputs['test_{}'.format(name)] = float(value)
+    outputs['batches'] = num_test_batches
+    return outputs
+
+
 def get_session_config(job_name: str, task_index: int):
     if job_name == 'chief':
         return tf.compat.v1.ConfigProto(device_filters=['/job:ps', '/job:chief'])
@@ -85,7 +171,75 @@ def get_session_config(job_name: str, task_index: int):
     return None
 
 
-def train_and_evaluate(table_id: str, job_dir: str, params: dict, job_name='', task_index=-1, hypertune=False):
+def make_train_step(model: tf.keras.Model, optimizer, compute_loss, train_eval_ops: list,
+                    accum_steps=1, jit_compile=False, sample_weight_fn=None, gradient_reducer=None):
+    """Builds the per-replica train step.
+
+    With `jit_compile` the forward and backward pass is XLA compiled. With
+    `accum_steps` > 1 each batch is split into that many micro-batches whose
+    gradients are summed before a single optimizer update, so peak activation
+    memory is that of one micro-batch. `compute_loss` must scale by the global
+    batch size so the summed micro-batch losses equal the full batch loss.
+    Note that BatchNormalization sees micro-batch statistics.
+    `sample_weight_fn` maps labels to the per-example weights of the train metrics.
+    `gradient_reducer`, from allreduce.get_gradient_reducer, replaces the
+    optimizer's own cross-replica gradient aggregation.
+    """
+
+    def update_metrics(labels, predictions):
+        sample_weight = sample_weight_fn(labels) if sample_weight_fn is not None else None
+        for op in train_eval_ops:
+            op.update_state(labels, predictions, sample_weight=sample_weight)
+
+    def compute_gradients(features, labels):
+        with tf.GradientTape() as tape:
+            predictions = model(features, training=True)
+            _, loss = compute_loss(labels, predictions)
+        return loss, predictions, tape.gradient(loss, model.trainable_variables)
+
+    if jit_compile is True:
+        # tf.function's jit_compile is TF 2.5+; setup.py pins 2.1, which names it experimental_compile
+        compute_gradients = tf.function(compute_gradients, experimental_compile=True)
+
+    def train_step(inputs):
+        features, labels = inputs
+
+        if accum_steps <= 1:
+            loss, predictions, gradients = compute_gradients(features, labels)
+            update_metrics(labels, predictions)
+        else:
+            batch_size = tf.shape(features)[0]
+            micro_batch_size = (batch_size + accum_steps - 1) // accum_steps
+            num_micro_batches = (batch_size + micro_batch_size - 1) // micro_batch_size
+
+            loss = tf.constant(0.0)
+            gradients = [tf.zeros_like(v) for v in model.trainable_variables]
+            for i in tf.range(num_micro_batches):
+                begin = i * micro_batch_size
+                end = tf.minimum(begin + micro_batch_size, batch_size)
+                micro_labels = labels[begin:end]
+                micro_loss, predictions, micro_gradients = compute_gradients(
+                    features[begin:end],
+                    micro_labels
+                )
+                loss += micro_loss
+                gradients = [g + mg for g, mg in zip(gradients, micro_gradients)]
+                update_metrics(micro_labels, predictions)
+
+        if gradient_reducer is None:
+            optimizer.apply_gradients(zip(gradients, model.trainable_variables))
+        else:
+            optimizer.apply_gradients(
+                zip(gradient_reducer(gradients), model.trainable_variables),
+                experimental_aggregate_gradients=False
+            )
+        return loss
+
+    return train_step
+
+
+def train_and_evaluate(table_id: str, job_dir: str, params: dict, job_name='', task_index=-1, hypertune=False,
+                       bucket_name='', prefix=''):
     """
     TODO: description
     :param table_id:
@@ -95,12 +249,18 @@ def train_and_evaluate(table_id: str, job_dir: str, params: dict, job_name='', t
 
     global global_table_id
     global global_params
+    global BUCKET_NAME
+    global PREFIX
     global_table_id = table_id
     global_params = params
-
-    # strategy = tf.distribute.MirroredStrategy()
-    strategy = tf.distribute.experimental.MultiWorkerMirroredStrategy(
-        communication=tf.distribute.experimental.CollectiveCommunication.AUTO
+    BUCKET_NAME = bucket_name
+    PREFIX = prefix
+
+    # Custom loops need a strategy that runs replica functions in this process
+    strategy = distribute.get_strategy(
+        global_params['distribute_strategy'],
+        'multi-worker',
+        supported=['multi-worker', 'mirrored', 'one-device']
     )
     tf.get_logger().info("NTC_DEBUG: Number of devices in strategy: {}".format(strategy.num_replicas_in_sync))
 
@@ -109,6 +269,25 @@ def train_and_evaluate(table_id: str, job_dir: str, params: dict, job_name='', t
     #     profiler=True
     # )
 
+    host_checkpoint = None
+    if global_params['async_io'] is True and hypertune is False:
+        # Built outside the strategy scope so checkpoints can be written
+        # from a host copy while training continues
+        with tf.device('/cpu:0'):
+            host_checkpoint = io_worker.HostCheckpoint(
+                base_model.get(global_params),
+                tf.optimizers.Adam(
+                    learning_rate=global_params['learning_rate']
+                ),
+                directory=job_dir,
+                max_to_keep=5
+            )
+
+    negative_rate = global_params['negative_rate']
+    sample_weight_fn = None
+    if negative_rate < 1. and global_params['downsample_correction'] == 'loss':
+        sample_weight_fn = lambda labels: downsampling.weights(labels, negative_rate)
+
     #https://www.tensorflow.org/tutorials/distribute/custom_training
     with strategy.scope():
         loss_object = tf.keras.losses.BinaryCrossentropy(
@@ -119,6 +298,8 @@ def train_and_evaluate(table_id: str, job_dir: str, params: dict, job_name='', t
             # equivalent of:
             # loss = tf.reduce_sum(loss_object(labels, predictions)) * (1. / global_params['batch_size'])
             per_example_loss = loss_object(labels, predictions)
+            if sample_weight_fn is not None:
+                per_example_loss = per_example_loss * sample_weight_fn(labels)
             return per_example_loss, tf.nn.compute_average_loss(per_example_loss, global_batch_size=global_params['batch_size'])
 
         train_eval_ops = [
@@ -138,13 +319,7 @@ def train_and_evaluate(table_id: str, job_dir: str, params: dict, job_name='', t
             tf.keras.metrics.TruePositives()
         ]
 
-        model = base_model()
-
-        # optimizer = tf.train.experimental.enable_mixed_precision_graph_rewrite(
-        #     tf.optimizers.Adam(
-        #         learning_rate=global_params['learning_rate']
-        #     )
-        # )
+        model = base_model.get(global_params)
 
         optimizer = tf.optimizers.Adam(
             learning_rate=global_params['learning_rate']
@@ -157,33 +332,21 @@ def train_and_evaluate(table_id: str, job_dir: str, params: dict, job_name='', t
             max_to_keep=5
         )
 
-        def train_step(inputs):
-            features, labels = inputs
-
-            with tf.GradientTape() as tape:
-                predictions = model(features, training=True)
-                batch_losses, loss = compute_loss(labels, predictions)
-
-            gradients = tape.gradient(loss, model.trainable_variables)
-            optimizer.apply_gradients(zip(gradients, model.trainable_variables))
-
-            # op = optimizer.get_updates(
-            #     loss,
-            #     model.trainable_variables)
-
-            # strategy.experimental_run_v2(op)
-
-            # tf.distribute.get_replica_context.merge_call(strategy.experimental_run_v2(op))
-
-            for op in train_eval_ops:
-                op.update_state(labels, predictions)
-            return loss
-
+        train_step = make_train_step(
+            model,
+            optimizer,
+            compute_loss,
+            train_eval_ops,
+            accum_steps=global_params['grad_accum_steps'],
+            jit_compile=global_params['jit_compile'],
+            sample_weight_fn=sample_weight_fn,
+            gradient_reducer=allreduce.get_gradient_reducer(global_params),
+        )
 
         def test_step(inputs):
             features, labels = inputs
 
-            predictions = model(features, training=False)
+            predictions = serving_predictions(model(features, training=False))
             t_loss = loss_object(labels, predictions)
 
             test_loss.update_state(t_loss)
@@ -200,106 +363,367 @@ def train_and_evaluate(table_id: str, job_dir: str, params: dict, job_name='', t
                                 axis=None)
 
 
+        @tf.function
+        def distributed_train_steps(iterator, steps):
+            # Runs up to `steps` train steps in one call to amortize Python
+            # dispatch. Returns the summed loss, the number of steps run
+            # (fewer than `steps` at the end of the data) and the train metrics.
+            total = tf.constant(0.0)
+            steps_run = tf.constant(0)
+            for _ in tf.range(steps):
+                optional_inputs = iterator.get_next_as_optional()
+                if not optional_inputs.has_value():
+                    break
+                per_replica_losses = strategy.experimental_run_v2(train_step,
+                                                                args=(optional_inputs.get_value(),))
+                total += strategy.reduce(tf.distribute.ReduceOp.SUM, per_replica_losses,
+                                        axis=None)
+                steps_run += 1
+            return total, steps_run, {op.name: op.result() for op in train_eval_ops}
+
+        @tf.function
+        def distributed_average_step():
+            # Local SGD: brings the replicas' diverged weights back together
+            return strategy.experimental_run_v2(
+                allreduce.average_variables,
+                args=(model.trainable_variables, global_params['allreduce_pack'] is True,
+                      global_params['allreduce_dtype'])
+            )
+
+        local_sgd_steps = global_params['local_sgd_steps']
+
         @tf.function
         def distributed_test_step(dataset_inputs):
             return strategy.experimental_run_v2(test_step, args=(dataset_inputs,))
 
+        @tf.function
+        def distributed_copy_step(dataset_inputs):
+            # Places the batch on each replica's device so the copy can be
+            # timed separately from the train step.
+            return strategy.experimental_run_v2(
+                lambda features, labels: (tf.identity(features), tf.identity(labels)),
+                args=dataset_inputs
+            )
+
         writer = tf.summary.create_file_writer(
             "{}/logs".format(job_dir),
             max_queue=500,
         )
 
-        epoch_start = time.process_time()
-        for epoch in range(global_params['epochs']):
+        steps_per_execution = global_params['steps_per_execution']
+        if steps_per_execution > 1 and global_params['step_timing'] is True:
+            tf.get_logger().warning("--step-timing needs one step per execution and is disabled with --steps-per-execution={}".format(steps_per_execution))
+            global_params['step_timing'] = False
+
+        background_writer = None
+        if global_params['async_io'] is True:
+            background_writer = io_worker.BackgroundWriter(
+                writer,
+                max_queue=global_params['io_queue_size']
+            )
+
+        def write_scalars(values, step):
+            if background_writer is not None:
+                background_writer.scalars(values, step)
+            else:
+                with writer.as_default():
+                    for name, value in values.items():
+                        tf.summary.scalar(name, value, step=step)
+
+        resumable = global_params['resumable'] is True
+        sidecar_eval = global_params['sidecar_eval'] is True
+        position_key = '{}-{}'.format(job_name or 'local', max(task_index, 0))
+        if resumable and global_params['steps_per_execution'] > 1:
+            tf.get_logger().warning("--resumable tracks rows per step and sets --steps-per-execution to 1")
+            global_params['steps_per_execution'] = 1
+
+        def save_checkpoint(checkpoint_number, loop_state=None):
+            if host_checkpoint is not None:
+                background_writer.checkpoint(host_checkpoint, model, optimizer, checkpoint_number)
+                if loop_state is not None:
+                    background_writer.submit(position.save, job_dir, checkpoint_number, position_key, loop_state)
+            else:
+                checkpoint_mgr.save(checkpoint_number)
+                if loop_state is not None:
+                    position.save(job_dir, checkpoint_number, position_key, loop_state)
+
+        # Resume from the latest checkpoint, including where its epoch stopped reading
+        start_epoch = 0
+        resume_batches = 0
+        global_step = 0
+        input_position = None
+        if resumable and checkpoint_mgr.latest_checkpoint:
+            checkpoint.restore(checkpoint_mgr.latest_checkpoint)
+            checkpoint_number = int(checkpoint_mgr.latest_checkpoint.rsplit('-', 1)[1])
+            loop_state = position.load(job_dir, checkpoint_number, position_key)
+            if loop_state is not None:
+                start_epoch = loop_state['epoch']
+                resume_batches = loop_state['batches']
+                global_step = loop_state['global_step']
+                if loop_state['input_position'] is not None:
+                    input_position = position.InputPosition.from_json(loop_state['input_position'])
+            tf.get_logger().info("Resumed from {}: epoch {}; step {} of the epoch".format(
+                checkpoint_mgr.latest_checkpoint, start_epoch+1, resume_batches))
+        elif global_params['warm_start_from']:
+            warm_start_checkpoint = warm_start.checkpoint_path(global_params['warm_start_from'])
+            checkpoint.restore(warm_start_checkpoint).expect_partial()
+            tf.get_logger().info("Warm starting from {}".format(warm_start_checkpoint))
+
+        # With --warm-start-steps, epochs over the new data repeat until that many steps have run
+        warm_start_steps = global_params['warm_start_steps']
+        if warm_start_steps:
+            epochs = itertools.count(start_epoch)
+        else:
+            epochs = range(start_epoch, global_params['epochs'])
+
+        preempted = []
+        if resumable:
+            # Checkpoint at the next step boundary when the worker is told to stop
+            signal.signal(signal.SIGTERM, lambda signum, frame: preempted.append(signum))
+
+        step_timer = timing.StepTimer()
+        profile_window = profiling.get_window(global_params)
+
+        memory = profiling.get_memory_profiler(global_params)
+        if memory is not None:
+            memory.start()
+            profile_input_memory(memory, global_params['memory_profile_steps'])
+            memory.start_stage('train_step')
+            memory_start_step = global_step
+
+        run_start_step = global_step
+        train_loss = None
+        train_seconds = 0.0
+        epoch_start = timing.now()
+        for epoch in epochs:
             tf.get_logger().info("Epoch {}: Starting training".format(epoch+1))
             # TRAIN LOOP
             total_loss = 0.0
             num_batches = 0
+            if resumable:
+                if input_position is None:
+                    input_position = position.InputPosition()
+                set_input_position(input_position)
+                num_batches = resume_batches
+                resume_batches = 0
+            step_timer.reset()
             train_dist_dataset = input_fn_train(dist=True, strategy=strategy)
-            start = time.process_time()
-            for x in train_dist_dataset:
-                total_loss += distributed_train_step(x)
-                num_batches += 1
-
-                if num_batches % global_params['summary_write_steps'] == 0:
-                    temp_loss = total_loss / num_batches
+            train_iterator = iter(train_dist_dataset)
+            start = timing.now()
+            train_start = start
+            last_log_batches = num_batches
+            epoch_batches = num_batches
+            while True:
+                if warm_start_steps and global_step >= warm_start_steps:
+                    break
+                step_metrics = None
+                if steps_per_execution > 1:
+                    execution_steps = steps_per_execution
+                    if warm_start_steps:
+                        execution_steps = min(execution_steps, warm_start_steps - global_step)
+                    step_loss, steps_run, step_metrics = distributed_train_steps(
+                        train_iterator,
+                        tf.constant(execution_steps)
+                    )
+                    steps_run = int(steps_run)
+                    if steps_run == 0:
+                        break
+                else:
+                    input_start = timing.now()
+                    try:
+                        x = next(train_iterator)
+                    except StopIteration:
+                        break
+                    if resumable:
+                        x, positions = x[:2], x[2]
+
+                    if global_params['step_timing'] is True:
+                        copy_start = timing.now()
+                        step_timer.record('input_wait', copy_start - input_start)
+                        x = distributed_copy_step(x)
+                        compute_start = timing.now()
+                        step_timer.record('host_to_device', compute_start - copy_start)
+                        step_loss = distributed_train_step(x)
+                        # Fetching the loss blocks until the step has finished
+                        step_loss.numpy()
+                        step_timer.record('compute', timing.now() - compute_start)
+                    else:
+                        step_loss = distributed_train_step(x)
+                    steps_run = 1
+                    if resumable:
+                        for replica_positions in strategy.experimental_local_results(positions):
+                            input_position.record(replica_positions.numpy())
+
+                total_loss += step_loss
+                previous_batches = num_batches
+                num_batches += steps_run
+                global_step += steps_run
+
+                if local_sgd_steps > 1 and global_step // local_sgd_steps > (global_step - steps_run) // local_sgd_steps:
+                    distributed_average_step()
+
+                if profile_window is not None:
+                    profile_window.update(global_step)
+
+                if memory is not None and global_step - memory_start_step >= global_params['memory_profile_steps']:
+                    finish_memory_profile(memory, model, optimizer)
+                    memory = None
+
+                if resumable and hypertune is False and (preempted or (
+                        global_params['checkpoint_steps'] > 0 and global_step % global_params['checkpoint_steps'] == 0)):
+                    save_checkpoint(global_step, {
+                        'epoch': epoch,
+                        'batches': num_batches,
+                        'global_step': global_step,
+                        'input_position': input_position.to_json(),
+                    })
+                    if preempted:
+                        tf.get_logger().info("Epoch {}: Stopping at step {} after checkpointing input position".format(epoch+1, num_batches))
+                        if background_writer is not None:
+                            background_writer.close()
+                        return
+
+                if num_batches // global_params['summary_write_steps'] > previous_batches // global_params['summary_write_steps']:
+                    temp_loss = total_loss / (num_batches - epoch_batches)
+                    step_times = step_timer.window()
+                    window_steps = num_batches - last_log_batches
+                    last_log_batches = num_batches
 
                     if hypertune is False:
-                        with writer.as_default():
-                            tf.summary.scalar("epoch_{}_train_loss".format(epoch+1), temp_loss, step=num_batches)
-
-                    end = time.process_time()
-                    tf.get_logger().info("Epoch {}: Step {} training complete. Loss: {}; Time elapsed: {} ({} steps/sec)".format(
+                        scalars = {"epoch_{}_train_loss".format(epoch+1): temp_loss}
+                        if global_params['step_timing'] is True:
+                            for phase, ms in step_times.items():
+                                scalars["epoch_{}_{}_ms".format(epoch+1, phase)] = ms
+                        write_scalars(scalars, num_batches)
+
+                    end = timing.now()
+                    tf.get_logger().info("Epoch {}: Step {} training complete. Loss: {}; Time elapsed: {} ({} steps/sec; {} examples/sec)".format(
                         epoch+1, 
                         num_batches, 
                         temp_loss,
                         round(end - start, 2),
-                        round(100 / (end - start), 2)
+                        round(window_steps / (end - start), 2),
+                        round(window_steps * global_params['batch_size'] / (end - start), 2)
                         )
                     )
-                    start = time.process_time()
-            train_loss = total_loss / num_batches
+                    if step_metrics is not None:
+                        tf.get_logger().info("Epoch {}: Step {} metrics: {}".format(
+                            epoch+1,
+                            num_batches,
+                            {name: float(value) for name, value in step_metrics.items()}
+                        ))
+                    if global_params['step_timing'] is True:
+                        tf.get_logger().info("Epoch {}: Step {} mean times (ms): {}".format(epoch+1, num_batches, step_times))
+                    start = timing.now()
+            train_seconds += timing.now() - train_start
+            if local_sgd_steps > 1 and global_step % local_sgd_steps != 0:
+                # Evaluate and checkpoint one model rather than this replica's copy
+                distributed_average_step()
+            train_loss = total_loss / max(num_batches - epoch_batches, 1)
             tf.get_logger().info("Epoch {}: Training complete. Steps: {}; Loss: {}".format(epoch+1, num_batches, train_loss))
 
+            if global_params['step_timing'] is True:
+                step_summary = step_timer.summary()
+                tf.get_logger().info("Epoch {}: Step time breakdown: {}".format(epoch+1, step_summary))
+                scalars = {"input_bound_fraction": step_summary['input_bound_fraction']}
+                for phase in timing.PHASES:
+                    scalars["{}_mean_ms".format(phase)] = step_summary['{}_mean_ms'.format(phase)]
+                write_scalars(scalars, epoch+1)
+
             # TEST LOOP
-            tf.get_logger().info("Epoch {}: Starting testing".format(epoch+1))
-            test_dist_dataset = input_fn_eval(dist=True, strategy=strategy)
-            num_test_batches = 0
-            start = time.process_time()
-            for x in test_dist_dataset:
-                distributed_test_step(x)
-                num_test_batches += 1
-                if num_test_batches % global_params['summary_write_steps'] == 0:
-                    end = time.process_time()
-                    tf.get_logger().info("Epoch {}: Test step {} complete. Time elapsed: {} ({} steps/sec)".format(
-                        epoch+1, 
-                        num_test_batches,
-                        round(end - start, 2),
-                        round(100 / (end - start), 2)
-                    ))
-                    start = time.process_time()
-            
-            tf.get_logger().info("Epoch {}: Testing finished in {} steps".format(epoch+1, num_test_batches))
+            if sidecar_eval:
+                tf.get_logger().info("Epoch {}: Skipping testing; the sidecar evaluator tests each checkpoint".format(epoch+1))
+            else:
+                tf.get_logger().info("Epoch {}: Starting testing".format(epoch+1))
+                test_dist_dataset = input_fn_eval(dist=True, strategy=strategy)
+                num_test_batches = 0
+                start = timing.now()
+                for x in test_dist_dataset:
+                    distributed_test_step(x)
+                    num_test_batches += 1
+                    if num_test_batches % global_params['summary_write_steps'] == 0:
+                        end = timing.now()
+                        tf.get_logger().info("Epoch {}: Test step {} complete. Time elapsed: {} ({} steps/sec)".format(
+                            epoch+1, 
+                            num_test_batches,
+                            round(end - start, 2),
+                            round(global_params['summary_write_steps'] / (end - start), 2)
+                        ))
+                        start = timing.now()
+
+                tf.get_logger().info("Epoch {}: Testing finished in {} steps".format(epoch+1, num_test_batches))
 
             if hypertune is False:
                 tf.get_logger().info("Epoch {}: Saving checkpoint".format(epoch+1))
-                checkpoint_mgr.save(epoch+1)
-                tf.get_logger().info("Epoch {}: Checkpoint saved".format(epoch+1))
+                if resumable:
+                    # The next epoch starts reading from the beginning
+                    save_checkpoint(global_step, {
+                        'epoch': epoch+1,
+                        'batches': 0,
+                        'global_step': global_step,
+                        'input_position': None,
+                    })
+                    input_position = None
+                else:
+                    save_checkpoint(epoch+1)
+                if host_checkpoint is None:
+                    tf.get_logger().info("Epoch {}: Checkpoint saved".format(epoch+1))
 
             outputs = {
                 'epoch': epoch+1,
                 'batches': num_batches+1,
                 'train_loss': train_loss,
-                'test_loss': test_loss.result()
             }
-
-            with writer.as_default():
-                tf.summary.scalar("train_loss", train_loss, step=epoch+1)
-                tf.summary.scalar("test_loss", test_loss.result(), step=epoch+1)
-
-            test_loss.reset_states()
             
             for op in train_eval_ops:
                 scalar_label = "train_{}".format(op.name)
                 outputs[scalar_label] = op.result()
-                with writer.as_default():
-                    tf.summary.scalar(scalar_label, op.result(), step=epoch+1)
                 op.reset_states()
 
-            for op in test_eval_ops:
-                scalar_label = "test_{}".format(op.name)
-                outputs[scalar_label] = op.result()
-                with writer.as_default():
-                    tf.summary.scalar(scalar_label, op.result(), step=epoch+1)
-                op.reset_states()
+            if not sidecar_eval:
+                outputs['test_loss'] = test_loss.result()
+                test_loss.reset_states()
+                for op in test_eval_ops:
+                    scalar_label = "test_{}".format(op.name)
+                    outputs[scalar_label] = op.result()
+                    op.reset_states()
 
-            writer.flush()
+            write_scalars({name: value for name, value in outputs.items() if name not in ['epoch', 'batches']}, epoch+1)
+            if background_writer is not None:
+                background_writer.flush()
+            else:
+                writer.flush()
 
             tf.get_logger().info("Epoch {} results: {}".format(epoch+1, outputs))
 
-            epoch_end = time.process_time()
+            epoch_end = timing.now()
             tf.get_logger().info("Epoch {} elapsed time: {}".format(epoch+1, epoch_end - epoch_start))
-            epoch_start = time.process_time()
+            epoch_start = timing.now()
+
+            if warm_start_steps and (global_step >= warm_start_steps or num_batches == epoch_batches):
+                tf.get_logger().info("Warm start finished after {} steps".format(global_step))
+                break
+
+        if profile_window is not None and profile_window.active:
+            profile_window.stop(global_step)
+        if memory is not None:
+            finish_memory_profile(memory, model, optimizer)
+
+        if global_params['throughput_dir']:
+            # --batch-size is the global batch, split across the replicas of every
+            # task; report this task's share so the cluster harness can sum them
+            local_share = len(strategy.extended.worker_devices) / strategy.num_replicas_in_sync
+            timing.write_throughput(
+                global_params['throughput_dir'],
+                position_key,
+                int((global_step - run_start_step) * global_params['batch_size'] * local_share),
+                train_seconds,
+                train_loss=float(train_loss) if train_loss is not None else None
+            )
+
+        if background_writer is not None:
+            tf.get_logger().info("Waiting for background checkpoint and summary writes")
+            background_writer.close()
 
         for (dirpath, dirnames, filenames) in walk(job_dir):
             tf.get_logger().info("path: {}; dirs: {}; files: {}".format(dirpath, dirnames, filenames))
@@ -307,7 +731,30 @@ def train_and_evaluate(table_id: str, job_dir: str, params: dict, job_name='', t
 
         if hypertune is False: 
             tf.get_logger().info("Saving model")
+            if negative_rate < 1. and global_params['downsample_correction'] == 'export':
+                # Serve probabilities at the true label rate
+                model = tf.keras.Sequential([
+                    model,
+                    tf.keras.layers.Lambda(lambda p: downsampling.correct_probability(p, negative_rate)),
+                ])
             model.save(job_dir, save_format="tf")
             tf.get_logger().info("Model saved")
             # tf.saved_model.save(model, '{}/saved_model'.format(job_dir))
+
+    if global_params['warm_start_baseline'] and hypertune is False and job_name in ['', 'chief']:
+        report_warm_start(job_dir)
+
+
+def report_warm_start(job_dir: str):
+    """Evaluates the warm-started, previous and fully retrained models on the same test rows"""
+    def evaluate(checkpoint_path):
+        tf.get_logger().info("Evaluating {} for the warm start report".format(checkpoint_path))
+        return evaluate_checkpoint(global_table_id, BUCKET_NAME, PREFIX, global_params, checkpoint_path)
+
+    warm_start.report(
+        job_dir,
+        evaluate(tf.train.latest_checkpoint(job_dir)),
+        evaluate(warm_start.checkpoint_path(global_params['warm_start_baseline'])),
+        previous=evaluate(warm_start.checkpoint_path(global_params['warm_start_from'])),
+    )
         
\ No newline at end of file
@@ -0,0 +1,334 @@
+import collections
+import gc
+import json
+import math
+import os
+import resource
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Any, Dict, List, Optional, Tuple
+
+import tensorflow as tf
+
+# Python functions sampled by default when --profile-python is set. These are
+# the generators tf.data calls back into for every row.
+DEFAULT_PYTHON_FUNCTIONS = [
+    'bq_stream_generator',
+    'get_reader_for_stream',
+    'generate_blob',
+]
+
+
+# Stages of --memory-profile. The input stages are prefixes of the readers'
+# tf.data pipeline: one reader generator, the interleave of cycle_length
+# generators with their prefetch buffers, plus their shuffle buffers, plus
+# batching. train_step is the full pipeline feeding the train step.
+MEMORY_STAGES = ['reader', 'interleave', 'shuffle', 'batch', 'train_step']
+INPUT_STAGES = MEMORY_STAGES[:-1]
+
+MEMORY_REPORT_FILE = 'memory_report.json'
+
+# Allocation sites kept per stage in the memory report
+TOP_ALLOCATIONS = 10
+
+
+def stage_reached(stage: Optional[str], name: str) -> bool:
+    """Whether a pipeline built up to `stage` includes stage `name`; None builds all of it"""
+    return stage is None or MEMORY_STAGES.index(stage) >= MEMORY_STAGES.index(name)
+
+
+def parse_profile_steps(value: str) -> Optional[Tuple[int, int]]:
+    """Parses a `START,END` step window. Returns None when profiling is off"""
+    if not value:
+        return None
+    parts = value.split(',')
+    if len(parts) != 2:
+        raise ValueError('--profile-steps must be START,END. Got: {}'.format(value))
+    start, end = int(parts[0]), int(parts[1])
+    if start < 0 or end <= start:
+        raise ValueError('--profile-steps END must be greater than START. Got: {}'.format(value))
+    return start, end
+
+
+def check_local_dir(profile_dir: str) -> str:
+    if '://' in profile_dir:
+        raise ValueError('--profile-dir must be a local directory. Got: {}'.format(profile_dir))
+    os.makedirs(profile_dir, exist_ok=True)
+    return profile_dir
+
+
+class PythonSampler(threading.Thread):
+    """Samples the Python stacks of every thread at a fixed interval.
+
+    Only stacks that pass through one of `functions` are kept. Samples are
+    written in the collapsed ("folded") format used by flamegraph tools, one
+    line per unique stack with its sample count.
+    """
+
+    def __init__(self, output_path: str, functions: List[str], interval_secs=0.01):
+        super(PythonSampler, self).__init__(name='python-sampler', daemon=True)
+        self.output_path = output_path
+        self.functions = set(functions)
+        self.interval_secs = interval_secs
+        self.samples = collections.Counter()
+        self._stopped = threading.Event()
+
+    def run(self):
+        own_id = threading.get_ident()
+        while not self._stopped.wait(self.interval_secs):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = _stack(frame)
+                if self.functions.intersection(name.split(' ')[0] for name in stack):
+                    self.samples[';'.join(stack)] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        with open(self.output_path, 'w') as f:
+            for stack, count in self.samples.most_common():
+                f.write('{} {}\n'.format(stack, count))
+        tf.get_logger().info("Wrote {} Python stack samples to {}".format(
+            sum(self.samples.values()), self.output_path))
+
+
+def _stack(frame) -> List[str]:
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), frame.f_lineno))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+class ProfileWindow(object):
+    """Starts and stops the TF profiler (and optional Python sampler) around a step window.
+
+    The TF profiler trace includes the tf.data iterator and per-transformation
+    events, which the TensorBoard profile plugin shows in its input pipeline
+    analyzer.
+    """
+
+    def __init__(self, steps: Tuple[int, int], profile_dir: str, python_functions: List[str] = None):
+        self.start_step, self.end_step = steps
+        self.profile_dir = check_local_dir(profile_dir)
+        self.python_functions = python_functions
+        self.active = False
+        self.done = False
+        self._sampler = None
+
+    def update(self, step: int):
+        """Call with the number of steps completed so far"""
+        if self.done:
+            return
+        if not self.active and step >= self.start_step:
+            self.start(step)
+        elif self.active and step >= self.end_step:
+            self.stop(step)
+
+    def start(self, step: int):
+        tf.get_logger().info("Step {}: Starting profiler trace in {}".format(step, self.profile_dir))
+        tf.profiler.experimental.start(self.profile_dir)
+        if self.python_functions:
+            self._sampler = PythonSampler(
+                os.path.join(self.profile_dir, 'python_samples_{}.folded'.format(int(time.time()))),
+                self.python_functions
+            )
+            self._sampler.start()
+        self.active = True
+
+    def stop(self, step: int):
+        tf.profiler.experimental.stop()
+        if self._sampler is not None:
+            self._sampler.stop()
+            self._sampler = None
+        tf.get_logger().info("Step {}: Profiler trace written to {}".format(step, self.profile_dir))
+        self.active = False
+        self.done = True
+
+
+class ProfileWindowHook(tf.estimator.SessionRunHook):
+    """Estimator hook that drives a ProfileWindow from the global step"""
+
+    def __init__(self, window: ProfileWindow):
+        self.window = window
+        self._global_step = None
+
+    def begin(self):
+        self._global_step = tf.compat.v1.train.get_global_step()
+
+    def before_run(self, run_context):
+        return tf.estimator.SessionRunArgs(self._global_step)
+
+    def after_run(self, run_context, run_values):
+        self.window.update(run_values.results)
+
+    def end(self, session):
+        if self.window.active:
+            self.window.stop(session.run(self._global_step))
+
+
+def rss_bytes() -> int:
+    """Resident set size of this process; the peak so far where /proc is missing"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class MemoryProfiler(threading.Thread):
+    """Samples process RSS and traced Python allocations, labelled with the stage running.
+
+    RSS includes TensorFlow's native buffers; tracemalloc only sees Python
+    objects such as generator rows and pickled read sessions. Each stage
+    reports its peak and its steady state, the median of the second half
+    of its samples, and the allocation sites holding the most Python memory
+    when it ends.
+    """
+
+    def __init__(self, profile_dir: str, interval_secs=0.05):
+        super(MemoryProfiler, self).__init__(name='memory-profiler', daemon=True)
+        self.profile_dir = check_local_dir(profile_dir)
+        self.interval_secs = interval_secs
+        self.stages = collections.OrderedDict()  # type: Dict[str, Dict[str, Any]]
+        self.values = {}  # type: Dict[str, Any]
+        self._stage = None
+        self._samples = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def run(self):
+        while not self._stopped.wait(self.interval_secs):
+            self.sample()
+
+    def sample(self):
+        traced, _ = tracemalloc.get_traced_memory()
+        with self._lock:
+            if self._stage is not None:
+                self._samples.append((rss_bytes(), traced))
+
+    def start_stage(self, name: str):
+        if self._stage is not None:
+            self.end_stage()
+        # Garbage of the previous stage would be counted against this one
+        gc.collect()
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        with self._lock:
+            self._stage = name
+            self._samples = []
+            self.stages[name] = {'start_rss_bytes': rss_bytes(), 'start_traced_bytes': tracemalloc.get_traced_memory()[0]}
+        tf.get_logger().info("Memory profile: stage {} started at {:.1f} MB RSS".format(
+            name, self.stages[name]['start_rss_bytes'] / float(1 << 20)))
+
+    def end_stage(self):
+        self.sample()
+        _, traced_peak = tracemalloc.get_traced_memory()
+        with self._lock:
+            name, samples = self._stage, self._samples
+            self._stage, self._samples = None, []
+        if name is None:
+            return
+        stage = self.stages[name]
+        rss = [sample[0] for sample in samples]
+        traced = [sample[1] for sample in samples]
+        steady = samples[len(samples) // 2:]
+        stage.update({
+            'samples': len(samples),
+            'peak_rss_bytes': max(rss),
+            'steady_rss_bytes': int(statistics.median(sample[0] for sample in steady)),
+            'peak_traced_bytes': max(max(traced), traced_peak),
+            'steady_traced_bytes': int(statistics.median(sample[1] for sample in steady)),
+            'top_allocations': [
+                {'site': str(stat.traceback), 'bytes': stat.size, 'blocks': stat.count}
+                for stat in tracemalloc.take_snapshot().statistics('lineno')[:TOP_ALLOCATIONS]
+            ],
+        })
+        stage['rss_growth_bytes'] = stage['steady_rss_bytes'] - stage['start_rss_bytes']
+        tf.get_logger().info("Memory profile: stage {} peak {:.1f} MB, steady {:.1f} MB RSS ({:+.1f} MB)".format(
+            name,
+            stage['peak_rss_bytes'] / float(1 << 20),
+            stage['steady_rss_bytes'] / float(1 << 20),
+            stage['rss_growth_bytes'] / float(1 << 20)))
+
+    def record(self, name: str, value: Any):
+        """Adds a value, such as the configured buffer capacity, to the report"""
+        self.values[name] = value
+
+    def stop(self) -> Dict[str, Any]:
+        """Ends the running stage and writes the JSON report and TensorBoard scalars to the profile directory"""
+        self.end_stage()
+        self._stopped.set()
+        self.join()
+        tracemalloc.stop()
+
+        report = {'stages': self.stages, 'values': self.values}
+        path = os.path.join(self.profile_dir, MEMORY_REPORT_FILE)
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+        writer = tf.summary.create_file_writer(os.path.join(self.profile_dir, 'memory'))
+        with writer.as_default():
+            for name, stage in self.stages.items():
+                step = MEMORY_STAGES.index(name) if name in MEMORY_STAGES else len(MEMORY_STAGES)
+                for key in ['peak_rss_bytes', 'steady_rss_bytes', 'rss_growth_bytes', 'peak_traced_bytes',
+                            'steady_traced_bytes']:
+                    if key in stage:
+                        tf.summary.scalar('memory/{}/{}'.format(name, key.replace('_bytes', '_mb')),
+                                          stage[key] / float(1 << 20), step=step)
+        writer.flush()
+        tf.get_logger().info("Memory profile written to {}".format(path))
+        return report
+
+
+def configured_buffer_capacity(params: Dict[str, Any], num_features: int) -> Dict[str, Any]:
+    """Elements the readers' tf.data buffers hold when full, and the bytes of their row values.
+
+    These are capacities computed from the flags, not measured occupancy.
+
+    Rows before batching are tuples of scalar tensors, each with its own
+    allocation and tensor overhead, so their actual size is several times
+    the value bytes.
+    """
+    row_bytes = 4 * (num_features + 1)
+    stream_rows = params['batch_size'] * 5
+    # Each interleaved stream has a prefetch and a shuffle buffer
+    buffered_rows = 2 * stream_rows * params['cycle_length']
+    prefetch_batches = math.ceil((params['batch_size'] * 5) / params['batch_size'])
+    sizes = {
+        'row_value_bytes': row_bytes,
+        'streams_interleaved': params['cycle_length'],
+        'stream_prefetch_rows': stream_rows,
+        'stream_shuffle_rows': stream_rows,
+        'stream_buffers_rows': buffered_rows,
+        'stream_buffers_value_bytes': buffered_rows * row_bytes,
+        'batch_prefetch_batches': prefetch_batches,
+        'batch_prefetch_value_bytes': prefetch_batches * params['batch_size'] * row_bytes,
+    }
+    if params['data_source'] == 'avro':
+        sizes['avro_read_ahead_bytes'] = int(params['read_ahead_mb'] * (1 << 20))
+    return sizes
+
+
+def get_memory_profiler(params: Dict) -> Optional[MemoryProfiler]:
+    if params.get('memory_profile') is not True:
+        return None
+    return MemoryProfiler(params['profile_dir'], params['memory_sample_ms'] / 1000.)
+
+
+def get_window(params: Dict) -> Optional[ProfileWindow]:
+    steps = parse_profile_steps(params.get('profile_steps'))
+    if steps is None:
+        return None
+    python_functions = None
+    if params.get('profile_python') is True:
+        python_functions = params['profile_python_functions'].split(',')
+    return ProfileWindow(steps, params['profile_dir'], python_functions)
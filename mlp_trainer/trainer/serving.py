@@ -0,0 +1,250 @@
+"""Predictions from an exported model behind a cache of recent inputs.
+
+Requests often repeat the same day of week and month one-hots with nearly
+the same pickup location and time, so the model is called again and again
+on near-duplicate rows. CachedModel keys each row on its feature vector,
+with the continuous features rounded to a configurable quantum, and only
+calls the model on rows whose key is not cached. Entries leave the cache
+least recently used first when it exceeds its entry or memory bound, and
+after `ttl_secs`. Loading a new model version empties the cache.
+
+    model = CachedModel('gs://bucket/jobs/weekly/saved_model', PredictionCache(max_bytes=64 << 20),
+                        quanta=get_quanta(parse_quanta('0.01')), reload_secs=60)
+    probabilities = model.predict(rows)  # rows: [n, features.num_features()]
+    model.cache.stats()
+"""
+import collections
+import sys
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import tensorflow as tf
+
+from trainer.data import features as features
+
+# Prefixes of the one-hot encoded features, which are never quantized
+ONE_HOT_PREFIXES = ('day_of_week_', 'month_')
+
+# Bytes a cache entry takes besides its key: the OrderedDict node, the
+# (prediction, expiry) tuple and its two floats
+ENTRY_OVERHEAD = 200
+
+
+def is_one_hot(name: str) -> bool:
+    return name.startswith(ONE_HOT_PREFIXES)
+
+
+def parse_quanta(text: str) -> Tuple[float, Dict[str, float]]:
+    """`0.01,pickup_lat_std=0.002` as the default quantum of the continuous features and per feature overrides"""
+    default = 0.
+    overrides = {}
+    for part in [part.strip() for part in (text or '').split(',') if part.strip()]:
+        if '=' in part:
+            name, value = [item.strip() for item in part.split('=', 1)]
+            overrides[name] = float(value)
+        else:
+            default = float(part)
+    return default, overrides
+
+
+def get_quanta(quanta: Tuple[float, Dict[str, float]]) -> np.ndarray:
+    """Quantum of each selected feature; 0 keys a feature on its exact value"""
+    default, overrides = quanta
+    unknown = [name for name in overrides if name not in features.names()]
+    if unknown:
+        raise ValueError("Unknown features in cache quanta: {}".format(unknown))
+    return np.array([
+        0. if is_one_hot(name) else overrides.get(name, default)
+        for name in features.names()
+    ], dtype=np.float64)
+
+
+def quantize(rows: np.ndarray, quanta: np.ndarray) -> np.ndarray:
+    """Rows as int64 keys: bucket indices of quantized columns, exact float32 bits of the others"""
+    rows = np.asarray(rows, dtype=np.float32)
+    keys = rows.view(np.int32).astype(np.int64)
+    quantized = quanta > 0
+    if quantized.any():
+        keys[:, quantized] = np.floor(rows[:, quantized] / quanta[quantized] + .5).astype(np.int64)
+    return keys
+
+
+class PredictionCache:
+    """LRU cache of predictions by row key, bounded by entries and bytes, with an optional TTL"""
+
+    def __init__(self, max_entries=1000000, max_bytes=256 << 20, ttl_secs=0., clock=time.monotonic):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_secs = ttl_secs
+        self.clock = clock
+        self.version = None
+        self.bytes = 0
+        self.counters = collections.Counter()
+        self._entries = collections.OrderedDict()  # type: collections.OrderedDict
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def entry_bytes(key: bytes) -> int:
+        return sys.getsizeof(key) + ENTRY_OVERHEAD
+
+    def _remove(self, key: bytes):
+        del self._entries[key]
+        self.bytes -= self.entry_bytes(key)
+
+    def get(self, key: bytes) -> Optional[float]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.counters['misses'] += 1
+                return None
+            prediction, expires = entry
+            if expires is not None and self.clock() >= expires:
+                self._remove(key)
+                self.counters['expired'] += 1
+                self.counters['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.counters['hits'] += 1
+            return prediction
+
+    def put(self, key: bytes, prediction: float, version=None):
+        """Caches a prediction of model `version`; dropped if another version has loaded since"""
+        with self._lock:
+            if version != self.version:
+                return
+            if key in self._entries:
+                self._remove(key)
+            expires = self.clock() + self.ttl_secs if self.ttl_secs > 0 else None
+            self._entries[key] = (prediction, expires)
+            self.bytes += self.entry_bytes(key)
+            while self._entries and (len(self._entries) > self.max_entries or self.bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                self.counters['evicted'] += 1
+
+    def count(self, name: str, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def invalidate(self, version):
+        """Drops every prediction when model `version` replaces the cached one"""
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+            self.version = version
+            self.counters['invalidations'] += 1
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.counters['hits'] + self.counters['misses']
+            return {
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+                'hits': self.counters['hits'],
+                'misses': self.counters['misses'],
+                'hit_rate': self.counters['hits'] / lookups if lookups else 0.,
+                # Repeats of a missed key within one predict() call, computed once
+                'deduplicated': self.counters['deduplicated'],
+                'expired': self.counters['expired'],
+                'evicted': self.counters['evicted'],
+                'invalidations': self.counters['invalidations'],
+            }
+
+
+def latest_version(export_dir: str) -> str:
+    """The newest SavedModel under `export_dir`: its highest numbered subdirectory, as
+    Estimator.export_saved_model writes, or `export_dir` itself for the custom loop's model.save"""
+    versions = [name.rstrip('/') for name in tf.io.gfile.listdir(export_dir) if name.rstrip('/').isdigit()]
+    if versions:
+        return '{}/{}'.format(export_dir.rstrip('/'), max(versions, key=int))
+    return export_dir
+
+
+def version_id(path: str) -> str:
+    """Changes when a model is exported again, including over the same directory"""
+    return '{}@{}'.format(path, tf.io.gfile.stat('{}/saved_model.pb'.format(path)).mtime_nsec)
+
+
+def load_model(path: str) -> Callable[[np.ndarray], np.ndarray]:
+    """The serving signature of the SavedModel at `path` as a function of [n, features] rows"""
+    loaded = tf.saved_model.load(path)
+    signature = loaded.signatures[tf.saved_model.DEFAULT_SERVING_SIGNATURE_DEF_KEY]
+    input_name = list(signature.structured_input_signature[1])[0]
+
+    def predict(rows: np.ndarray) -> np.ndarray:
+        outputs = signature(**{input_name: tf.constant(rows, dtype=tf.float32)})
+        return next(iter(outputs.values())).numpy().reshape(-1)
+
+    # The loaded object owns the signature's variables
+    predict.saved_model = loaded
+    return predict
+
+
+class CachedModel:
+    """The latest model exported to `export_dir`, called only on rows the cache misses"""
+
+    def __init__(self, export_dir: str, cache: PredictionCache, quanta: np.ndarray, reload_secs=0.):
+        self.export_dir = export_dir
+        self.cache = cache
+        self.quanta = quanta
+        self.reload_secs = reload_secs
+        # (predict, version), swapped as one so a request never pairs a model with another's version
+        self._loaded = (None, None)
+        self._checked = 0.
+        self._load_lock = threading.Lock()
+        self.load()
+
+    @property
+    def version(self):
+        return self._loaded[1]
+
+    def load(self) -> bool:
+        """Loads the latest version when it differs from the loaded one; True if it did"""
+        with self._load_lock:
+            self._checked = time.monotonic()
+            path = latest_version(self.export_dir)
+            version = version_id(path)
+            if version == self.version:
+                return False
+            predict = load_model(path)
+            # Clear before swapping: until then requests still run the old model,
+            # and their puts are dropped as the cache already expects `version`
+            self.cache.invalidate(version)
+            self._loaded = (predict, version)
+            tf.get_logger().info("Serving model {}; prediction cache cleared".format(version))
+            return True
+
+    def keys(self, rows: np.ndarray) -> List[bytes]:
+        return [key.tobytes() for key in quantize(rows, self.quanta)]
+
+    def predict(self, rows: np.ndarray) -> np.ndarray:
+        """Probability of a cash payment for each row"""
+        if self.reload_secs > 0 and time.monotonic() - self._checked >= self.reload_secs:
+            self.load()
+        predict, version = self._loaded
+
+        rows = np.asarray(rows, dtype=np.float32)
+        predictions = np.empty(len(rows), dtype=np.float32)
+        missing = collections.OrderedDict()  # key -> indices of the rows sharing it
+        deduplicated = 0
+        for index, key in enumerate(self.keys(rows)):
+            if key in missing:
+                missing[key].append(index)
+                deduplicated += 1
+                continue
+            prediction = self.cache.get(key)
+            if prediction is None:
+                missing[key] = [index]
+            else:
+                predictions[index] = prediction
+
+        if deduplicated:
+            self.cache.count('deduplicated', deduplicated)
+        if missing:
+            # One model call for the first row of each missing key
+            computed = predict(rows[[indices[0] for indices in missing.values()]])
+            for (key, indices), prediction in zip(missing.items(), computed):
+                predictions[indices] = prediction
+                self.cache.put(key, float(prediction), version)
+        return predictions
@@ -4,7 +4,20 @@ import os
 import json
 from typing import Any, Dict, Tuple
 
+import trainer.allreduce as allreduce
+import trainer.evaluator as evaluator
+import trainer.input_service as input_service
+import trainer.base_model as base_model
 import trainer.model as model
+import trainer.model_keras as model_keras
+import trainer.model_loop as model_loop
+import trainer.profiling as profiling
+import trainer.threads as threads
+import trainer.warm_start as warm_start
+import trainer.data.avro as avro_generator
+import trainer.data.bigquery as data
+import trainer.data.downsampling as downsampling
+import trainer.data.features as features
 
 
 def get_params(args) -> Dict[str, Any]:
@@ -14,11 +27,31 @@ def get_params(args) -> Dict[str, Any]:
         'no_generated_job_path': args.no_generated_job_path,
         'distribute': args.distribute,
         'data_source': args.data_source,
+        'features': [name for name in args.features.split(',') if name] or None,
+        'sample_fraction': args.sample_fraction,
+        'negative_rate': args.negative_rate,
+        'downsample_correction': args.downsample_correction,
         'distribute_strategy': args.distribute_strategy,
+        'throughput_dir': args.throughput_dir,
         'cycle_length': args.cycle_length,
+        'intra_op_threads': args.intra_op_threads,
+        'inter_op_threads': args.inter_op_threads,
+        'data_threads': args.data_threads,
+        'thread_calibration_steps': args.thread_calibration_steps,
+        'thread_calibration_file': args.thread_calibration_file,
         'summary_write_steps': args.summary_write_steps,
         # 'checkpoint_write_steps': args.checkpoint_write_steps,
         'log_step_count_steps': args.log_step_count_steps,
+        'step_timing': args.step_timing,
+        'async_io': args.async_io,
+        'io_queue_size': args.io_queue_size,
+        'profile_steps': args.profile_steps,
+        'profile_dir': args.profile_dir,
+        'profile_python': args.profile_python,
+        'profile_python_functions': args.profile_python_functions,
+        'memory_profile': args.memory_profile,
+        'memory_profile_steps': args.memory_profile_steps,
+        'memory_sample_ms': args.memory_sample_ms,
         'dense_neurons_1': args.dense_neurons_1,
         'dense_neurons_2': args.dense_neurons_2,
         'dense_neurons_3': args.dense_neurons_3,
@@ -28,6 +61,31 @@ def get_params(args) -> Dict[str, Any]:
         'learning_rate': args.learning_rate,
         'chunk_size': args.chunk_size,
         'batch_size': args.batch_size,
+        'jit_compile': args.jit_compile,
+        'precision': args.precision,
+        'grad_accum_steps': args.grad_accum_steps,
+        'steps_per_execution': args.steps_per_execution,
+        'avro_endpoint': args.avro_endpoint,
+        'download_threads': args.download_threads,
+        'download_range_mb': args.download_range_mb,
+        'read_ahead_mb': args.read_ahead_mb,
+        'shard_filter': args.shard_filter,
+        'input_workers': args.input_workers,
+        'input_service_port': args.input_service_port,
+        'allreduce_pack': args.allreduce_pack,
+        'allreduce_dtype': args.allreduce_dtype,
+        'local_sgd_steps': args.local_sgd_steps,
+        'resumable': args.resumable,
+        'checkpoint_steps': args.checkpoint_steps,
+        'sidecar_eval': args.sidecar_eval,
+        'eval_threads': args.eval_threads,
+        'eval_interval_secs': args.eval_interval_secs,
+        'eval_timeout_secs': args.eval_timeout_secs,
+        'warm_start_from': args.warm_start_from,
+        'warm_start_steps': args.warm_start_steps,
+        'warm_start_baseline': args.warm_start_baseline,
+        'new_data_since': args.new_data_since,
+        'replay_fraction': args.replay_fraction,
         'epochs': args.epochs,
         'validation_freq': args.validation_freq,
         'kernel_initial_1': args.kernel_initial_1,
@@ -37,6 +95,28 @@ def get_params(args) -> Dict[str, Any]:
 
     if args.batch_size_float:
         params['batch_size'] = int(args.batch_size_float)
+
+    if not 0. < params['sample_fraction'] <= 1.:
+        raise ValueError("--sample-fraction must be in (0, 1], got {}".format(params['sample_fraction']))
+
+    if params['precision'] not in base_model.PRECISIONS:
+        raise ValueError("--precision must be one of {}".format(base_model.PRECISIONS))
+    if params['allreduce_dtype'] not in allreduce.DTYPES:
+        raise ValueError("--allreduce-dtype must be one of {}".format(list(allreduce.DTYPES)))
+    if params['local_sgd_steps'] < 1:
+        raise ValueError("--local-sgd-steps must be at least 1, got {}".format(params['local_sgd_steps']))
+    if not 0. < params['negative_rate'] <= 1.:
+        raise ValueError("--negative-rate must be in (0, 1], got {}".format(params['negative_rate']))
+    if params['downsample_correction'] not in downsampling.CORRECTIONS:
+        raise ValueError("--downsample-correction must be one of {}".format(downsampling.CORRECTIONS))
+
+    if params['input_workers'] > 0 and params['resumable'] is True:
+        raise ValueError("--resumable cannot track the input position of --input-workers")
+    warm_start.validate(params)
+
+    features.select(params['features'])
+    avro_generator.configure(params)
+    data.configure(params)
     
     return params
 
@@ -79,12 +159,64 @@ def train_and_evaluate(args):
 
     params = get_params(args)
 
-    _, job_name, task_index = get_tf_config()
+    cluster, job_name, task_index = get_tf_config()
+    training_tasks = sum(len((cluster or {}).get(job) or []) for job in ['chief', 'worker'])
+    if params['resumable'] is True and training_tasks > 1:
+        # Each worker would see every stream and keep only its share of the rows, so
+        # the rows the others train on would never reach its input position
+        raise ValueError("--resumable tracks the input position of a single training task and cannot be used with several workers")
+
+    params = threads.resolve(params)
+    if params['thread_calibration_steps'] > 0 or params['thread_calibration_file']:
+        params = threads.calibrate(params, args.table_id, args.avro_bucket, args.avro_prefix, args.job_dir)
+    threads.configure(params)
+
+    job_dir = args.job_dir
+    sidecar = None
+    if params['sidecar_eval'] is True and args.trainer == 'keras':
+        logging.warning("--sidecar-eval is not supported by the keras trainer and is ignored")
+    elif params['sidecar_eval'] is True and job_name in ['', 'chief']:
+        if args.trainer != 'loop':
+            # Resolve the generated job path once so the evaluator watches the same directory
+            job_dir = model.make_job_output(job_dir, params['no_generated_job_path'])
+            params['no_generated_job_path'] = False
+        sidecar = evaluator.start_sidecar(args.trainer, args.table_id, job_dir, args.avro_bucket, args.avro_prefix, params)
+
+    if params['warm_start_from'] and args.trainer == 'keras':
+        logging.warning("--warm-start-from is not supported by the keras trainer and is ignored")
+
+    if params['memory_profile'] is True and args.trainer != 'loop':
+        logging.warning("--memory-profile is only supported by the loop trainer and is ignored")
 
-    if args.distribute is True:
-        return model.train_and_evaluate_dist(
+    if params['input_workers'] > 0 and args.trainer != 'loop':
+        logging.warning("--input-workers is only supported by the loop trainer and is ignored")
+    elif params['input_workers'] > 0:
+        input_service.start(params)
+
+    if args.trainer == 'loop':
+        model_loop.train_and_evaluate(
+            args.table_id,
+            job_dir,
+            params=params,
+            job_name=job_name,
+            task_index=task_index,
+            hypertune=args.hypertune,
+            bucket_name=args.avro_bucket,
+            prefix=args.avro_prefix,
+        )
+    elif args.trainer == 'keras':
+        model_keras.train_and_evaluate(
+            args.table_id,
+            job_dir,
+            params=params,
+            job_name=job_name,
+            task_index=task_index,
+            num_workers=args.num_workers,
+        )
+    elif args.distribute is True:
+        model.train_and_evaluate_dist(
             args.table_id, 
-            args.job_dir, 
+            job_dir, 
             args.avro_bucket,
             args.avro_prefix,
             params=params,
@@ -94,9 +226,9 @@ def train_and_evaluate(args):
             # hypertune=args.hypertune
         )
     else:
-        return model.train_and_evaluate_local(
+        model.train_and_evaluate_local(
             args.table_id, 
-            args.job_dir, 
+            job_dir, 
             args.avro_bucket,
             args.avro_prefix,
             params=params,
@@ -106,6 +238,28 @@ def train_and_evaluate(args):
             # hypertune=args.hypertune
         )
 
+    input_service.stop()
+
+    if sidecar is not None:
+        process, training_done = sidecar
+        logging.info("Training finished; waiting for the sidecar evaluator")
+        training_done.set()
+        process.join()
+
+
+def evaluate(args):
+    params = get_params(args)
+    params = threads.resolve(params)
+
+    # --job-dir is the directory the checkpoints are written to, with any generated suffix
+    evaluator.run(args.trainer, args.table_id, args.job_dir, args.avro_bucket, args.avro_prefix, params)
+
+
+def input_worker(args):
+    if not args.input_service_address:
+        raise ValueError("--task=input-worker needs --input-service-address")
+    input_service.run_worker(args.input_service_address)
+
 
 def save_model(args):
     params = get_params(args)
@@ -128,6 +282,28 @@ if __name__ == '__main__':
         type=str,
         help='Get data from BigQuery Storiage API or avro files',
         default='bigquery')
+    parser.add_argument(
+        '--features',
+        type=str,
+        help='Comma separated subset of features to read and train on. Default: all features',
+        default='')
+    parser.add_argument(
+        '--sample-fraction',
+        type=float,
+        help='Read a deterministic hash-based sample of this fraction of the rows (Avro: of the blocks). Default: 1.0',
+        default=1.)
+    parser.add_argument(
+        '--negative-rate',
+        type=float,
+        help='Fraction of non-cash (majority class) training rows to keep, chosen by a hash of each row '
+             'so every epoch keeps the same rows. Default: 1.0',
+        default=1.)
+    parser.add_argument(
+        '--downsample-correction',
+        type=str,
+        help='With --negative-rate below 1: `loss` weights kept negatives in the loss and train metrics, '
+             '`export` corrects the predicted probabilities in evaluation and the exported model. Default: loss',
+        default='loss')
     parser.add_argument(
         '--distribute',
         type=bool,
@@ -136,8 +312,14 @@ if __name__ == '__main__':
     parser.add_argument(
         '--distribute-strategy',
         type=str,
-        help='Distribute strategy. Can be `parameter-server` or `multi-worker`. Default: multi-worker',
-        default='multi-worker')
+        help='Distribute strategy. Can be `multi-worker`, `parameter-server` (Estimator only), `mirrored` or `one-device`. '
+             'Default: parameter-server for the distributed Estimator, multi-worker for the custom loop, mirrored for keras',
+        default='')
+    parser.add_argument(
+        '--trainer',
+        type=str,
+        help='Training implementation. Can be `estimator`, `loop` (custom training loop) or `keras` (Model.fit). Default: estimator',
+        default='estimator')
     parser.add_argument(
         '--hypertune',
         type=bool,
@@ -148,6 +330,11 @@ if __name__ == '__main__':
         type=int,
         help='Number of workers in distribution strategy',
         default=1)
+    parser.add_argument(
+        '--throughput-dir',
+        type=str,
+        help='Local directory each task writes its trained examples and training seconds to (used by trainer.cluster)',
+        default='')
     parser.add_argument(
         '--log-step-count-steps',
         type=int,
@@ -158,6 +345,57 @@ if __name__ == '__main__':
         type=int,
         help='Steps (batches) to run before writing Tensorflow scalar summaries. Default: 100',
         default=100)
+    parser.add_argument(
+        '--step-timing',
+        action='store_true',
+        help='Record input wait, host-to-device and compute wall time for every step (custom loop only)',
+    )
+    parser.add_argument(
+        '--async-io',
+        action='store_true',
+        help='Write checkpoints and summaries from a background thread (custom loop only)',
+    )
+    parser.add_argument(
+        '--io-queue-size',
+        type=int,
+        help='Maximum pending background writes before training waits for them. Default: 8',
+        default=8)
+    parser.add_argument(
+        '--profile-steps',
+        type=str,
+        help='Capture a TF profiler trace between two global steps, e.g. `100,110`. Default: off',
+        default='')
+    parser.add_argument(
+        '--profile-dir',
+        type=str,
+        help='Local directory to write profiler traces to. Default: profile',
+        default='profile')
+    parser.add_argument(
+        '--profile-python',
+        action='store_true',
+        help='Also sample Python stacks of the input generators during the profile window',
+    )
+    parser.add_argument(
+        '--profile-python-functions',
+        type=str,
+        help='Comma separated Python function names to sample with --profile-python. Default: {}'.format(
+            ','.join(profiling.DEFAULT_PYTHON_FUNCTIONS)),
+        default=','.join(profiling.DEFAULT_PYTHON_FUNCTIONS))
+    parser.add_argument(
+        '--memory-profile',
+        action='store_true',
+        help='Sample RSS and Python allocations of each input stage and of the first train steps, and write '
+             'memory_report.json and TensorBoard scalars to --profile-dir (custom loop only)')
+    parser.add_argument(
+        '--memory-profile-steps',
+        type=int,
+        help='Batches read by each input stage, and train steps sampled, by --memory-profile. Default: 50',
+        default=50)
+    parser.add_argument(
+        '--memory-sample-ms',
+        type=int,
+        help='Milliseconds between --memory-profile samples. Default: 50',
+        default=50)
     parser.add_argument(
         '--table-id',
         type=str,
@@ -166,7 +404,7 @@ if __name__ == '__main__':
     parser.add_argument(
         '--avro-bucket',
         type=str,
-        help='Name of GCS bucket with avro data',
+        help='Name of GCS bucket with avro data, or a local directory (absolute path or file://) standing in for it',
         default='gcp-cert-demo-1'
     )
     parser.add_argument(
@@ -175,10 +413,37 @@ if __name__ == '__main__':
         help='Path prefix to avro data in GCS bucket',
         default='data/avro/1_pct'
     )
+    parser.add_argument(
+        '--avro-endpoint',
+        type=str,
+        help='API endpoint of a fake GCS server to read --avro-bucket from, e.g. http://localhost:4443',
+        default='')
+    parser.add_argument(
+        '--download-threads',
+        type=int,
+        help='Concurrent Avro object range downloads. Default: 8',
+        default=8)
+    parser.add_argument(
+        '--download-range-mb',
+        type=float,
+        help='Size of each Avro object range download in MB. Default: 8',
+        default=8)
+    parser.add_argument(
+        '--read-ahead-mb',
+        type=float,
+        help='Downloaded Avro bytes buffered ahead of decoding, in MB; each object being read may exceed it by one range. Default: 256',
+        default=256)
+    parser.add_argument(
+        '--shard-filter',
+        type=str,
+        help='Comma separated conditions like `year_norm>=0.5`; Avro shards whose manifest column ranges rule them '
+             'out are not read. Rows of the shards read are not filtered. Default: off',
+        default='')
     parser.add_argument(
         '--task',
         type=str,
-        help='train or save. Default: train',
+        help='train, evaluate (sidecar evaluator for a running job), input-worker (decodes input for a '
+             'running job\'s --input-service-port) or save. Default: train',
         default='train')
     parser.add_argument(
         '--job-dir',
@@ -193,8 +458,33 @@ if __name__ == '__main__':
     parser.add_argument(
         '--cycle-length',
         type=int,
-        help='The number of input elements that will be processed concurrently. Should be set to the number of available CPUs. Default: 8',
-        default=8)
+        help='The number of input elements that will be processed concurrently. Default: 0 (number of available CPUs)',
+        default=0)
+    parser.add_argument(
+        '--intra-op-threads',
+        type=int,
+        help='Threads used within a TF op. Default: 0 (number of available CPUs)',
+        default=0)
+    parser.add_argument(
+        '--inter-op-threads',
+        type=int,
+        help='Threads used to run independent TF ops concurrently. Default: 0 (2)',
+        default=0)
+    parser.add_argument(
+        '--data-threads',
+        type=int,
+        help='Size of the private tf.data threadpool for the input pipeline. Default: 0 (number of available CPUs)',
+        default=0)
+    parser.add_argument(
+        '--thread-calibration-steps',
+        type=int,
+        help='Train this many steps with each of a few input/compute thread splits and keep the fastest. Default: 0 (off)',
+        default=0)
+    parser.add_argument(
+        '--thread-calibration-file',
+        type=str,
+        help='Reuse the thread split from a previous thread_calibration.json instead of calibrating',
+        default='')
     parser.add_argument(
         '--dense-neurons-1',
         type=int,
@@ -239,6 +529,113 @@ if __name__ == '__main__':
         '--batch-size-float',
         type=float,
         help='Batch size as float (for hypertuning only, do not use)')
+    parser.add_argument(
+        '--jit-compile',
+        action='store_true',
+        help='XLA compile the train step',
+    )
+    parser.add_argument(
+        '--precision',
+        type=str,
+        help='`float32` or `mixed_bfloat16` (bfloat16 compute with float32 weights and output). Default: float32',
+        default='float32')
+    parser.add_argument(
+        '--grad-accum-steps',
+        type=int,
+        help='Split each batch into this many micro-batches and accumulate their gradients before updating (custom loop only). Default: 1',
+        default=1)
+    parser.add_argument(
+        '--steps-per-execution',
+        type=int,
+        help='Number of train steps to run inside each tf.function call (custom loop only). Default: 1',
+        default=1)
+    parser.add_argument(
+        '--input-workers',
+        type=int,
+        help='Decode input rows in this many local worker processes behind a dispatcher instead of in the '
+             'training process; 0 decodes in process (custom loop only). Default: 0',
+        default=0)
+    parser.add_argument(
+        '--input-service-port',
+        type=int,
+        help='Port of the --input-workers dispatcher, listening on every interface for input workers on other '
+             'hosts (needs INPUT_SERVICE_AUTHKEY); 0 picks a free port on localhost. Default: 0',
+        default=0)
+    parser.add_argument(
+        '--input-service-address',
+        type=str,
+        help='host:port of the dispatcher a --task=input-worker connects to',
+        default='')
+    parser.add_argument(
+        '--allreduce-pack',
+        action='store_true',
+        help='All-reduce the gradients as one packed buffer per step instead of one tensor per variable (custom loop only)')
+    parser.add_argument(
+        '--allreduce-dtype',
+        type=str,
+        help='Dtype of the gradient all-reduce: `float32`, `float16` or `bfloat16` (custom loop only). Default: float32',
+        default='float32')
+    parser.add_argument(
+        '--local-sgd-steps',
+        type=int,
+        help='Train each replica locally and average the weights every this many steps instead of all-reducing gradients every step (custom loop only). Default: 1',
+        default=1)
+    parser.add_argument(
+        '--resumable',
+        action='store_true',
+        help='Checkpoint the input position with the weights and resume mid-epoch after preemption '
+             '(custom loop, single training task only)')
+    parser.add_argument(
+        '--checkpoint-steps',
+        type=int,
+        help='Steps between mid-epoch checkpoints with --resumable; 0 only checkpoints at epoch end and on SIGTERM. Default: 0',
+        default=0)
+    parser.add_argument(
+        '--sidecar-eval',
+        action='store_true',
+        help='Evaluate checkpoints in a separate local process instead of pausing training to evaluate')
+    parser.add_argument(
+        '--eval-threads',
+        type=int,
+        help='CPUs given to the sidecar evaluator and taken from training; 0 uses a quarter of them. Default: 0',
+        default=0)
+    parser.add_argument(
+        '--eval-interval-secs',
+        type=int,
+        help='Minimum seconds between sidecar evaluations. Default: 0',
+        default=0)
+    parser.add_argument(
+        '--eval-timeout-secs',
+        type=int,
+        help='Seconds `--task=evaluate` waits for a new checkpoint before exiting. Default: 600',
+        default=600)
+    parser.add_argument(
+        '--warm-start-from',
+        type=str,
+        help='Checkpoint, or job directory of its latest checkpoint, to initialize the weights from. Default: off',
+        default='')
+    parser.add_argument(
+        '--warm-start-steps',
+        type=int,
+        help='Train steps of a warm start; 0 trains --epochs epochs. Default: 0',
+        default=0)
+    parser.add_argument(
+        '--warm-start-baseline',
+        type=str,
+        help='Checkpoint, or job directory, of a full retrain to evaluate the warm-started model against; the '
+             'comparison is written to warm_start_report.json in the job directory. Default: off',
+        default='')
+    parser.add_argument(
+        '--new-data-since',
+        type=str,
+        help='Train only on rows added since then: a start_time timestamp for BigQuery, or the pipeline.py run '
+             'number of the first new shards for Avro. Test and validation are not restricted. Default: off',
+        default='')
+    parser.add_argument(
+        '--replay-fraction',
+        type=float,
+        help='Fraction of the train rows before --new-data-since mixed into the new rows. Default: 0',
+        default=0.)
     parser.add_argument(
         '--epochs',
         type=int,
@@ -268,7 +665,11 @@ if __name__ == '__main__':
 
     if args.task in ['train']:
         train_and_evaluate(args)
+    elif args.task in ['evaluate']:
+        evaluate(args)
+    elif args.task in ['input-worker']:
+        input_worker(args)
     elif args.task in 'save':
         save_model(args)
     else:
-        logging.error('--task must be \'train\' or \'save\'')
+        logging.error('--task must be \'train\', \'evaluate\', \'input-worker\' or \'save\'')
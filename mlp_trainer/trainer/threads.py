@@ -0,0 +1,227 @@
+import json
+import math
+import multiprocessing
+import os
+from typing import Any, Dict, List, Optional
+
+import tensorflow as tf
+
+import trainer.base_model as base_model
+import trainer.timing as timing
+from trainer.data import features as features
+from trainer.data import source as source
+
+CALIBRATION_FILE = 'thread_calibration.json'
+
+# Share of the CPUs given to the tf.data threadpool in each calibration run
+CALIBRATION_DATA_FRACTIONS = [0.25, 0.5, 0.75]
+
+
+def available_cpus() -> int:
+    """CPUs this process may use, honoring cgroup CPU quotas (e.g. Kubernetes limits)"""
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    quota = _cgroup_quota()
+    if quota is not None:
+        cpus = min(cpus, quota)
+    return max(1, cpus)
+
+
+def _cgroup_quota() -> Optional[int]:
+    # cgroup v2
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+        if quota != 'max':
+            return int(math.ceil(int(quota) / int(period)))
+        return None
+    except (IOError, OSError, ValueError):
+        pass
+    # cgroup v1
+    try:
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+            quota = int(f.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+            period = int(f.read())
+        if quota > 0 and period > 0:
+            return int(math.ceil(quota / period))
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+def resolve(params: Dict[str, Any]) -> Dict[str, Any]:
+    """Fills thread options left at 0 (auto) from the available CPUs.
+
+    With --sidecar-eval, --eval-threads CPUs are left to the evaluator, and
+    with --input-workers one CPU is left to each local input worker.
+    """
+    cpus = available_cpus()
+    if not params.get('eval_threads'):
+        params['eval_threads'] = max(1, cpus // 4)
+    if params.get('sidecar_eval'):
+        cpus = max(1, cpus - params['eval_threads'])
+    if params.get('input_workers'):
+        cpus = max(1, cpus - params['input_workers'])
+    if not params.get('cycle_length'):
+        params['cycle_length'] = cpus
+    if not params.get('data_threads'):
+        params['data_threads'] = cpus
+    if not params.get('intra_op_threads'):
+        params['intra_op_threads'] = cpus
+    if not params.get('inter_op_threads'):
+        params['inter_op_threads'] = 2
+    tf.get_logger().info("Using {} CPUs: intra-op threads {}; inter-op threads {}; tf.data threads {}; cycle length {}".format(
+        cpus,
+        params['intra_op_threads'],
+        params['inter_op_threads'],
+        params['data_threads'],
+        params['cycle_length'],
+    ))
+    return params
+
+
+def configure(params: Dict[str, Any]):
+    """Sets the TF runtime threadpools. Must run before any TF op executes"""
+    tf.config.threading.set_intra_op_parallelism_threads(params['intra_op_threads'])
+    tf.config.threading.set_inter_op_parallelism_threads(params['inter_op_threads'])
+
+
+def session_config(params: Dict[str, Any]) -> tf.compat.v1.ConfigProto:
+    """The same threadpool sizes for graph sessions, which do not use the runtime settings"""
+    return tf.compat.v1.ConfigProto(
+        allow_soft_placement=True,
+        intra_op_parallelism_threads=params['intra_op_threads'],
+        inter_op_parallelism_threads=params['inter_op_threads'],
+    )
+
+
+def dataset_options(params: Dict[str, Any]) -> tf.data.Options:
+    """Options giving a dataset its own tf.data threadpool of --data-threads threads"""
+    options = tf.data.Options()
+    threading = getattr(options, 'threading', None) or options.experimental_threading
+    threading.private_threadpool_size = params['data_threads']
+    return options
+
+
+def candidates(params: Dict[str, Any]) -> List[Dict[str, int]]:
+    """Splits of the available CPUs between input and compute, in a fixed order"""
+    cpus = available_cpus()
+    splits = []
+    for fraction in CALIBRATION_DATA_FRACTIONS:
+        data_threads = max(1, int(round(cpus * fraction)))
+        split = {
+            'data_threads': data_threads,
+            'cycle_length': data_threads,
+            'intra_op_threads': max(1, cpus - data_threads),
+            'inter_op_threads': params['inter_op_threads'],
+        }
+        if split not in splits:
+            splits.append(split)
+    return splits
+
+
+def _measure(params: Dict[str, Any], table_id: str, bucket_name: str, prefix: str, steps: int,
+             queue: multiprocessing.Queue):
+    """Runs in a fresh process so the TF threadpools can be sized per candidate"""
+    configure(params)
+    features.select(params['features'])
+    tf.random.set_seed(0)
+
+    # The input service is not running yet, so the candidate reads --data-source itself
+    dataset = source.get_data(
+        params,
+        table_id,
+        bucket_name,
+        prefix,
+        'train',
+        negative_rate=params['negative_rate'],
+    ).with_options(dataset_options(params))
+
+    model = base_model.get(params)
+    optimizer = tf.optimizers.Adam(learning_rate=params['learning_rate'])
+    loss_object = tf.keras.losses.BinaryCrossentropy()
+
+    @tf.function
+    def train_step(features, labels):
+        with tf.GradientTape() as tape:
+            loss = loss_object(labels, model(features, training=True))
+        gradients = tape.gradient(loss, model.trainable_variables)
+        optimizer.apply_gradients(zip(gradients, model.trainable_variables))
+        return loss
+
+    iterator = iter(dataset)
+    # The first step traces the function and fills the input buffers
+    batch_features, batch_labels = next(iterator)
+    train_step(batch_features, batch_labels).numpy()
+
+    start = timing.now()
+    completed = 0
+    loss = None
+    for batch_features, batch_labels in iterator:
+        loss = train_step(batch_features, batch_labels)
+        completed += 1
+        if completed == steps:
+            break
+    if loss is None:
+        # The data ran out after the first step; there is nothing to time
+        queue.put(None)
+        return
+    loss.numpy()
+    queue.put(completed / (timing.now() - start))
+
+
+def calibrate(params: Dict[str, Any], table_id: str, bucket_name: str, prefix: str, job_dir: str) -> Dict[str, Any]:
+    """Picks the fastest input/compute thread split over the first training steps.
+
+    Each candidate from candidates() trains for --thread-calibration-steps
+    steps in its own process. The result is logged and written to
+    `thread_calibration.json` in the job directory; passing that file back
+    with --thread-calibration-file reuses the split without re-running.
+    Candidates that fail or time no step are not picked; when none is
+    timed, the resolved defaults are kept and no file is written.
+    """
+    if params.get('thread_calibration_file'):
+        with tf.io.gfile.GFile(params['thread_calibration_file']) as f:
+            calibration = json.load(f)
+        tf.get_logger().info("Using thread split from {}: {}".format(params['thread_calibration_file'], calibration['best']))
+        params.update(calibration['best'])
+        return params
+
+    steps = params['thread_calibration_steps']
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for candidate in candidates(params):
+        candidate_params = dict(params)
+        candidate_params.update(candidate)
+        queue = context.Queue()
+        process = context.Process(target=_measure, args=(candidate_params, table_id, bucket_name, prefix, steps, queue))
+        process.start()
+        process.join()
+        steps_per_sec = queue.get() if process.exitcode == 0 else None
+        if steps_per_sec is None:
+            tf.get_logger().warning("Thread calibration: {} did not complete a timed step (exit code {})".format(
+                candidate, process.exitcode))
+        else:
+            tf.get_logger().info("Thread calibration: {} -> {} steps/sec".format(candidate, round(steps_per_sec, 3)))
+        results.append({'threads': candidate, 'steps_per_sec': steps_per_sec})
+
+    measured = [result for result in results if result['steps_per_sec']]
+    if not measured:
+        tf.get_logger().warning("Thread calibration measured no candidate; keeping the default split")
+        return params
+    best = max(measured, key=lambda result: result['steps_per_sec'])
+    calibration = {
+        'cpus': available_cpus(),
+        'steps': steps,
+        'batch_size': params['batch_size'],
+        'results': results,
+        'best': best['threads'],
+    }
+    tf.get_logger().info("Thread calibration picked {}".format(best['threads']))
+
+    tf.io.gfile.makedirs(job_dir)
+    with tf.io.gfile.GFile('{}/{}'.format(job_dir, CALIBRATION_FILE), 'w') as f:
+        json.dump(calibration, f, indent=2)
+
+    params.update(best['threads'])
+    return params
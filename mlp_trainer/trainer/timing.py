@@ -0,0 +1,103 @@
+import json
+import os
+import time
+from typing import Dict, List
+
+import tensorflow as tf
+
+PHASES = ('input_wait', 'host_to_device', 'compute')
+
+
+class StepTimer(object):
+    """Collects wall-clock time spent in each phase of a training step.
+
+    Phases are `input_wait` (blocked on the input pipeline), `host_to_device`
+    (placing the batch on the replica devices) and `compute` (the train step
+    itself, until its loss is available on the host).
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._times = {phase: [] for phase in PHASES}
+        self._window_start = 0
+
+    def record(self, phase: str, seconds: float):
+        self._times[phase].append(seconds)
+
+    def steps(self) -> int:
+        return max(len(times) for times in self._times.values())
+
+    def window(self) -> Dict[str, float]:
+        """Mean milliseconds per phase since the previous call to window()"""
+        means = {}
+        for phase, times in self._times.items():
+            recent = times[self._window_start:]
+            means[phase] = _mean_ms(recent)
+        self._window_start = self.steps()
+        return means
+
+    def summary(self) -> Dict[str, float]:
+        """Totals, means and the input-bound fraction for every recorded step"""
+        summary = {'steps': self.steps()}
+        total = 0.0
+        for phase, times in self._times.items():
+            summary['{}_total_secs'.format(phase)] = sum(times)
+            summary['{}_mean_ms'.format(phase)] = _mean_ms(times)
+            summary['{}_p90_ms'.format(phase)] = _percentile_ms(times, 90)
+            total += sum(times)
+
+        summary['input_bound_fraction'] = \
+            sum(self._times['input_wait']) / total if total > 0 else 0.0
+        summary['bound'] = 'input' if summary['input_bound_fraction'] > 0.5 else 'compute'
+        return summary
+
+
+class ThroughputHook(tf.estimator.SessionRunHook):
+    """Writes the examples this task trained on and how long it took, for --throughput-dir"""
+
+    def __init__(self, directory: str, task_key: str, batch_size: int):
+        self.directory = directory
+        self.task_key = task_key
+        self.batch_size = batch_size
+        self._steps = 0
+        self._start = None
+
+    def after_create_session(self, session, coord):
+        self._start = now()
+
+    def after_run(self, run_context, run_values):
+        # Counts this task's own steps; the global step also counts other workers'
+        self._steps += 1
+
+    def end(self, session):
+        write_throughput(self.directory, self.task_key, self._steps * self.batch_size, now() - self._start)
+
+
+def write_throughput(directory: str, task_key: str, examples: int, seconds: float, train_loss=None):
+    """Writes `{directory}/{task_key}.json`, read by the cluster harness"""
+    os.makedirs(directory, exist_ok=True)
+    result = {'task': task_key, 'examples': examples, 'seconds': seconds}
+    if train_loss is not None:
+        result['train_loss'] = train_loss
+    with open(os.path.join(directory, '{}.json'.format(task_key)), 'w') as f:
+        json.dump(result, f)
+
+
+def now() -> float:
+    return time.perf_counter()
+
+
+def _mean_ms(times: List[float]) -> float:
+    if len(times) == 0:
+        return 0.0
+    return 1000 * sum(times) / len(times)
+
+
+def _percentile_ms(times: List[float], percentile: int) -> float:
+    if len(times) == 0:
+        return 0.0
+    ordered = sorted(times)
+    index = min(len(ordered) - 1, int(round((percentile / 100.) * (len(ordered) - 1))))
+    return 1000 * ordered[index]
@@ -0,0 +1,96 @@
+"""Warm-started retraining on the rows added since a previous training run.
+
+With --warm-start-from the Estimator and the custom loop start from the
+weights of a previous run's checkpoint instead of random ones. Training
+then reads only the new rows of the train partition (--new-data-since),
+plus a --replay-fraction sample of the older rows so the model does not
+drift towards the latest months, for --warm-start-steps steps. Test and
+validation always cover the whole partition.
+
+With --warm-start-baseline, a checkpoint of a full retrain on the same
+data, the warm-started model, the previous model and the baseline are
+evaluated on the same rows and the results are written to
+`warm_start_report.json` in the job directory.
+"""
+import json
+import math
+import re
+from typing import Any, Dict, Optional
+
+import tensorflow as tf
+
+REPORT_FILE = 'warm_start_report.json'
+
+# Variables the Estimator does not warm start, by name prefix: the step counter,
+# so --warm-start-steps counts from zero, and the slots and hyperparameters in the
+# name scope of each --optimizer, so the new --learning-rate applies
+NOT_WARM_STARTED = ['global_step:', 'Adam/', 'RMSprop/', 'SGD/']
+
+
+def checkpoint_path(path: str) -> str:
+    """The latest checkpoint of a job directory, or `path` itself when it names a checkpoint"""
+    if tf.io.gfile.isdir(path):
+        latest = tf.train.latest_checkpoint(path)
+        if latest is None:
+            raise ValueError("No checkpoint in {}".format(path))
+        return latest
+    return path
+
+
+def validate(params: Dict[str, Any]):
+    if not 0. <= params['replay_fraction'] <= 1.:
+        raise ValueError("--replay-fraction must be in [0, 1], got {}".format(params['replay_fraction']))
+    if params['replay_fraction'] > 0. and not params['new_data_since']:
+        raise ValueError("--replay-fraction samples the rows before --new-data-since, which is not set")
+    if params['warm_start_steps'] < 0:
+        raise ValueError("--warm-start-steps must be at least 0, got {}".format(params['warm_start_steps']))
+    if (params['warm_start_steps'] or params['warm_start_baseline']) and not params['warm_start_from']:
+        raise ValueError("--warm-start-steps and --warm-start-baseline need --warm-start-from")
+
+
+def estimator_settings(params: Dict[str, Any]) -> Optional[tf.estimator.WarmStartSettings]:
+    """Initializes the Estimator's model variables, BatchNormalization statistics included, from --warm-start-from
+
+    A list of patterns is matched against global variables, not only trainable ones.
+    """
+    if not params.get('warm_start_from'):
+        return None
+    return tf.estimator.WarmStartSettings(
+        ckpt_to_initialize_from=checkpoint_path(params['warm_start_from']),
+        vars_to_warm_start=['(?!{}).*'.format('|'.join(re.escape(prefix) for prefix in NOT_WARM_STARTED))],
+    )
+
+
+def max_steps(train_steps_per_epoch: int, params: Dict[str, Any]) -> int:
+    """--warm-start-steps when set, else --epochs full epochs"""
+    if params.get('warm_start_steps'):
+        return params['warm_start_steps']
+    return train_steps_per_epoch * params['epochs']
+
+
+def _scalars(metrics: Dict[str, Any]) -> Dict[str, float]:
+    return {name: float(value) for name, value in metrics.items()}
+
+
+def report(job_dir: str, warm_start: Dict[str, Any], baseline: Dict[str, Any],
+           previous: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Writes the evaluations of the warm-started model and the full retrain, and their differences"""
+    warm_start = _scalars(warm_start)
+    baseline = _scalars(baseline)
+    result = {
+        'warm_start': warm_start,
+        'baseline': baseline,
+        # Warm start minus baseline; negative losses and positive scores favor the warm start
+        'difference': {
+            name: warm_start[name] - baseline[name]
+            for name in sorted(warm_start)
+            if name != 'global_step' and name in baseline and not math.isnan(baseline[name])
+        },
+    }
+    if previous is not None:
+        result['previous'] = _scalars(previous)
+    tf.get_logger().info("Warm start report: {}".format(result['difference']))
+    tf.io.gfile.makedirs(job_dir)
+    with tf.io.gfile.GFile('{}/{}'.format(job_dir, REPORT_FILE), 'w') as f:
+        json.dump(result, f, indent=2, sort_keys=True)
+    return result
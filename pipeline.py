@@ -1,17 +1,27 @@
 from __future__ import absolute_import
 import argparse, logging
-from typing import Any, Tuple, Dict, Iterator
+import functools
+import hashlib
+import inspect
+import json
+import math
+from typing import Any, Callable, Tuple, Dict, Iterator
 import tensorflow as tf 
 import apache_beam as beam
 import subprocess
 import posixpath
+from apache_beam.io.filesystem import CompressionTypes
 from apache_beam.options.pipeline_options import PipelineOptions
 import tensorflow_transform as tft
 import tensorflow_transform.beam as tft_beam
+from tensorflow_transform.beam.tft_beam_io import transform_fn_io
 from tensorflow_transform.tf_metadata import dataset_metadata
 from tensorflow_transform.tf_metadata import dataset_schema
 from tensorflow_transform.coders import ExampleProtoCoder
 
+from mlp_trainer.trainer.data import features
+from mlp_trainer.trainer.data import manifest
+
 class SplitPartitions(beam.DoFn):
    def process(self, element: dict) -> Iterator[Dict[(str, Any)]]:
       if element.get('ml_partition') == 'train':
@@ -22,70 +32,320 @@ class SplitPartitions(beam.DoFn):
         yield beam.pvalue.TaggedOutput('validation', element)
 
 def get_metadata() -> dataset_metadata.DatasetMetadata:
-    return dataset_metadata.DatasetMetadata(dataset_schema.from_feature_spec({ #  
-     'cash':tf.io.FixedLenFeature([], tf.int64), 
-     'year_norm':tf.io.FixedLenFeature([], tf.float32), 
-     'start_time_norm_midnight':tf.io.FixedLenFeature([], tf.float32), 
-     'start_time_norm_noon':tf.io.FixedLenFeature([], tf.float32), 
-     'pickup_lat_std':tf.io.FixedLenFeature([], tf.float32), 
-     'pickup_long_std':tf.io.FixedLenFeature([], tf.float32), 
-     'pickup_lat_centered':tf.io.FixedLenFeature([], tf.float32), 
-     'pickup_long_centered':tf.io.FixedLenFeature([], tf.float32), 
-     'day_of_week_MONDAY':tf.io.FixedLenFeature([], tf.float32), 
-     'day_of_week_TUESDAY':tf.io.FixedLenFeature([], tf.float32), 
-     'day_of_week_WEDNESDAY':tf.io.FixedLenFeature([], tf.float32), 
-     'day_of_week_THURSDAY':tf.io.FixedLenFeature([], tf.float32), 
-     'day_of_week_FRIDAY':tf.io.FixedLenFeature([], tf.float32), 
-     'day_of_week_SATURDAY':tf.io.FixedLenFeature([], tf.float32), 
-     'day_of_week_SUNDAY':tf.io.FixedLenFeature([], tf.float32), 
-     'month_JANUARY':tf.io.FixedLenFeature([], tf.float32), 
-     'month_FEBRUARY':tf.io.FixedLenFeature([], tf.float32), 
-     'month_MARCH':tf.io.FixedLenFeature([], tf.float32), 
-     'month_APRIL':tf.io.FixedLenFeature([], tf.float32), 
-     'month_MAY':tf.io.FixedLenFeature([], tf.float32), 
-     'month_JUNE':tf.io.FixedLenFeature([], tf.float32), 
-     'month_JULY':tf.io.FixedLenFeature([], tf.float32), 
-     'month_AUGUST':tf.io.FixedLenFeature([], tf.float32), 
-     'month_SEPTEMBER':tf.io.FixedLenFeature([], tf.float32), 
-     'month_OCTOBER':tf.io.FixedLenFeature([], tf.float32), 
-     'month_NOVEMBER':tf.io.FixedLenFeature([], tf.float32), 
-     'month_DECEMBER':tf.io.FixedLenFeature([], tf.float32)}))
+    return dataset_metadata.DatasetMetadata(dataset_schema.from_feature_spec(features.feature_spec()))
 
 def preprocessing_fn(input):
-    return {'cash':input.get('cash'), 
-     'year_norm':input.get('year_norm'), 
-     'start_time_norm_midnight':input.get('start_time_norm_midnight'), 
-     'start_time_norm_noon':input.get('start_time_norm_noon'), 
-     'pickup_lat_std':input.get('pickup_lat_std'), 
-     'pickup_long_std':input.get('pickup_long_std'), 
-     'pickup_lat_centered':input.get('pickup_lat_centered'), 
-     'pickup_long_centered':input.get('pickup_long_centered'), 
-     'day_of_week_MONDAY':input.get('day_of_week_MONDAY'), 
-     'day_of_week_TUESDAY':input.get('day_of_week_TUESDAY'), 
-     'day_of_week_WEDNESDAY':input.get('day_of_week_WEDNESDAY'), 
-     'day_of_week_THURSDAY':input.get('day_of_week_THURSDAY'), 
-     'day_of_week_FRIDAY':input.get('day_of_week_FRIDAY'), 
-     'day_of_week_SATURDAY':input.get('day_of_week_SATURDAY'), 
-     'day_of_week_SUNDAY':input.get('day_of_week_SUNDAY'), 
-     'month_JANUARY':input.get('month_JANUARY'), 
-     'month_FEBRUARY':input.get('month_FEBRUARY'), 
-     'month_MARCH':input.get('month_MARCH'), 
-     'month_APRIL':input.get('month_APRIL'), 
-     'month_MAY':input.get('month_MAY'), 
-     'month_JUNE':input.get('month_JUNE'), 
-     'month_JULY':input.get('month_JULY'), 
-     'month_AUGUST':input.get('month_AUGUST'), 
-     'month_SEPTEMBER':input.get('month_SEPTEMBER'), 
-     'month_OCTOBER':input.get('month_OCTOBER'), 
-     'month_NOVEMBER':input.get('month_NOVEMBER'), 
-     'month_DECEMBER':input.get('month_DECEMBER')}
-
-
-def write_tfrecords(transformed_dataset, location, step):
+    return {name: input.get(name) for name in features.feature_spec()}
+
+
+STATE_FILE = '_pipeline_state.json'
+PARTITIONS = ['train', 'test', 'validation']
+
+# --tfrecord_compression: Beam compression type and file suffix. `zlib` is
+# TensorFlow's ZLIB record compression (DEFLATE with a zlib header).
+TFRECORD_COMPRESSION = {
+    'none': (CompressionTypes.UNCOMPRESSED, '.tfrecords'),
+    'gzip': (CompressionTypes.GZIP, '.tfrecords.gz'),
+    'zlib': (CompressionTypes.DEFLATE, '.tfrecords.zz'),
+}
+
+# --avro_codec values; `zstandard` needs the zstandard package, `snappy` python-snappy
+AVRO_CODECS = ['null', 'deflate', 'snappy', 'zstandard']
+
+# Bytes TFRecord adds around each record: length, length CRC and data CRC
+TFRECORD_FRAMING_BYTES = 16
+
+# TensorFlow's name of each --tfrecord_compression, to read the shards back
+TFRECORD_READ_COMPRESSION = {'none': '', 'gzip': 'GZIP', 'zlib': 'ZLIB'}
+
+
+def definitions_fingerprint() -> str:
+    """Hash of the transform definitions. A change forces a full re-analysis."""
+    source = inspect.getsource(preprocessing_fn) + inspect.getsource(get_metadata) + repr(sorted(
+        (name, spec.dtype.name) for name, spec in features.feature_spec().items()))
+    return hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+
+def file_fingerprint(path: str) -> str:
+    digest = hashlib.sha256()
+    with tf.io.gfile.GFile(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_state(location: str) -> Dict[str, Any]:
+    path = posixpath.join(location, STATE_FILE)
+    if not tf.io.gfile.exists(path):
+        return {}
+    with tf.io.gfile.GFile(path) as f:
+        return json.load(f)
+
+
+def write_state(location: str, state: Dict[str, Any]):
+    tf.io.gfile.makedirs(location)
+    with tf.io.gfile.GFile(posixpath.join(location, STATE_FILE), 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+
+
+def bigquery_inputs(known_args) -> Dict[str, Any]:
+    """Cheap fingerprint of the BigQuery input: row count and newest trip"""
+    from google.cloud import bigquery
+    rows = bigquery.Client(project=known_args.project).query(
+        "SELECT COUNT(*), CAST(MAX(start_time) AS STRING) FROM `{}.{}.{}`".format(
+            known_args.project, known_args.dataset, known_args.table)).result()
+    count, watermark = list(rows)[0]
+    return {
+        'table': '{}.{}.{}'.format(known_args.project, known_args.dataset, known_args.table),
+        'rows': count,
+        'watermark': watermark,
+    }
+
+
+def file_inputs(known_args) -> Dict[str, Any]:
+    """Fingerprint of local or GCS newline delimited JSON input files"""
+    files = sorted(tf.io.gfile.glob(posixpath.join(known_args.input_path, '*.json')))
+    return {'files': {path: file_fingerprint(path) for path in files}}
+
+
+def bigquery_rows_through(known_args, watermark: str) -> int:
+    """Rows of the BigQuery input that started at or before `watermark`"""
+    from google.cloud import bigquery
+    rows = bigquery.Client(project=known_args.project).query(
+        "SELECT COUNT(*) FROM `{}.{}.{}` WHERE start_time <= TIMESTAMP('{}')".format(
+            known_args.project, known_args.dataset, known_args.table, watermark)).result()
+    return list(rows)[0][0]
+
+
+def plan_run(state: Dict[str, Any], inputs: Dict[str, Any],
+             rows_through: Callable[[str], int] = None) -> Tuple[str, Any]:
+    """Decides between a full run, an incremental run over new rows, or skipping.
+
+    Returns the mode ('full', 'incremental' or 'skip') and, for incremental
+    runs, what is new: the previous watermark for BigQuery or the list of new
+    files for file input. `rows_through(watermark)` counts the BigQuery rows
+    that started at or before `watermark`, to detect rows that arrived late.
+    """
+    if not state or state.get('definitions') != definitions_fingerprint():
+        return 'full', None
+    previous = state.get('inputs', {})
+    if previous == inputs:
+        return 'skip', None
+
+    if 'files' in inputs:
+        old_files = previous.get('files', {})
+        changed = [path for path, digest in old_files.items() if inputs['files'].get(path) != digest]
+        if changed:
+            # Rows were edited or removed rather than appended
+            return 'full', None
+        return 'incremental', [path for path in inputs['files'] if path not in old_files]
+
+    if (previous.get('table') == inputs['table'] and previous.get('watermark') is not None
+            and inputs['watermark'] > previous['watermark'] and inputs['rows'] > previous['rows']):
+        if rows_through is not None and rows_through(previous['watermark']) != previous['rows']:
+            # Rows older than the previous watermark were added or removed since;
+            # reading only newer start times would miss them for good
+            return 'full', None
+        return 'incremental', previous['watermark']
+    return 'full', None
+
+
+def read_partition(p, known_args, partition: str, new_rows=None):
+    if known_args.input_path:
+        files = new_rows if new_rows is not None else tf.io.gfile.glob(posixpath.join(known_args.input_path, '*.json'))
+        return (p
+            | 'Read files {}'.format(partition) >> beam.Create(sorted(files))
+            | 'Read lines {}'.format(partition) >> beam.io.ReadAllFromText()
+            | 'Parse {}'.format(partition) >> beam.Map(json.loads)
+            | 'Filter {}'.format(partition) >> beam.Filter(lambda row, partition=partition: row.get('ml_partition') == partition))
+
+    query = "SELECT * FROM `{}.{}.{}` WHERE ml_partition='{}'".format(known_args.project, known_args.dataset, known_args.table, partition)
+    if new_rows is not None:
+        query += " AND start_time > TIMESTAMP('{}')".format(new_rows)
+    return p | 'ReadBigQuery {}'.format(partition) >> beam.io.Read(beam.io.BigQuerySource(query=query,
+        use_standard_sql=True))
+
+
+def partition_rows(known_args, partition: str, new_rows=None) -> int:
+    """Rows read_partition will read, to size shards from --target_shard_mb"""
+    if known_args.input_path:
+        files = new_rows if new_rows is not None else tf.io.gfile.glob(posixpath.join(known_args.input_path, '*.json'))
+        input_manifest = read_manifest(known_args.input_path)
+        if input_manifest is not None:
+            # Per partition row counts written by trainer.data.etl
+            names = {posixpath.basename(path) for path in files}
+            return sum(shard.get('partitions', {}).get(partition, 0)
+                       for shard in input_manifest['shards'] if shard['path'] in names)
+        count = 0
+        for path in files:
+            with tf.io.gfile.GFile(path) as f:
+                count += sum(1 for line in f if line.strip() and json.loads(line).get('ml_partition') == partition)
+        return count
+
+    from google.cloud import bigquery
+    query = "SELECT COUNT(*) FROM `{}.{}.{}` WHERE ml_partition='{}'".format(
+        known_args.project, known_args.dataset, known_args.table, partition)
+    if new_rows is not None:
+        query += " AND start_time > TIMESTAMP('{}')".format(new_rows)
+    return list(bigquery.Client(project=known_args.project).query(query).result())[0][0]
+
+
+def zero_row() -> Dict[str, Any]:
+    return {name: 0 if spec.dtype == tf.int64 else 0. for name, spec in features.feature_spec().items()}
+
+
+def avro_schema() -> Dict[str, Any]:
+    return {
+        'type': 'record',
+        'name': 'TaxiTrip',
+        'fields': [{'name': name, 'type': 'long' if spec.dtype == tf.int64 else 'float'}
+                   for name, spec in features.feature_spec().items()],
+    }
+
+
+def to_avro_record(row: Dict[str, Any]) -> Dict[str, Any]:
+    spec = features.feature_spec()
+    return {name: int(row[name]) if spec[name].dtype == tf.int64 else float(row[name]) for name in spec}
+
+
+def tfrecord_row_bytes() -> int:
+    return len(ExampleProtoCoder(get_metadata().schema).encode(zero_row())) + TFRECORD_FRAMING_BYTES
+
+
+def avro_row_bytes() -> int:
+    # Floats are 4 bytes; a long label is a 1 byte varint
+    return sum(1 if spec.dtype == tf.int64 else 4 for spec in features.feature_spec().values())
+
+
+def num_shards(rows: int, row_bytes: int, target_shard_mb: float) -> int:
+    """Shards of about `target_shard_mb` before compression; 0 lets the runner decide"""
+    if target_shard_mb <= 0:
+        return 0
+    return max(1, int(math.ceil(rows * row_bytes / (target_shard_mb * (1 << 20)))))
+
+
+def read_manifest(directory: str):
+    path = posixpath.join(directory, manifest.MANIFEST_FILE)
+    if not tf.io.gfile.exists(path):
+        return None
+    with tf.io.gfile.GFile(path) as f:
+        return manifest.from_json(f.read())
+
+
+def shard_path(path: str, partition: str) -> str:
+    """Path of a shard relative to its manifest, which is next to the partition directories"""
+    return posixpath.join(partition, posixpath.basename(path))
+
+
+def describe_tfrecord_shard(path: str, partition: str, compression: str) -> Dict[str, Any]:
+    """Manifest entry of one written TFRecord shard, read back once by the writer"""
+    coder = ExampleProtoCoder(get_metadata().schema)
+    options = tf.io.TFRecordOptions(TFRECORD_READ_COMPRESSION[compression])
+    stats = {}
+    rows = 0
+    for record in tf.compat.v1.io.tf_record_iterator(path, options=options):
+        manifest.add_row(stats, coder.decode(record))
+        rows += 1
+    return manifest.shard(shard_path(path, partition), partition, 'tfrecord', compression, rows,
+                          tf.io.gfile.stat(path).length, stats)
+
+
+def describe_avro_shard(path: str, partition: str) -> Dict[str, Any]:
+    """Manifest entry of one written Avro shard, read back once by the writer"""
+    import fastavro
+    stats = {}
+    rows = 0
+    with tf.io.gfile.GFile(path, 'rb') as f:
+        avro_reader = fastavro.reader(f)
+        codec = avro_reader.metadata.get('avro.codec', 'null')
+        for row in avro_reader:
+            manifest.add_row(stats, row)
+            rows += 1
+    return manifest.shard(shard_path(path, partition), partition, 'avro', codec, rows,
+                          tf.io.gfile.stat(path).length, stats)
+
+
+def write_manifest(shards, directory: str, run=0):
+    """Writes the manifest of `directory`. Incremental runs add their shards to the previous one"""
+    previous = read_manifest(directory) if run > 0 else None
+    result = manifest.merge(previous or manifest.new(), shards)
+    with tf.io.gfile.GFile(posixpath.join(directory, manifest.MANIFEST_FILE), 'w') as f:
+        f.write(manifest.to_json(result))
+    logging.info('Wrote manifest of %d shards to %s', len(result['shards']), directory)
+
+
+def write_tfrecords(transformed_dataset, location, step, run=0, compression='none', shards=0):
+    """Writes the rows as TFRecords; returns the manifest entries of the written shards"""
     transformed_data, transformed_metadata = transformed_dataset
-    transformed_data | '{} - Write Transformed Data'.format(step) >> beam.io.tfrecordio.WriteToTFRecord(file_path_prefix=('{}/{}/{}'.format(location, step, step)),
-      file_name_suffix='.tfrecords',
+    compression_type, suffix = TFRECORD_COMPRESSION[compression]
+    # Incremental runs write new shards next to the existing ones
+    prefix = step if run == 0 else '{}-run{}'.format(step, run)
+    written = transformed_data | '{} - Write Transformed Data'.format(step) >> beam.io.tfrecordio.WriteToTFRecord(file_path_prefix=('{}/{}/{}'.format(location, step, prefix)),
+      file_name_suffix=suffix,
+      num_shards=shards,
+      compression_type=compression_type,
       coder=(ExampleProtoCoder(get_metadata().schema)))
+    return written | '{} - Describe TFRecord shards'.format(step) >> beam.Map(
+      describe_tfrecord_shard, step, compression)
+
+
+def write_avro(transformed_dataset, location, step, run=0, codec='deflate', shards=0):
+    """Writes the transformed rows as Avro for the trainer's --data-source=avro reader; returns the manifest entries"""
+    transformed_data, transformed_metadata = transformed_dataset
+    prefix = step if run == 0 else '{}-run{}'.format(step, run)
+    return (transformed_data
+      | '{} - To Avro records'.format(step) >> beam.Map(to_avro_record)
+      | '{} - Write Avro'.format(step) >> beam.io.WriteToAvro(
+          '{}/avro/{}/{}'.format(location, step, prefix),
+          schema=avro_schema(),
+          codec=codec,
+          file_name_suffix='.avro',
+          num_shards=shards,
+          use_fastavro=True)
+      | '{} - Describe Avro shards'.format(step) >> beam.Map(
+          describe_avro_shard, step))
+
+
+def write_outputs(known_args, transformed_dataset, location, partition, run=0, new_rows=None) -> Dict[str, Any]:
+    """Writes one partition in every output format; returns the manifest entries by output directory"""
+    rows = partition_rows(known_args, partition, new_rows) if known_args.target_shard_mb > 0 else 0
+    shards = {location: write_tfrecords(transformed_dataset, location, partition, run,
+      compression=known_args.tfrecord_compression,
+      shards=num_shards(rows, tfrecord_row_bytes(), known_args.target_shard_mb))}
+    if known_args.avro_codec:
+        shards['{}/avro'.format(location)] = write_avro(transformed_dataset, location, partition, run,
+          codec=known_args.avro_codec,
+          shards=num_shards(rows, avro_row_bytes(), known_args.target_shard_mb))
+    return shards
+
+
+def write_manifests(shards_by_partition, run=0):
+    """One manifest per output directory, covering the shards of every partition"""
+    for index, directory in enumerate(sorted(shards_by_partition[0])):
+        (tuple(shards[directory] for shards in shards_by_partition)
+          | 'Manifest {} - Flatten'.format(index) >> beam.Flatten()
+          | 'Manifest {} - Collect'.format(index) >> beam.combiners.ToList()
+          | 'Manifest {} - Write'.format(index) >> beam.Map(write_manifest, directory, run))
+
+
+def clear_outputs(location: str):
+    """Removes the shards, manifests and run state of `location` before a full run.
+
+    The state goes first so a full run that fails is followed by another full
+    run rather than skipping over the emptied outputs.
+    """
+    state_path = posixpath.join(location, STATE_FILE)
+    if tf.io.gfile.exists(state_path):
+        tf.io.gfile.remove(state_path)
+    for partition in PARTITIONS:
+        for path in (tf.io.gfile.glob('{}/{}/*.tfrecords*'.format(location, partition)) +
+                     tf.io.gfile.glob('{}/avro/{}/*.avro'.format(location, partition))):
+            tf.io.gfile.remove(path)
+    for directory in [location, '{}/avro'.format(location)]:
+        path = posixpath.join(directory, manifest.MANIFEST_FILE)
+        if tf.io.gfile.exists(path):
+            tf.io.gfile.remove(path)
+
 
 def run(argv=None, save_main_session=True):
     parser = argparse.ArgumentParser()
@@ -104,42 +364,97 @@ def run(argv=None, save_main_session=True):
     parser.add_argument('--output_path', dest='output_path',
       default='data/tfrecord',
       help='')
+    parser.add_argument('--input_path', dest='input_path',
+      default='',
+      help='Read newline delimited JSON rows from *.json files in this directory instead of BigQuery')
+    parser.add_argument('--local', dest='local',
+      action='store_true',
+      help='Run on the DirectRunner and write to --output_path on the local filesystem')
+    parser.add_argument('--force', dest='force',
+      action='store_true',
+      help='Re-analyze and rewrite everything even if the inputs are unchanged')
+    parser.add_argument('--tfrecord_compression', dest='tfrecord_compression',
+      default='none', choices=sorted(TFRECORD_COMPRESSION),
+      help='Compression of the TFRecord shards')
+    parser.add_argument('--avro_codec', dest='avro_codec',
+      default='', choices=[''] + AVRO_CODECS,
+      help='Also write Avro shards under avro/ with this block codec')
+    parser.add_argument('--target_shard_mb', dest='target_shard_mb',
+      default=0., type=float,
+      help='Approximate size of each shard before compression; 0 lets the runner choose the shard count')
     known_args, pipeline_args = parser.parse_known_args(argv)
-    pipeline_args.extend([
-     '--runner=DataflowRunner',
-     '--project=ml-sandbox-1-191918',
-     '--staging_location=gs://ntc-mls-dataflow-staging/python',
-     '--temp_location=gs://ntc-mls-dataflow-tmp/python',
-     '--job_name=gcp-demo1-tf-etl-12',
-     '--setup_file=/Users/acarnevale/Projects/ntc-ml/setup.py',
-     '--experiments=shuffle_mode=service',
-     '--max_num_workers=4',
-     '--worker_machine_type=n1-standard-4',
-     '--service_account_email=261855689705-compute@developer.gserviceaccount.com',
-     '--region=us-central1'])
+
+    if known_args.local:
+        location = known_args.output_path
+        temp_dir = posixpath.join(location, 'tmp')
+        pipeline_args.extend(['--runner=DirectRunner'])
+    else:
+        location = 'gs://{}/{}'.format(known_args.output_bucket, known_args.output_path)
+        temp_dir = 'gs://ntc-mls-dataflow-tmp/python'
+        pipeline_args.extend([
+         '--runner=DataflowRunner',
+         '--project=ml-sandbox-1-191918',
+         '--staging_location=gs://ntc-mls-dataflow-staging/python',
+         '--temp_location=gs://ntc-mls-dataflow-tmp/python',
+         '--job_name=gcp-demo1-tf-etl-12',
+         '--setup_file=/Users/acarnevale/Projects/ntc-ml/setup.py',
+         '--experiments=shuffle_mode=service',
+         '--max_num_workers=4',
+         '--worker_machine_type=n1-standard-4',
+         '--service_account_email=261855689705-compute@developer.gserviceaccount.com',
+         '--region=us-central1'])
+
+    state = {} if known_args.force else read_state(location)
+    inputs = file_inputs(known_args) if known_args.input_path else bigquery_inputs(known_args)
+    rows_through = None if known_args.input_path else functools.partial(bigquery_rows_through, known_args)
+    mode, new_rows = plan_run(state, inputs, rows_through)
+    if mode != 'full' and (state.get('tfrecord_compression', 'none'), state.get('avro_codec', '')) != (
+            known_args.tfrecord_compression, known_args.avro_codec):
+        # Every shard of a partition must share one format
+        logging.info('Output compression changed; rewriting everything')
+        mode, new_rows = 'full', None
+    transform_fn_dir = posixpath.join(location, 'transform')
+    run_number = 0 if mode == 'full' else state.get('run', 0) + 1
+    logging.info('Preprocessing mode: %s (run %d)', mode, run_number)
+    if mode == 'skip':
+        logging.info('Inputs and transform definitions unchanged since run %d. Nothing to do.', state.get('run', 0))
+        return
+    if mode == 'full':
+        clear_outputs(location)
 
     pipeline_options = PipelineOptions(pipeline_args).view_as(beam.options.pipeline_options.GoogleCloudOptions)
     with beam.Pipeline(options=pipeline_options) as p:
-        with tft_beam.Context(temp_dir='gs://ntc-mls-dataflow-tmp/python'):
-            training_data = p | 'ReadBigQuery training' >> beam.io.Read(beam.io.BigQuerySource(query=("SELECT * FROM `{}.{}.{}` WHERE ml_partition='train'".format(known_args.project, known_args.dataset, known_args.table)),
-                use_standard_sql=True))
-            test_data = p | 'ReadBigQuery test' >> beam.io.Read(beam.io.BigQuerySource(query=("SELECT * FROM `{}.{}.{}` WHERE ml_partition='test'".format(known_args.project, known_args.dataset, known_args.table)),
-                use_standard_sql=True))
-            validation_data = p | 'ReadBigQuery eval' >> beam.io.Read(beam.io.BigQuerySource(query=("SELECT * FROM `{}.{}.{}` WHERE ml_partition='validation'".format(known_args.project, known_args.dataset, known_args.table)),
-                use_standard_sql=True))
-            
-            transformed_train_dataset, transform_fn = ( # pylint: disable=unused-variable
-              training_data, get_metadata()) | '{} - Transform'.format('train') >> tft_beam.AnalyzeAndTransformDataset(preprocessing_fn)
-            write_tfrecords(transformed_train_dataset, 'gs://{}/{}'.format(known_args.output_bucket, known_args.output_path), 'train')
-
-            transformed_test_dataset, transform_fn = ( # pylint: disable=unused-variable
-              test_data, get_metadata()) | '{} - Transform'.format('test') >> tft_beam.AnalyzeAndTransformDataset(preprocessing_fn)
-            write_tfrecords(transformed_test_dataset, 'gs://{}/{}'.format(known_args.output_bucket, known_args.output_path), 'test')
-            
-            transformed_validation_dataset, transform_fn = ( # pylint: disable=unused-variable
-              validation_data, get_metadata())| '{} - Transform'.format('validation') >> tft_beam.AnalyzeAndTransformDataset(preprocessing_fn)
-            write_tfrecords(transformed_validation_dataset, 'gs://{}/{}'.format(known_args.output_bucket, known_args.output_path), 'validation')
-            
+        with tft_beam.Context(temp_dir=temp_dir):
+            if mode == 'full':
+                # Analyze the training data only and apply the same transform to every partition
+                training_data = read_partition(p, known_args, 'train')
+                transformed_train_dataset, transform_fn = (
+                  training_data, get_metadata()) | '{} - Transform'.format('train') >> tft_beam.AnalyzeAndTransformDataset(preprocessing_fn)
+                transform_fn | 'Write transform function' >> transform_fn_io.WriteTransformFn(transform_fn_dir)
+            else:
+                # Reuse the previously saved transform function for the new rows only
+                transform_fn = p | 'Read transform function' >> transform_fn_io.ReadTransformFn(transform_fn_dir)
+                training_data = read_partition(p, known_args, 'train', new_rows)
+                transformed_train_dataset = (
+                  (training_data, get_metadata()), transform_fn) | '{} - Transform'.format('train') >> tft_beam.TransformDataset()
+            shards = [write_outputs(known_args, transformed_train_dataset, location, 'train', run_number, new_rows)]
+
+            for partition in ['test', 'validation']:
+                partition_data = read_partition(p, known_args, partition, new_rows)
+                transformed_dataset = (
+                  (partition_data, get_metadata()), transform_fn) | '{} - Transform'.format(partition) >> tft_beam.TransformDataset()
+                shards.append(write_outputs(known_args, transformed_dataset, location, partition, run_number, new_rows))
+            write_manifests(shards, run_number)
+
+    write_state(location, {
+        'definitions': definitions_fingerprint(),
+        'inputs': inputs,
+        'run': run_number,
+        'transform_fn': transform_fn_dir,
+        'tfrecord_compression': known_args.tfrecord_compression,
+        'avro_codec': known_args.avro_codec,
+    })
+
 if __name__ == '__main__':
     logging.getLogger().setLevel(logging.INFO)
     run()
@@ -0,0 +1,10 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# pipeline.py is imported from the repository root and the trainer's modules
+# import each other as `trainer.*` from mlp_trainer/, as in its Docker image
+for path in [ROOT, os.path.join(ROOT, 'mlp_trainer')]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
@@ -0,0 +1,25 @@
+import json
+
+import pytest
+
+from trainer import cluster
+
+
+def test_cluster_spec():
+    assert cluster.cluster_spec(1, 0, 2222) == {'master': ['localhost:2222']}
+    assert cluster.cluster_spec(3, 1, 2222) == {
+        'master': ['localhost:2222'],
+        'worker': ['localhost:2223', 'localhost:2224'],
+        'ps': ['localhost:2225'],
+    }
+    assert json.loads(cluster.tf_config({'master': ['localhost:2222']}, 'master', 0))['task'] == {
+        'type': 'master', 'index': 0}
+
+
+def test_scaling_efficiency():
+    results = cluster.add_scaling_efficiency([
+        {'workers': 1, 'examples_per_sec': 100.},
+        {'workers': 2, 'examples_per_sec': 180.},
+        {'workers': 4, 'examples_per_sec': 400.},
+    ])
+    assert [result['scaling_efficiency'] for result in results] == pytest.approx([1., .9, 1.])
@@ -0,0 +1,33 @@
+import pytest
+
+downsampling = pytest.importorskip('trainer.data.downsampling')
+
+
+def rows(count, label):
+    return [[index / 7., (index % 13) / 13., label] for index in range(count)]
+
+
+def test_keep_row_keeps_every_positive():
+    assert all(downsampling.keep_row(row, .01) for row in rows(1000, 1))
+
+
+def test_keep_row_is_deterministic():
+    negatives = rows(2000, 0)
+    first = [downsampling.keep_row(row, .3) for row in negatives]
+    assert first == [downsampling.keep_row(list(row), .3) for row in negatives]
+    assert abs(sum(first) / len(first) - .3) < .05
+
+
+def test_keep_row_keeps_everything_at_rate_one():
+    assert all(downsampling.keep_row(row, 1.) for row in rows(1000, 0))
+
+
+def test_weights():
+    assert downsampling.weights([[1], [0], [0]], .25).numpy().tolist() == [1., 4., 4.]
+
+
+def test_correct_probability_undoes_the_downsampling():
+    # 10% positives; keeping a quarter of the negatives makes them 4 / 13 of the rows
+    learned = .1 / (.1 + .9 * .25)
+    assert downsampling.correct_probability(learned, .25) == pytest.approx(.1)
+    assert downsampling.correct_probability(.3, 1.) == pytest.approx(.3)
@@ -0,0 +1,112 @@
+import json
+import math
+
+import pytest
+
+pytest.importorskip('pandas')
+etl = pytest.importorskip('trainer.data.etl')
+from trainer.data import manifest
+
+TRIPS = [
+    {'unique_key': 'a', 'trip_start_timestamp': '2019-03-04 12:00:00 UTC', 'trip_seconds': 600, 'trip_miles': 2.,
+     'fare': 10., 'payment_type': 'Cash', 'company': 'Taxi Co.', 'pickup_latitude': 41.9,
+     'pickup_longitude': -87.6},
+    {'unique_key': 'b', 'trip_start_timestamp': '2020-07-10 18:30:15 UTC', 'trip_seconds': 900, 'trip_miles': 3.,
+     'fare': 12., 'payment_type': 'Credit Card', 'company': 'Other Cab', 'pickup_latitude': 41.8,
+     'pickup_longitude': -87.7},
+    # Filtered out: no company, no miles, unknown payment type
+    {'unique_key': 'c', 'trip_start_timestamp': '2020-01-01 00:00:00 UTC', 'trip_seconds': 60, 'trip_miles': 1.,
+     'fare': 5., 'payment_type': 'Cash', 'company': None, 'pickup_latitude': 41.8, 'pickup_longitude': -87.7},
+    {'unique_key': 'd', 'trip_start_timestamp': '2020-01-01 00:00:00 UTC', 'trip_seconds': 60, 'trip_miles': 0.,
+     'fare': 5., 'payment_type': 'Cash', 'company': 'Taxi Co.', 'pickup_latitude': 41.8, 'pickup_longitude': -87.7},
+    {'unique_key': 'e', 'trip_start_timestamp': '2020-01-01 00:00:00 UTC', 'trip_seconds': 60, 'trip_miles': 1.,
+     'fare': 5., 'payment_type': 'Unknown', 'company': 'Taxi Co.', 'pickup_latitude': 41.8,
+     'pickup_longitude': -87.7},
+]
+
+
+def options(tmp_path, **overrides):
+    values = {
+        'input': str(tmp_path / 'raw' / '*.json'), 'output_dir': str(tmp_path / 'encoded'), 'output_format': 'json',
+        'workers': 1, 'chunk_rows': 2, 'map_center_lat': 41.8839, 'map_center_long': -87.6319,
+        'hot_encode_company': True, 'train_weight': 70., 'test_weight': 15., 'validation_weight': 15.,
+        'sample_size': 100, 'seed': 0,
+    }
+    values.update(overrides)
+    return values
+
+
+def write_trips(tmp_path):
+    (tmp_path / 'raw').mkdir()
+    with open(str(tmp_path / 'raw' / 'trips-0.json'), 'w') as f:
+        f.write(''.join(json.dumps(trip) + '\n' for trip in TRIPS))
+
+
+def test_clean_company():
+    companies = etl.pd.Series(['Taxi Co.', ' Blue  Cab ', None])
+    assert list(etl.clean_company(companies)) == ['taxi_co', '_blue__cab_', '']
+
+
+def test_merge_stats_matches_one_pass():
+    trips = etl.filter_rows(etl.pd.DataFrame(TRIPS))
+    assert list(trips['unique_key']) == ['a', 'b']
+    opts = {'hot_encode_company': True}
+    whole = etl.chunk_stats(trips, opts)
+    merged = etl.merge_stats(etl.chunk_stats(trips.iloc[:1], opts), etl.chunk_stats(trips.iloc[1:], opts))
+    merged = etl.merge_stats(merged, etl.empty_stats())
+    assert merged == whole
+    assert (whole['min_year'], whole['max_year'], whole['companies']) == (2019, 2020, {'taxi_co', 'other_cab'})
+
+
+def test_normalize_times():
+    hours = etl.np.array([0, 12, 18])
+    minutes = etl.np.array([0, 0, 30])
+    secs = etl.np.array([0, 0, 15])
+    times = etl.normalize_times(hours * 3600. + minutes * 60 + secs, hours, minutes, secs)
+    assert list(times['start_time_norm_midnight'][:2]) == [0., 12 * 3600 / etl.MAX_DAY_SECONDS]
+    assert list(times['start_time_norm_noon'][:2]) == [-1., 0.]
+    # Off the hour, minute and second outside 12 o'clock, as the Dataflow job writes it
+    assert times['start_time_norm_noon'][2] == 0.
+
+
+def test_run_writes_encoded_rows_and_manifest(tmp_path):
+    write_trips(tmp_path)
+    stats = etl.run(options(tmp_path))
+    assert stats['rows'] == 2
+    assert math.isclose(stats['pickup_latitude']['mean'], 41.85)
+
+    with open(str(tmp_path / 'encoded' / 'trips-00000-of-00001.json')) as f:
+        rows = [json.loads(line) for line in f]
+    assert [row['unique_key'] for row in rows] == ['a', 'b']
+    assert list(rows[0]) == etl.output_columns(stats, options(tmp_path))
+    assert [row['cash'] for row in rows] == [1, 0]
+    assert [row['year_norm'] for row in rows] == [0., 1.]
+    assert rows[0]['day_of_week_MONDAY'] == 1 and rows[1]['day_of_week_FRIDAY'] == 1
+    assert rows[0]['month_MARCH'] == 1 and rows[1]['month_JULY'] == 1
+    assert (rows[0]['company_taxi_co'], rows[0]['company_other_cab']) == (1, 0)
+
+    with open(str(tmp_path / 'encoded' / manifest.MANIFEST_FILE)) as f:
+        data = manifest.from_json(f.read())
+    [shard] = data['shards']
+    assert shard['rows'] == 2 and sum(shard['partitions'].values()) == 2
+    assert shard['columns']['cash']['mean'] == .5
+    assert data['encoding']['min_year'] == 2019
+
+
+def test_run_is_reproducible_and_samples(tmp_path):
+    write_trips(tmp_path)
+    etl.run(options(tmp_path, output_format='csv'))
+    with open(str(tmp_path / 'encoded' / 'trips-00000-of-00001.csv')) as f:
+        first = f.read()
+    etl.run(options(tmp_path, output_format='csv'))
+    with open(str(tmp_path / 'encoded' / 'trips-00000-of-00001.csv')) as f:
+        assert f.read() == first
+
+    etl.run(options(tmp_path, sample_size=0))
+    with open(str(tmp_path / 'encoded' / manifest.MANIFEST_FILE)) as f:
+        assert manifest.from_json(f.read())['shards'][0]['rows'] == 0
+
+
+def test_run_without_trips(tmp_path):
+    with pytest.raises(ValueError):
+        etl.run(options(tmp_path))
@@ -0,0 +1,55 @@
+import socket
+
+import pytest
+
+input_service = pytest.importorskip('trainer.input_service')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def test_parse_address():
+    assert input_service.parse_address('trainer-host:50051') == ('trainer-host', 50051)
+
+
+def test_decode_unit_chunks_every_row(monkeypatch):
+    rows = [(float(index), float(index % 3), index % 2) for index in range(25)]
+    monkeypatch.setattr(input_service, 'unit_rows', lambda config, unit: iter(rows))
+    chunks = list(input_service.decode_unit({'batch_size': 2, 'negative_rate': 1.}, 'unit'))
+    assert [len(labels) for _, labels in chunks] == [10, 10, 5]
+    decoded = sorted(tuple(values) + (int(label),) for features, labels in chunks
+                     for values, [label] in zip(features.tolist(), labels.tolist()))
+    assert decoded == rows
+
+
+def test_authkey_from_environment(monkeypatch):
+    monkeypatch.setenv(input_service.AUTHKEY_ENV, 'secret')
+    assert input_service.get_authkey(required=True) == b'secret'
+
+
+def test_random_authkey_for_local_workers(monkeypatch):
+    monkeypatch.delenv(input_service.AUTHKEY_ENV, raising=False)
+    first = input_service.get_authkey(required=False)
+    assert len(first) == 32 and first != input_service.get_authkey(required=False)
+    with pytest.raises(ValueError):
+        input_service.get_authkey(required=True)
+
+
+def test_dispatcher_without_fixed_port_listens_on_localhost(monkeypatch):
+    monkeypatch.delenv(input_service.AUTHKEY_ENV, raising=False)
+    service = input_service.InputService(0, 0)
+    try:
+        assert service.manager.address[0] == '127.0.0.1'
+    finally:
+        service.stop()
+
+
+def test_fixed_port_requires_authkey(monkeypatch):
+    monkeypatch.delenv(input_service.AUTHKEY_ENV, raising=False)
+    with pytest.raises(ValueError):
+        input_service.InputService(free_port(), 0)
+    with pytest.raises(ValueError):
+        input_service.run_worker('trainer-host:50051')
@@ -0,0 +1,78 @@
+import pytest
+
+from trainer.data import manifest
+
+
+def entry(path, partition, rows, cash_min=0., cash_max=1., cash_mean=.5):
+    return {'path': path, 'partition': partition, 'format': 'avro', 'codec': 'null', 'rows': rows, 'bytes': 0,
+            'columns': {'cash': {'min': cash_min, 'max': cash_max, 'mean': cash_mean}}}
+
+
+def test_json_round_trip_and_version():
+    data = manifest.new([entry('a.avro', 'train', 10)])
+    assert manifest.from_json(manifest.to_json(data)) == data
+    with pytest.raises(ValueError):
+        manifest.from_json('{"version": 2, "shards": []}')
+
+
+def test_merge_replaces_shards_with_the_same_path():
+    data = manifest.new([entry('b.avro', 'train', 10), entry('a.avro', 'train', 10)])
+    merged = manifest.merge(data, [entry('b.avro', 'train', 20), entry('c.avro', 'test', 5)])
+    assert [(shard['path'], shard['rows']) for shard in merged['shards']] == [
+        ('a.avro', 10), ('b.avro', 20), ('c.avro', 5)]
+
+
+def test_column_stats():
+    stats = {}
+    manifest.add_row(stats, {'cash': 1, 'miles': 2.5, 'company': 'x', 'flag': True})
+    manifest.add_row(stats, {'cash': 0, 'miles': .5})
+    manifest.add_values(stats, 'miles', 10., 10., 0., 0)
+    assert manifest.column_stats(stats) == {
+        'cash': {'min': 0., 'max': 1., 'mean': .5},
+        'miles': {'min': .5, 'max': 2.5, 'mean': 1.5},
+    }
+
+
+def test_parse_filter():
+    assert manifest.parse_filter('year_norm>=0.5, cash=1') == [('year_norm', '>=', .5), ('cash', '=', 1.)]
+    assert manifest.parse_filter('') == []
+    with pytest.raises(ValueError):
+        manifest.parse_filter('year_norm~0.5')
+
+
+@pytest.mark.parametrize('text, matches', [
+    ('cash>=0.5', True),
+    ('cash>1', False),
+    ('cash>0.9', False),
+    ('cash>0.8', True),
+    ('cash<0.2', False),
+    ('cash<=0.2', True),
+    ('cash=0.6', True),
+    ('cash=1', False),
+    ('unknown>100', True),
+])
+def test_may_match(text, matches):
+    assert manifest.may_match(entry('a.avro', 'train', 10, .2, .9), manifest.parse_filter(text)) == matches
+
+
+def test_shards_by_partition_and_filter():
+    data = manifest.new([entry('a.avro', 'train', 10, 0., 0.), entry('b.avro', 'train', 10, 1., 1.),
+                         entry('c.avro', 'test', 10)])
+    assert [shard['path'] for shard in manifest.shards(data, 'train')] == ['a.avro', 'b.avro']
+    assert [shard['path'] for shard in manifest.shards(data, 'train', manifest.parse_filter('cash=1'))] == ['b.avro']
+
+
+def test_plan_balances_rows_and_covers_every_shard():
+    entries = [entry('{}.avro'.format(index), 'train', rows) for index, rows in enumerate([100, 60, 50, 40, 10])]
+    assert manifest.plan(entries, 1, 0) == entries
+    planned = [manifest.plan(entries, 2, task_index) for task_index in range(2)]
+    assert sorted(shard['path'] for shards in planned for shard in shards) == [shard['path'] for shard in entries]
+    assert [sum(shard['rows'] for shard in shards) for shards in planned] == [140, 120]
+
+
+def test_row_count():
+    entries = [entry('a.avro', 'train', 100, cash_mean=.2), entry('b.avro', 'train', 100, cash_mean=.4)]
+    assert manifest.row_count(entries, 'cash') == 200
+    assert manifest.row_count(entries, 'cash', sample_fraction=.5) == 100
+    # 60 positives and half of the 140 negatives
+    assert manifest.row_count(entries, 'cash', negative_rate=.5) == 130
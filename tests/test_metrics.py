@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+metrics = pytest.importorskip('trainer.metrics')
+
+LABELS = np.array([0, 1, 1, 0, 1, 0, 1, 0, 1, 1], dtype=np.int64)
+# Includes predictions exactly at the thresholds
+PREDICTIONS = np.array([.5, .5, .9, .1, .25, .75, .0, .3, 1., .55], dtype=np.float32)
+
+
+def histogram():
+    result = metrics.ConfusionHistogram()
+    result.update_state(LABELS, PREDICTIONS)
+    return result
+
+
+@pytest.mark.parametrize('threshold', [.25, .3, .5, .75])
+def test_scores_match_keras(threshold):
+    scores = histogram().scores(threshold)
+    precision = tf.keras.metrics.Precision(thresholds=threshold)
+    recall = tf.keras.metrics.Recall(thresholds=threshold)
+    precision.update_state(LABELS, PREDICTIONS)
+    recall.update_state(LABELS, PREDICTIONS)
+    assert float(scores['precision']) == pytest.approx(float(precision.result()))
+    assert float(scores['recall']) == pytest.approx(float(recall.result()))
+
+
+def test_curve_matches_keras():
+    rng = np.random.RandomState(0)
+    labels = rng.randint(0, 2, 1000)
+    predictions = np.concatenate([
+        rng.uniform(size=800),
+        np.array(metrics.CURVE_THRESHOLDS * 10 + [0., 1.] * 5),
+    ]).astype(np.float32)
+    result = metrics.ConfusionHistogram()
+    result.update_state(labels, predictions)
+    for threshold in metrics.CURVE_THRESHOLDS:
+        precision = tf.keras.metrics.Precision(thresholds=threshold)
+        precision.update_state(labels, predictions)
+        assert float(result.scores(threshold)['precision']) == pytest.approx(float(precision.result())), threshold
+
+
+def test_confusion_counts():
+    counts = {name: float(value) for name, value in histogram().confusion(.5).items()}
+    assert counts == {'true_positives': 3., 'false_positives': 1., 'true_negatives': 3., 'false_negatives': 3.}
+
+
+def test_auc_close_to_keras():
+    auc = tf.keras.metrics.AUC(num_thresholds=1000)
+    auc.update_state(LABELS, PREDICTIONS)
+    assert float(histogram().auc()) == pytest.approx(float(auc.result()), abs=.02)
+
+
+def test_estimator_evaluate(tmp_path):
+    def input_fn():
+        return tf.data.Dataset.from_tensor_slices((PREDICTIONS[:, None], LABELS[:, None])).batch(4)
+
+    def model_fn(features, labels, mode):
+        global_step = tf.compat.v1.train.get_or_create_global_step()
+        return tf.estimator.EstimatorSpec(
+            mode=mode,
+            loss=tf.constant(0.),
+            train_op=tf.compat.v1.assign_add(global_step, 1),
+            eval_metric_ops=metrics.eval_metric_ops(labels, features),
+        )
+
+    estimator = tf.estimator.Estimator(model_fn, model_dir=str(tmp_path))
+    results = estimator.evaluate(input_fn)
+    assert all(np.ndim(value) == 0 for value in results.values())
+    scores = histogram().scores(.5)
+    assert results['test_precision'] == pytest.approx(float(scores['precision']))
+    assert results['test_recall'] == pytest.approx(float(scores['recall']))
+    assert results['test_true_positives'] == 3.
+    assert results['test_auc'] == pytest.approx(float(histogram().auc()))
+    # A second evaluation starts from an empty histogram
+    assert estimator.evaluate(input_fn)['test_true_positives'] == 3.
@@ -0,0 +1,79 @@
+import pytest
+
+from trainer.data import object_store
+
+
+@pytest.fixture
+def objects(tmp_path):
+    contents = {}
+    for index in range(2):
+        name = 'train/part-{}.avro'.format(index)
+        data = bytes((index * 7 + offset) % 251 for offset in range(10000))
+        (tmp_path / 'train').mkdir(exist_ok=True)
+        (tmp_path / name).write_bytes(data)
+        contents[name] = data
+    return str(tmp_path), contents
+
+
+def make_reader(root, **options):
+    return object_store.ObjectReader(object_store.LocalStore(root), threads=2, **options)
+
+
+def test_local_store_lists_and_reads(objects):
+    root, contents = objects
+    store = object_store.get_store(root)
+    assert list(store.list('train/')) == [(name, 10000) for name in sorted(contents)]
+    assert store.read_range('train/part-1.avro', 10, 20) == contents['train/part-1.avro'][10:20]
+    assert object_store.get_store('file://' + root).root == root
+
+
+def test_sequential_reads(objects):
+    root, contents = objects
+    reader = make_reader(root, range_bytes=1000, read_ahead_bytes=2500)
+    for name, data in sorted(contents.items()):
+        with reader.open(name) as f:
+            assert f.read() == data
+    assert reader.budget.used == 0
+
+
+def test_interleaved_reads_under_a_full_budget(objects):
+    # The budget fits two ranges and a half, so one object often finds it full
+    root, contents = objects
+    reader = make_reader(root, range_bytes=1000, read_ahead_bytes=2500)
+    streams = {name: reader.open(name) for name in sorted(contents)}
+    read = {name: b'' for name in streams}
+    while streams:
+        for name in sorted(streams):
+            chunk = streams[name].read(300)
+            if chunk:
+                read[name] += chunk
+            else:
+                streams.pop(name).close()
+    assert read == contents
+    assert reader.budget.used == 0
+
+
+def test_tell_and_first_range(objects):
+    root, contents = objects
+    reader = make_reader(root, range_bytes=1000)
+    with reader.open('train/part-0.avro') as f:
+        assert f.raw.first_range() == contents['train/part-0.avro'][:1000]
+        f.read(1500)
+        assert f.tell() == 1500
+
+
+def test_close_releases_the_budget(objects):
+    root, _ = objects
+    reader = make_reader(root, range_bytes=1000, read_ahead_bytes=2500)
+    f = reader.open('train/part-0.avro')
+    f.read(10)
+    f.close()
+    assert reader.budget.used == 0
+
+
+def test_list_names(objects):
+    root, contents = objects
+    reader = make_reader(root)
+    assert list(reader.list('train/')) == sorted(contents)
+    assert reader.size('train/part-0.avro') == 10000
+    assert not reader.store.exists('missing')
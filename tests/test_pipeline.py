@@ -0,0 +1,103 @@
+import glob
+import json
+import os
+
+import pytest
+
+pytest.importorskip('apache_beam')
+pytest.importorskip('tensorflow_transform')
+
+import pipeline
+from mlp_trainer.trainer.data import features
+from mlp_trainer.trainer.data import manifest
+
+
+def write_rows(path, count, offset=0):
+    with open(path, 'w') as f:
+        for index in range(offset, offset + count):
+            row = {name: 0. for name in features.feature_spec()}
+            row[features.LABEL] = index % 2
+            row['pickup_lat_std'] = index / 100.
+            row['ml_partition'] = pipeline.PARTITIONS[index % len(pipeline.PARTITIONS)]
+            f.write(json.dumps(row) + '\n')
+
+
+def run_local(inputs, outputs, *args):
+    pipeline.run(['--local', '--input_path', str(inputs), '--output_path', str(outputs)] + list(args))
+    return pipeline.read_state(str(outputs))
+
+
+def manifest_rows(outputs, partition):
+    with open(os.path.join(str(outputs), manifest.MANIFEST_FILE)) as f:
+        shards = manifest.from_json(f.read())['shards']
+    return sum(shard['rows'] for shard in shards if shard['partition'] == partition)
+
+
+def output_files(outputs):
+    return sorted(glob.glob(os.path.join(str(outputs), '*', '*.tfrecords*')))
+
+
+def test_full_skip_and_incremental_runs(tmp_path):
+    inputs = tmp_path / 'inputs'
+    outputs = tmp_path / 'outputs'
+    inputs.mkdir()
+    write_rows(str(inputs / 'part-0.json'), 30)
+
+    state = run_local(inputs, outputs)
+    assert state['run'] == 0
+    assert manifest_rows(outputs, 'train') == 10
+    written = {path: os.path.getmtime(path) for path in output_files(outputs)}
+    assert written
+
+    # Unchanged inputs and definitions: nothing is rewritten
+    assert run_local(inputs, outputs) == state
+    assert {path: os.path.getmtime(path) for path in output_files(outputs)} == written
+
+    # A new input file is transformed on its own into shards of the next run
+    write_rows(str(inputs / 'part-1.json'), 15, offset=30)
+    state = run_local(inputs, outputs)
+    assert state['run'] == 1
+    assert manifest_rows(outputs, 'train') == 15
+    assert manifest_rows(outputs, 'test') == 15
+    new_files = [path for path in output_files(outputs) if path not in written]
+    assert new_files and all('-run1' in os.path.basename(path) for path in new_files)
+    assert all(os.path.getmtime(path) == mtime for path, mtime in written.items())
+
+
+def test_edited_input_forces_full_run(tmp_path):
+    inputs = tmp_path / 'inputs'
+    outputs = tmp_path / 'outputs'
+    inputs.mkdir()
+    write_rows(str(inputs / 'part-0.json'), 9)
+    run_local(inputs, outputs)
+
+    write_rows(str(inputs / 'part-0.json'), 12)
+    state = run_local(inputs, outputs)
+    assert state['run'] == 0
+    assert manifest_rows(outputs, 'train') == 4
+    assert not [path for path in output_files(outputs) if '-run' in os.path.basename(path)]
+
+
+def test_clear_outputs_removes_state(tmp_path):
+    location = str(tmp_path)
+    pipeline.write_state(location, {'run': 3})
+    pipeline.clear_outputs(location)
+    assert pipeline.read_state(location) == {}
+
+
+def bigquery_state(rows, watermark):
+    return {
+        'definitions': pipeline.definitions_fingerprint(),
+        'inputs': {'table': 'project.dataset.table', 'rows': rows, 'watermark': watermark},
+    }
+
+
+def test_plan_run_bigquery():
+    state = bigquery_state(100, '2019-06-30 23:00:00+00')
+    newer = {'table': 'project.dataset.table', 'rows': 120, 'watermark': '2019-07-31 23:00:00+00'}
+
+    assert pipeline.plan_run(state, dict(state['inputs'])) == ('skip', None)
+    assert pipeline.plan_run(state, newer, lambda watermark: 100) == ('incremental', '2019-06-30 23:00:00+00')
+    # Late rows at or before the previous watermark need a full run
+    assert pipeline.plan_run(state, newer, lambda watermark: 105) == ('full', None)
+    assert pipeline.plan_run({}, newer) == ('full', None)
@@ -0,0 +1,177 @@
+import random
+
+import numpy as np
+import pytest
+
+position = pytest.importorskip('trainer.data.position')
+
+
+def positions(stream, offsets):
+    return np.array([[stream, offset] for offset in offsets], dtype=np.int64)
+
+
+def test_watermark_advances_over_contiguous_rows():
+    input_position = position.InputPosition()
+    stream = input_position.stream_index('a')
+    input_position.record(positions(stream, [2, 0, 4]))
+    assert input_position.start_offset('a') == 1
+    assert input_position.skip('a') == frozenset([2, 4])
+
+    input_position.record(positions(stream, [1, 3]))
+    assert input_position.start_offset('a') == 5
+    assert input_position.skip('a') == frozenset()
+
+
+def test_skipped_rows_advance_the_watermark():
+    input_position = position.InputPosition()
+    stream = input_position.stream_index('a')
+    input_position.skip_rows('a', range(0, 10))
+    input_position.record(positions(stream, [11]))
+    assert input_position.start_offset('a') == 10
+    input_position.skip_rows('a', [10])
+    assert input_position.start_offset('a') == 12
+    assert input_position.skip('a') == frozenset()
+
+
+def test_json_round_trip(tmp_path):
+    input_position = position.InputPosition()
+    input_position.session = b'c2Vzc2lvbg=='
+    input_position.record(positions(input_position.stream_index('a'), [0, 1, 5]))
+    input_position.record(positions(input_position.stream_index('b'), [3]))
+
+    position.save(str(tmp_path), 7, 'local-0', {'input_position': input_position.to_json()})
+    restored = position.InputPosition.from_json(position.load(str(tmp_path), 7, 'local-0')['input_position'])
+    assert restored.to_json() == input_position.to_json()
+    assert restored.stream_index('b') == 1
+    assert position.load(str(tmp_path), 8, 'local-0') is None
+
+
+def feature_names():
+    from trainer.data import features
+    return features, [feature['name'] for feature in features.FEATURES]
+
+
+def write_objects(root, objects, rows):
+    """Avro objects of `rows` rows each, in blocks of about a dozen rows, under `root`/train/"""
+    fastavro = pytest.importorskip('fastavro')
+    features, names = feature_names()
+    schema = fastavro.parse_schema({
+        'type': 'record',
+        'name': 'TaxiTrip',
+        'fields': [{'name': features.LABEL, 'type': 'long'}] + [{'name': name, 'type': 'float'} for name in names],
+    })
+    (root / 'train').mkdir(parents=True)
+    for index in range(objects):
+        records = []
+        for row in range(rows):
+            record = {name: float((index * rows + row) % 97) / 97. for name in names}
+            record['pickup_lat_std'] = float(row)
+            record[features.LABEL] = int(row % 3 == 0)
+            records.append(record)
+        with open(str(root / 'train' / 'part-{}.avro'.format(index)), 'wb') as f:
+            fastavro.writer(f, schema, records, sync_interval=2000)
+    return ['train/part-{}.avro'.format(index) for index in range(objects)]
+
+
+class Trainer:
+    """The custom loop's reading and recording, with the interleave and shuffle done in Python"""
+
+    def __init__(self, avro, bucket, objects, input_position, seed):
+        self.avro = avro
+        self.input_position = input_position
+        self.random = random.Random(seed)
+        avro.input_position = input_position
+        self.generators = [
+            avro.generate_blob(bucket.encode('utf-8'), name.encode('utf-8'), with_position=True,
+                               sample_fraction=.6, negative_rate=.5)
+            for name in objects
+        ]
+        self.buffer = []
+        self.trained = []
+
+    def fill(self, size):
+        while len(self.buffer) < size and self.generators:
+            generator = self.generators[self.random.randrange(len(self.generators))]
+            try:
+                self.buffer.append(next(generator))
+            except StopIteration:
+                self.generators.remove(generator)
+
+    def step(self, batch_size=8, buffer_size=40) -> bool:
+        self.fill(buffer_size)
+        if not self.buffer:
+            return False
+        self.random.shuffle(self.buffer)
+        batch, self.buffer = self.buffer[:batch_size], self.buffer[batch_size:]
+        rows = np.array([row[-2:] for row in batch], dtype=np.int64)
+        self.input_position.record(rows)
+        names = self.input_position.to_json()['streams']
+        self.trained.extend((names[stream]['name'], offset) for stream, offset in rows.tolist())
+        return True
+
+    def kill(self):
+        for generator in self.generators:
+            generator.close()
+
+
+def test_kill_and_restart_trains_every_kept_row_once(tmp_path):
+    avro = pytest.importorskip('trainer.data.avro')
+    pytest.importorskip('fastavro')
+    rows = 300
+    objects = write_objects(tmp_path, 2, rows)
+    bucket = str(tmp_path)
+
+    # An uninterrupted epoch: the watermark passes sampled out blocks and dropped negatives
+    full = Trainer(avro, bucket, objects, position.InputPosition(), seed=0)
+    while full.step():
+        pass
+    kept = sorted(full.trained)
+    assert len(kept) == len(set(kept))
+    assert 0 < len(kept) < rows * len(objects)
+    state = full.input_position.to_json()
+    assert [(stream['watermark'], stream['done']) for stream in state['streams']] == [(rows, [])] * len(objects)
+
+    # Checkpoint part way through, train on past it, then lose the process
+    first = Trainer(avro, bucket, objects, position.InputPosition(), seed=1)
+    for _ in range(12):
+        assert first.step()
+    checkpoint = first.input_position.to_json()
+    trained_before = list(first.trained)
+    assert all(stream['watermark'] > 0 for stream in checkpoint['streams'])
+    for _ in range(5):
+        first.step()
+    first.kill()
+
+    restarted = Trainer(avro, bucket, objects, position.InputPosition.from_json(checkpoint), seed=2)
+    while restarted.step():
+        pass
+    trained = trained_before + restarted.trained
+    assert sorted(trained) == kept
+
+
+class Session:
+    def __init__(self, partition):
+        self.partition = partition
+        self.streams = [Stream('{}/stream-0'.format(partition))]
+
+
+class Stream:
+    def __init__(self, name):
+        self.name = name
+
+
+def test_test_pass_reads_its_own_read_session(monkeypatch):
+    bigquery_generator = pytest.importorskip('trainer.data.bigquery_generator')
+    monkeypatch.setattr(bigquery_generator.data, 'get_data_partition_sharded',
+                        lambda table_id, partition, shards, sample_fraction: Session(partition))
+    monkeypatch.setattr(bigquery_generator, 'input_position', position.InputPosition())
+
+    def streams(partition, with_position):
+        return [stream.numpy().decode('utf-8') for _, stream in bigquery_generator.bq_stream_generator(
+            b'project.dataset.table', partition, 1., with_position)]
+
+    assert streams(b'train', True) == ['train/stream-0']
+    # The evaluation between training epochs runs with the train position installed
+    assert streams(b'test', False) == ['test/stream-0']
+    assert streams(b'train', True) == ['train/stream-0']
+    assert bigquery_generator.input_position.session is not None
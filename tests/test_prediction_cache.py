@@ -0,0 +1,97 @@
+import numpy as np
+import pytest
+
+serving = pytest.importorskip('trainer.serving')
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+
+def test_hits_and_misses():
+    cache = serving.PredictionCache()
+    assert cache.get(b'a') is None
+    cache.put(b'a', .25)
+    assert cache.get(b'a') == .25
+    stats = cache.stats()
+    assert (stats['entries'], stats['hits'], stats['misses'], stats['hit_rate']) == (1, 1, 1, .5)
+    assert stats['bytes'] == cache.entry_bytes(b'a')
+
+
+def test_evicts_least_recently_used_by_entries():
+    cache = serving.PredictionCache(max_entries=2)
+    cache.put(b'a', 1.)
+    cache.put(b'b', 2.)
+    cache.get(b'a')
+    cache.put(b'c', 3.)
+    assert cache.get(b'b') is None
+    assert (cache.get(b'a'), cache.get(b'c')) == (1., 3.)
+    assert cache.stats()['evicted'] == 1
+
+
+def test_evicts_by_bytes():
+    cache = serving.PredictionCache(max_bytes=2 * serving.PredictionCache.entry_bytes(b'a'))
+    for key in [b'a', b'b', b'c']:
+        cache.put(key, 0.)
+    stats = cache.stats()
+    assert (stats['entries'], stats['evicted']) == (2, 1)
+    assert stats['bytes'] <= cache.max_bytes
+
+
+def test_replacing_a_key_keeps_the_byte_count():
+    cache = serving.PredictionCache()
+    cache.put(b'a', 1.)
+    cache.put(b'a', 2.)
+    assert (cache.get(b'a'), cache.stats()['entries'], cache.bytes) == (2., 1, cache.entry_bytes(b'a'))
+
+
+def test_ttl():
+    clock = Clock()
+    cache = serving.PredictionCache(ttl_secs=10., clock=clock)
+    cache.put(b'a', 1.)
+    clock.now = 9.
+    assert cache.get(b'a') == 1.
+    clock.now = 10.
+    assert cache.get(b'a') is None
+    stats = cache.stats()
+    assert (stats['entries'], stats['bytes'], stats['expired'], stats['misses']) == (0, 0, 1, 1)
+
+
+def test_invalidate_drops_entries_and_stale_puts():
+    cache = serving.PredictionCache()
+    cache.invalidate('1')
+    cache.put(b'a', 1., version='1')
+    cache.invalidate('2')
+    assert cache.get(b'a') is None
+    cache.put(b'b', 1., version='1')
+    assert cache.get(b'b') is None
+    cache.put(b'b', 2., version='2')
+    assert cache.get(b'b') == 2.
+    assert cache.stats()['invalidations'] == 2
+
+
+def test_requests_during_a_reload_get_predictions_of_the_model_they_run(monkeypatch):
+    exports = {'path': '1'}
+    monkeypatch.setattr(serving, 'latest_version', lambda export_dir: exports['path'])
+    monkeypatch.setattr(serving, 'version_id', lambda path: path)
+    monkeypatch.setattr(serving, 'load_model', lambda path: lambda rows: np.full(len(rows), float(path)))
+    rows = np.zeros([1, 2], dtype=np.float32)
+    served = []
+
+    class ConcurrentCache(serving.PredictionCache):
+        def invalidate(self, version):
+            # A request arriving while load() swaps the model
+            if self.version is not None:
+                served.append((model.version, float(model.predict(rows)[0])))
+            super().invalidate(version)
+
+    model = serving.CachedModel('export', ConcurrentCache(), quanta=np.zeros(2))
+    assert model.predict(rows)[0] == 1.
+    exports['path'] = '2'
+    assert model.load() is True
+    assert served == [('1', 1.)]
+    assert (model.version, model.predict(rows)[0]) == ('2', 2.)
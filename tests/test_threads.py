@@ -0,0 +1,127 @@
+import os
+import queue
+
+import pytest
+
+
+@pytest.fixture
+def threads():
+    return pytest.importorskip('trainer.threads')
+
+
+def fake_files(monkeypatch, module, files):
+    def fake_open(path, *args, **kwargs):
+        if path not in files:
+            raise IOError(path)
+        return __import__('io').StringIO(files[path])
+    monkeypatch.setattr(module, 'open', fake_open, raising=False)
+
+
+@pytest.mark.parametrize('files, quota', [
+    ({'/sys/fs/cgroup/cpu.max': '150000 100000\n'}, 2),
+    ({'/sys/fs/cgroup/cpu.max': 'max 100000\n'}, None),
+    ({'/sys/fs/cgroup/cpu/cpu.cfs_quota_us': '300000\n', '/sys/fs/cgroup/cpu/cpu.cfs_period_us': '100000\n'}, 3),
+    ({'/sys/fs/cgroup/cpu/cpu.cfs_quota_us': '-1\n', '/sys/fs/cgroup/cpu/cpu.cfs_period_us': '100000\n'}, None),
+    ({}, None),
+])
+def test_cgroup_quota(threads, monkeypatch, files, quota):
+    fake_files(monkeypatch, threads, files)
+    assert threads._cgroup_quota() == quota
+
+
+@pytest.mark.parametrize('quota, cpus', [(None, 8), (3, 3), (16, 8)])
+def test_available_cpus(threads, monkeypatch, quota, cpus):
+    monkeypatch.setattr(threads.os, 'sched_getaffinity', lambda pid: set(range(8)), raising=False)
+    monkeypatch.setattr(threads, '_cgroup_quota', lambda: quota)
+    assert threads.available_cpus() == cpus
+
+
+def fake_context(monkeypatch, threads, results):
+    """Runs each calibration candidate in process as an exit code and a queued steps/sec"""
+    results = iter(results)
+
+    class Process:
+        def __init__(self, target, args):
+            self.queue = args[-1]
+
+        def start(self):
+            self.exitcode, steps_per_sec = next(results)
+            if self.exitcode == 0:
+                self.queue.put(steps_per_sec)
+
+        def join(self):
+            pass
+
+    class Context:
+        Queue = queue.Queue
+
+    Context.Process = Process
+    monkeypatch.setattr(threads.multiprocessing, 'get_context', lambda method: Context)
+    monkeypatch.setattr(threads, 'available_cpus', lambda: 4)
+
+
+def calibration_params():
+    return {
+        'thread_calibration_file': '',
+        'thread_calibration_steps': 5,
+        'batch_size': 32,
+        'data_threads': 4,
+        'cycle_length': 4,
+        'intra_op_threads': 4,
+        'inter_op_threads': 2,
+    }
+
+
+def test_calibrate_skips_failed_candidates(threads, monkeypatch, tmp_path):
+    fake_context(monkeypatch, threads, [(1, None), (0, 3.), (0, None)])
+    params = threads.calibrate(calibration_params(), 'table', 'bucket', 'prefix', str(tmp_path))
+    assert (params['data_threads'], params['intra_op_threads']) == (2, 2)
+    assert os.path.exists(str(tmp_path / threads.CALIBRATION_FILE))
+
+
+def test_calibrate_keeps_defaults_without_measurements(threads, monkeypatch, tmp_path):
+    fake_context(monkeypatch, threads, [(1, None), (0, None), (1, None)])
+    params = threads.calibrate(calibration_params(), 'table', 'bucket', 'prefix', str(tmp_path))
+    assert params == calibration_params()
+    assert not os.path.exists(str(tmp_path / threads.CALIBRATION_FILE))
+
+
+def test_measure_reads_the_configured_source_with_the_selected_features(threads, monkeypatch):
+    tf = pytest.importorskip('tensorflow')
+    features = threads.features
+    reads = []
+
+    def fake_get_data(params, table_id, bucket_name, prefix, partition, negative_rate=1.):
+        reads.append({
+            'source': (params['data_source'], table_id, bucket_name, prefix, partition, negative_rate),
+            'columns': features.columns(),
+        })
+        rows = tf.ones([params['batch_size'] * 4, features.num_features()])
+        labels = tf.ones([params['batch_size'] * 4, 1])
+        return tf.data.Dataset.from_tensor_slices((rows, labels)).batch(params['batch_size'])
+
+    models = []
+
+    def fake_model(params):
+        models.append(tf.keras.Sequential([
+            tf.keras.layers.Dense(1, activation='sigmoid', input_shape=(features.num_features(),)),
+        ]))
+        return models[-1]
+
+    # The threadpools cannot be resized once this process has run TF ops
+    monkeypatch.setattr(threads, 'configure', lambda params: None)
+    monkeypatch.setattr(threads.source, 'get_data', fake_get_data)
+    monkeypatch.setattr(threads.base_model, 'get', fake_model)
+    monkeypatch.setattr(features, 'selected', None)
+
+    params = dict(calibration_params(), data_source='avro', features=['month_MAY', 'year_norm'],
+                  negative_rate=.5, learning_rate=.01, batch_size=2)
+    results = queue.Queue()
+    threads._measure(params, 'table', 'bucket', 'prefix', 2, results)
+
+    assert reads == [{
+        'source': ('avro', 'table', 'bucket', 'prefix', 'train', .5),
+        'columns': ['cash', 'year_norm', 'month_MAY'],
+    }]
+    assert models[0].input_shape == (None, 2)
+    assert results.get_nowait() > 0
@@ -0,0 +1,77 @@
+import json
+
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+warm_start = pytest.importorskip('trainer.warm_start')
+
+
+def build(learning_rate):
+    """A graph like model_fn's: a dense layer, BatchNormalization and an Adam optimizer on the global step"""
+    features = tf.compat.v1.placeholder(tf.float32, [None, 3])
+    labels = tf.compat.v1.placeholder(tf.float32, [None, 1])
+    model = tf.keras.Sequential([
+        tf.keras.layers.Dense(4, input_shape=(3,)),
+        tf.keras.layers.BatchNormalization(axis=1),
+        tf.keras.layers.Dense(1, activation='sigmoid'),
+    ])
+    loss = tf.reduce_mean(tf.keras.losses.binary_crossentropy(labels, model(features, training=True)))
+    optimizers = getattr(tf.keras.optimizers, 'legacy', tf.keras.optimizers)
+    optimizer = optimizers.Adam(learning_rate=learning_rate)
+    optimizer.iterations = tf.compat.v1.train.get_or_create_global_step()
+    train_op = optimizer.get_updates(loss, model.trainable_variables)[0]
+    return model, train_op, {features: np.ones([8, 3]), labels: np.ones([8, 1])}
+
+
+def values(session):
+    return {variable.op.name: session.run(variable) for variable in tf.compat.v1.global_variables()}
+
+
+def test_estimator_warm_start_includes_batch_norm_statistics(tmp_path):
+    with tf.Graph().as_default():
+        model, train_op, feed = build(.1)
+        with tf.compat.v1.Session() as session:
+            session.run(tf.compat.v1.global_variables_initializer())
+            for _ in range(3):
+                session.run(train_op, feed)
+            batch_norm = model.layers[1]
+            session.run([batch_norm.moving_mean.assign([1., 2., 3., 4.]), batch_norm.moving_variance.assign([5.] * 4)])
+            previous = values(session)
+            path = tf.compat.v1.train.Saver().save(session, str(tmp_path / 'model.ckpt'))
+
+    settings = warm_start.estimator_settings({'warm_start_from': path})
+    with tf.Graph().as_default():
+        build(.01)
+        tf.compat.v1.train.warm_start(path, vars_to_warm_start=settings.vars_to_warm_start)
+        with tf.compat.v1.Session() as session:
+            session.run(tf.compat.v1.global_variables_initializer())
+            restored = values(session)
+
+    assert np.allclose(restored['batch_normalization/moving_mean'], previous['batch_normalization/moving_mean'])
+    assert np.allclose(restored['batch_normalization/moving_variance'], 5.)
+    assert np.allclose(restored['dense/kernel'], previous['dense/kernel'])
+    assert restored['global_step'] == 0
+    assert np.isclose(restored['Adam/learning_rate'], .01)
+
+
+def test_report(tmp_path):
+    result = warm_start.report(
+        str(tmp_path),
+        {'loss': .5, 'auc': .8, 'global_step': 100},
+        {'loss': .4, 'auc': .85, 'global_step': 1000},
+        previous={'loss': .6, 'auc': .7},
+    )
+    assert result['difference'] == pytest.approx({'loss': .1, 'auc': -.05})
+    with open(str(tmp_path / warm_start.REPORT_FILE)) as f:
+        assert json.load(f) == result
+
+
+def test_validate():
+    params = {'replay_fraction': 0., 'new_data_since': '', 'warm_start_steps': 0, 'warm_start_baseline': '',
+              'warm_start_from': ''}
+    warm_start.validate(params)
+    with pytest.raises(ValueError):
+        warm_start.validate(dict(params, replay_fraction=.5))
+    with pytest.raises(ValueError):
+        warm_start.validate(dict(params, warm_start_steps=10))